@@ -27,6 +27,9 @@
 #
 
 import getopt, sys, os, glob, builtins, subprocess, time, signal, csv, tempfile, math
+import io, shutil, multiprocessing, threading, functools, concurrent.futures
+import xml.etree.ElementTree as ElementTree
+import hashlib, json, sqlite3, statistics, re
 
 # This shadows builtin open with the nasty os.open.
 from os import *
@@ -63,11 +66,55 @@ Options:
      generated_seq_program otherwise.
      e.g scheduler_tester.py -x -g \"-O3\"
   -h This help text.
+  -j <N> Run N (test case, architecture) pairs in parallel. Each pair is
+     compiled and simulated in a private scratch directory; the results are
+     reported in the same order as in a serial run.
+  --rerun-worsened=<N> Rerun each worsened (test case, architecture) pair N
+     times in parallel. The worsening is reported as compiler noise if any of
+     the runs reaches the reference cycle count, otherwise it is compared
+     using the median of the runs.
+  --profile-passes Ask LLVM for the pass execution times of the compilation
+     and print the slowest passes of each run.
+  --compile-time-limit=<percent> Consider the compile CPU time growing over
+     the given percentage from the median of the recent runs in the history
+     database an error.
+  --compile-memory-limit=<percent> Same for the compile peak memory.
+  --incremental=<file> Run only the (test case, architecture) pairs whose
+     ADF, OSAL operation modules, program, test configuration or compiler
+     build (tcecc, libtce, llvm-tce and the scheduler passes) changed since
+     they last passed. The inputs are recorded to the given
+     file. The Operations directory is rebuilt only if it changed.
+  --smoke=<list of test case directories> Always run these test cases in the
+     incremental mode. Matched like -b.
+  --history-db=<file> Append the results of every run to the given SQLite
+     database.
+  --moving-baseline=<N> Compare the results against the median of the last
+     N runs recorded to the history database instead of the top results.
+  --trend=<test>[,<ADF>] Print the cycle count trend of the test cases
+     matching <test> (from the right) recorded to the history database.
+  --which-regressed=<test>[,<ADF>] Print the commits after which the cycle
+     count of the matching test cases worsened.
+  -k <dir> Cache the scheduled programs in the given directory, keyed by
+     the program, the ADF, the extra compile flags and the compiler build
+     (tcecc, libtce, llvm-tce and the scheduler passes). Reruns with
+     unchanged inputs skip the scheduling.
+  -K <MB> Size limit of the -k cache, the least recently used programs are
+     evicted at the end of the run. Default: 1024.
+  -J <C>:<S> Like -j, but pipeline the scheduling and the simulation of the
+     pairs with C scheduling and S simulation workers, so the compilations of
+     the upcoming pairs overlap with the simulations.
+  --batch-simulation Schedule all the pairs first, then simulate the
+     programs of each ADF back to back in a single simulator process, loading
+     the machine and the operation behaviors only once. The ADFs are
+     simulated in parallel by the -j workers. Overrides -J.
   -i <comma separated list of stats>. Print more statistics for each run.
      Stats available:
      c=cycle count, rr=register reads, rw=register writes, oc=operation count,
-     opc=ops/cycle, and 'all' which includes all stats. Example: 'rr,rw'
-     prints register read and write stats.
+     opc=ops/cycle, fu=average function unit utilization, bus=average bus
+     utilization, ct=compile wall time, cc=compile CPU time, cm=compile peak
+     memory, and 'all' which includes all stats. Example: 'rr,rw'
+     prints register read and write stats. In the CSV output the stats are
+     appended as columns.
   -l Output as LaTeX table.
   -L Loosen the topresults. Set the worsened result as the new topresult to
      compare the future runs against but do not touch the results that
@@ -78,6 +125,14 @@ Options:
   -p Do not delete the parallel programs from scheduling after simulation.
   -q Use compiled simulation (slow initialization, fast simulation, basic
      block simulation granularity).
+  --compiled-sim-threshold=<cycles> Use compiled simulation for the
+     (test case, architecture) pairs whose reference cycle count is at least
+     the given count, the interpretive simulation for the rest.
+  --compiled-sim-cache=<dir> Keep the compiled simulation engines in the
+     given directory, so simulating an unchanged program on an unchanged
+     ADF again skips generating and compiling the engine.
+  --compiled-sim-cache-size=<MB> Size limit of the engine cache, the least
+     recently used engines are evicted at the end of the run. Default: 4096.
   -r Regression test mode. Do not output anything unless there's an error, in
      which case output as normal.
   -s Stop testing after the first FAILED test encountered.
@@ -145,6 +200,476 @@ def get_backend_cache_dir():
         backendCacheDir = tempfile.mkdtemp(prefix="scheduler_tester-")
     return backendCacheDir
 
+runScratchDir = None
+def get_run_scratch_dir():
+    """Returns the directory under which the -j mode runs are executed.
+
+    Creates a new temporary directory, if there's not one already."""
+    global runScratchDir
+    if runScratchDir is None:
+        runScratchDir = tempfile.mkdtemp(prefix="scheduler_tester-runs-")
+    return runScratchDir
+
+# The pool workers rely on inheriting the parsed options and the shared
+# counters of the parent process.
+forkContext = multiprocessing.get_context("fork")
+
+fileHashes = {}
+def file_hash(fileName):
+    """Returns the SHA-256 of the given file, computed once per run."""
+    fileName = os.path.abspath(fileName)
+    if fileName not in fileHashes:
+        with builtins.open(fileName, "rb") as f:
+            fileHashes[fileName] = hashlib.sha256(f.read()).hexdigest()
+    return fileHashes[fileName]
+
+# Build products which decide how the programs are compiled and scheduled,
+# relative to the location of this script. tcecc is only a script around
+# them. The backend plugins are generated by libtce in each run, unless
+# TCE_ST_REUSE_OLD_BACKENDS is set.
+compilerBuildFiles = ["../../src/bintools/Compiler/tcecc",
+                      "../../src/.libs/libtce*.so*",
+                      "../../src/.libs/libtce*.dylib",
+                      "../../src/bintools/Compiler/llvm-tce/llvm-tce",
+                      "../../src/bintools/Compiler/llvm-tce/.libs/*llvm-tce",
+                      "../../src/applibs/LLVMBackend/.libs/LLVMTCEPOMBuilder*",
+                      "../passes/*.so"]
+# The scheduler pass configurations, identified by their contents.
+schedulerConfigFiles = ["../passes/*.conf"]
+
+def existing_files(patterns):
+    """Returns the files matching the patterns relative to this script."""
+    files = set()
+    for pattern in patterns:
+        for fileName in glob.glob(os.path.join(rootDir, pattern)):
+            fileName = os.path.realpath(fileName)
+            if os.path.isfile(fileName):
+                files.add(fileName)
+    return sorted(files)
+
+compilerIdentity = None
+def get_compiler_identity():
+    """Returns a string which changes when the compiler is rebuilt.
+
+    Covers the tcecc version, the size and modification time of the
+    compiler and scheduler binaries and the contents of the scheduler
+    pass configurations.
+    """
+    global compilerIdentity
+    if compilerIdentity is None:
+        exitOk, version, err = runWithTimeout(tceccExe + " --version", 60)
+        parts = [version.strip()]
+        for fileName in existing_files(compilerBuildFiles):
+            st = os.stat(fileName)
+            parts.append("%s %d %d" % (fileName, st.st_size, st.st_mtime_ns))
+        for fileName in existing_files(schedulerConfigFiles):
+            parts.append("%s %s" % (fileName, file_hash(fileName)))
+        compilerIdentity = hashlib.sha256(
+            "\n".join(parts).encode("utf-8")).hexdigest()
+    return compilerIdentity
+
+class TPEFCache:
+    """Content addressed cache of the scheduled programs.
+
+    The programs are keyed by the hashes of the sequential program, the ADF,
+    the extra compile flags and the compiler, so the reruns which only
+    exercise a simulator change skip the scheduling. The least recently used
+    programs are evicted when the cache grows over its size limit.
+    """
+
+    def __init__(self, directory, maxSizeMB):
+        self.directory = os.path.abspath(directory)
+        self.maxSize = maxSizeMB * 1024 * 1024
+        os.makedirs(self.directory, exist_ok=True)
+        # Shared with the pool workers.
+        self.hits = forkContext.Value('l', 0)
+        self.misses = forkContext.Value('l', 0)
+        self.evicted = 0
+        self.size = 0
+        # Computed before forking the pool workers.
+        get_compiler_identity()
+
+    def key(self, seqProgFileName, archFilename, compileFlags):
+        key = hashlib.sha256()
+        for part in (get_compiler_identity(), compileFlags.strip(),
+                     file_hash(archFilename), file_hash(seqProgFileName)):
+            key.update(part.encode("utf-8") + b"\0")
+        return key.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".tpef")
+
+    def fetch(self, key, dstProgFileName):
+        """Copies the cached program to dstProgFileName, returns true on hit."""
+        cached = self.path(key)
+        try:
+            shutil.copyfile(cached, dstProgFileName)
+            # The modification time orders the programs for the eviction.
+            os.utime(cached)
+        except OSError:
+            counter = self.misses
+        else:
+            counter = self.hits
+        with counter.get_lock():
+            counter.value += 1
+        return counter is self.hits
+
+    def store(self, key, progFileName):
+        cached = self.path(key)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(cached))
+        os.close(fd)
+        shutil.copyfile(progFileName, tmpFile)
+        os.replace(tmpFile, cached)
+
+    def evict(self):
+        """Removes the least recently used programs over the size limit."""
+        entries = []
+        self.size = 0
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+                self.size += st.st_size
+        for mtime, size, path in sorted(entries):
+            if self.size <= self.maxSize:
+                break
+            tryRemove(path)
+            self.size -= size
+            self.evicted += 1
+
+    def summary(self):
+        return "TPEF cache: %d hit(s), %d miss(es), %d evicted, " \
+               "%.1f MB in %s.\n" % (self.hits.value, self.misses.value,
+                                     self.evicted, self.size / 1024.0 / 1024,
+                                     self.directory)
+
+# The cache of scheduled programs, if enabled with -k.
+tpefCache = None
+
+class CompiledSimulationCache:
+    """The directory ttasim keeps the compiled simulation engines in.
+
+    ttasim stores each statically compiled engine to the directory named by
+    TTASIM_COMPILED_SIM_CACHE, keyed by the generated code, that is, by the
+    ADF and the program, and reuses it when the pair is simulated again.
+    The least recently used engines are evicted when the directory grows
+    over its size limit.
+    """
+
+    def __init__(self, directory, maxSizeMB):
+        self.directory = os.path.abspath(directory)
+        self.maxSize = maxSizeMB * 1024 * 1024
+        os.makedirs(self.directory, exist_ok=True)
+        os.environ["TTASIM_COMPILED_SIM_CACHE"] = self.directory
+        self.oldEngines = set(self.engines())
+        self.evicted = 0
+        self.size = 0
+
+    def engines(self):
+        return [name for name in os.listdir(self.directory)
+                if name.startswith("engine_")]
+
+    def evict(self):
+        """Removes the least recently used engines over the size limit.
+
+        The engines are being compiled in the tmp_engine_ directories, which
+        are removed only after they are abandoned by a crashed simulator.
+        """
+        entries = []
+        self.size = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            mtime = os.stat(path).st_mtime
+            if name.startswith("tmp_engine_") and \
+               mtime > time.time() - simulationTimeoutSec:
+                continue
+            size = 0
+            for root, dirs, files in os.walk(path):
+                for fileName in files:
+                    size += os.lstat(os.path.join(root, fileName)).st_size
+            entries.append((mtime, size, path))
+            self.size += size
+        for mtime, size, path in sorted(entries):
+            if self.size <= self.maxSize:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            self.size -= size
+            self.evicted += 1
+
+    def summary(self):
+        engines = self.engines()
+        return "Compiled simulation cache: %d engine(s), %d new, %d evicted, " \
+               "%.1f MB in %s.\n" % (
+                   len(engines), len(set(engines) - self.oldEngines),
+                   self.evicted, self.size / 1024.0 / 1024, self.directory)
+
+# The compiled simulation engine cache, if enabled with --compiled-sim-cache.
+compiledSimulationCache = None
+
+class HistoryDatabase:
+    """Append-only SQLite store of the results of every run.
+
+    Keeps the history which topresults.csv and lastresults.csv lose, for
+    spotting slow drifts in the schedule quality and the commits which
+    caused them.
+    """
+
+    def __init__(self, fileName):
+        self.connection = sqlite3.connect(fileName)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                time TEXT,
+                commit_id TEXT,
+                test TEXT,
+                adf TEXT,
+                cycles INTEGER,
+                operations INTEGER,
+                register_reads INTEGER,
+                register_writes INTEGER,
+                compile_time REAL,
+                simulate_time REAL)""")
+        columns = [row[1] for row in
+                   self.connection.execute("PRAGMA table_info(runs)")]
+        for column, columnType in (("compile_cpu_time", "REAL"),
+                                   ("compile_maxrss", "INTEGER")):
+            if column not in columns:
+                self.connection.execute(
+                    "ALTER TABLE runs ADD COLUMN %s %s" % (column, columnType))
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS runs_test_adf ON runs (test, adf)")
+        self.connection.commit()
+
+    def commitId(self):
+        """Returns the commit of the tested sources, TCE_ST_COMMIT overrides."""
+        if 'TCE_ST_COMMIT' in os.environ:
+            return os.environ['TCE_ST_COMMIT']
+        try:
+            return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], cwd=rootDir,
+                stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return "unknown"
+
+    def record(self, testCases):
+        """Appends the successful runs of the given test cases."""
+        timeStamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        commitId = self.commitId()
+        rows = []
+        for testCase in testCases:
+            for arch in testCase.architectures:
+                if arch not in testCase.results:
+                    continue
+                stats = testCase.stats[arch]
+                rows.append((timeStamp, commitId, testCase.title, arch,
+                             stats.cycleCount, stats.operationExecutions,
+                             stats.registerReads, stats.registerWrites,
+                             stats.compileTime, stats.simulateTime,
+                             stats.compileCpuTime, stats.compileMaxRSS))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO runs (time, commit_id, test, adf, cycles, "
+                "operations, register_reads, register_writes, compile_time, "
+                "simulate_time, compile_cpu_time, compile_maxrss) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def movingBaseline(self, test, adf, runs):
+        """Returns the median cycle count of the latest runs, or None."""
+        cycles = [row[0] for row in self.connection.execute(
+            "SELECT cycles FROM runs WHERE test = ? AND adf = ? "
+            "ORDER BY id DESC LIMIT ?", (test, adf, runs))]
+        if len(cycles) == 0:
+            return None
+        return statistics.median(cycles)
+
+    def compileBaseline(self, test, adf, runs):
+        """Returns the median compile CPU time and peak memory of the latest
+        compiled runs, or None."""
+        rows = self.connection.execute(
+            "SELECT compile_cpu_time, compile_maxrss FROM runs "
+            "WHERE test = ? AND adf = ? AND compile_cpu_time IS NOT NULL "
+            "ORDER BY id DESC LIMIT ?", (test, adf, runs)).fetchall()
+        if len(rows) == 0:
+            return None
+        return (statistics.median(row[0] for row in rows),
+                statistics.median(row[1] for row in rows))
+
+    def commitHistory(self, test, adf):
+        """Returns (commit, first run time, median cycles, run count) tuples
+        of the given pair in the order the commits were first tested."""
+        commits = []
+        cycles = {}
+        for commitId, runTime, count in self.connection.execute(
+                "SELECT commit_id, time, cycles FROM runs "
+                "WHERE test = ? AND adf = ? ORDER BY id", (test, adf)):
+            if commitId not in cycles:
+                commits.append((commitId, runTime))
+                cycles[commitId] = []
+            cycles[commitId].append(count)
+        return [(commitId, runTime, statistics.median(cycles[commitId]),
+                 len(cycles[commitId])) for commitId, runTime in commits]
+
+    def pairs(self, testFilter, adf=None):
+        """Returns the recorded (test, ADF) pairs whose test name ends with
+        testFilter, limited to the given ADF."""
+        return [(test, arch) for test, arch in self.connection.execute(
+                    "SELECT DISTINCT test, adf FROM runs ORDER BY test, adf")
+                if test.endswith(testFilter) and adf in (None, arch)]
+
+    def printTrend(self, testFilter, adf=None):
+        for test, arch in self.pairs(testFilter, adf):
+            print(test + " " + arch + ":")
+            first = None
+            for commitId, runTime, cycles, count in \
+                    self.commitHistory(test, arch):
+                if first is None:
+                    first = cycles
+                print("  %-19s %-12s cycles: %.0f (%+.1f%%) runs: %d"
+                      % (runTime, commitId, cycles,
+                         (cycles - first) / first * 100, count))
+
+    def printRegressions(self, testFilter, adf=None):
+        """Prints the commits after which the median cycle count grew."""
+        for test, arch in self.pairs(testFilter, adf):
+            history = self.commitHistory(test, arch)
+            for previous, current in zip(history, history[1:]):
+                if current[2] > previous[2]:
+                    print("%s %s: regressed in %s (after %s): cycles %.0f -> "
+                          "%.0f (%+.1f%%)"
+                          % (test, arch, current[0], previous[0], previous[2],
+                             current[2],
+                             (current[2] - previous[2]) / previous[2] * 100))
+
+# The history database, if enabled with --history-db.
+historyDatabase = None
+
+class IncrementalState:
+    """Records the inputs each (test case, architecture) pair consumed.
+
+    A pair is fingerprinted by its ADF, the OSAL operation modules in the
+    Operations directory implementing the operations of the ADF, the
+    sequential program (or its sources with -g), the test configuration
+    files and the compiler build, see get_compiler_identity(), so that
+    rebuilding the scheduler reruns every pair. The incremental mode reruns
+    only the pairs whose fingerprint differs from the one recorded when they
+    last passed.
+    """
+
+    # Test case files which affect the result of a run.
+    configFiles = ["simulate.ttasim", "correct_simulation_output",
+                   "verify.sh", "extraCompileFlags"]
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.pairs = {}
+        self.operations = None
+        if os.access(fileName, R_OK):
+            with builtins.open(fileName) as f:
+                state = json.load(f)
+            self.pairs = state.get("pairs", {})
+            self.operations = state.get("operations")
+        self.archOperations = {}
+        self.operationModules = {}
+        for oppFile in sorted(glob.glob(operationDir + "/*.opp")):
+            module = oppFile[:-4]
+            moduleHash = hashlib.sha256()
+            for fileName in (oppFile, module + ".cc"):
+                if os.access(fileName, R_OK):
+                    moduleHash.update(file_hash(fileName).encode("utf-8"))
+            for name in ElementTree.parse(oppFile).getroot().iter("name"):
+                self.operationModules[name.text.strip().upper()] = \
+                    moduleHash.hexdigest()
+
+    def operationsHash(self):
+        return hashlib.sha256(" ".join(
+            sorted(set(self.operationModules.values()))).encode(
+                "utf-8")).hexdigest()
+
+    def operationsChanged(self):
+        """Returns true if the operation modules need to be rebuilt."""
+        if self.operations != self.operationsHash():
+            return True
+        for ccFile in glob.glob(operationDir + "/*.cc"):
+            opbFile = ccFile[:-3] + ".opb"
+            if not os.access(opbFile, R_OK) or \
+               os.stat(opbFile).st_mtime < os.stat(ccFile).st_mtime:
+                return True
+        return False
+
+    def architectureOperations(self, archFilename):
+        """Returns the hashes of the custom operation modules of the ADF."""
+        if archFilename not in self.archOperations:
+            names = set(element.text.strip().upper() for element in
+                        ElementTree.parse(archFilename).getroot().iter("name")
+                        if element.text is not None)
+            self.archOperations[archFilename] = sorted(set(
+                self.operationModules[name] for name in names
+                if name in self.operationModules))
+        return self.archOperations[archFilename]
+
+    def fingerprint(self, testCase, architecture):
+        archFilename = os.path.join(testCase.directory, architecture)
+        if not access(archFilename, R_OK):
+            archFilename = ADFDir + "/" + architecture
+        if not access(archFilename, R_OK):
+            # Let the run report the missing ADF.
+            return None
+
+        parts = [get_compiler_identity(), testCase.testExtraCompileFlags,
+                 file_hash(archFilename)]
+        parts += self.architectureOperations(archFilename)
+        if recompile:
+            sources = []
+            for root, dirs, files in os.walk(testCase.directory + "/src"):
+                sources += [os.path.join(root, name) for name in files
+                            if not name.startswith("generated_")]
+            parts += [file_hash(name) for name in sorted(sources)]
+        else:
+            seqProgFile = testCase.sequentialProgramFile(
+                archFilename, testCase.directory + "/program")
+            if access(seqProgFile, R_OK):
+                parts.append(file_hash(seqProgFile))
+        for name in self.configFiles:
+            if access(testCase.directory + "/" + name, R_OK):
+                parts.append(name + file_hash(testCase.directory + "/" + name))
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def select(self, testCase):
+        """Restricts the architectures of the test case to the changed ones.
+
+        The skipped architectures are stored to skippedArchitectures, so
+        their rows of lastresults.csv are kept."""
+        testCase.fingerprints = {}
+        selected = []
+        for arch in testCase.architectures:
+            fingerprint = self.fingerprint(testCase, arch)
+            testCase.fingerprints[arch] = fingerprint
+            if fingerprint is None or \
+               self.pairs.get(testCase.title + " " + arch) != fingerprint:
+                selected.append(arch)
+            else:
+                testCase.skippedArchitectures.append(arch)
+        testCase.architectures = selected
+
+    def record(self, testCases):
+        """Records the fingerprints of the passed pairs and saves the state."""
+        for testCase in testCases:
+            for arch in testCase.architectures:
+                if arch in testCase.results and \
+                   testCase.fingerprints.get(arch) is not None:
+                    self.pairs[testCase.title + " " + arch] = \
+                        testCase.fingerprints[arch]
+        tmpFile = self.fileName + ".tmp"
+        with builtins.open(tmpFile, "w") as f:
+            json.dump({"operations": self.operationsHash(),
+                       "pairs": self.pairs}, f, indent=1, sort_keys=True)
+        os.replace(tmpFile, self.fileName)
+
+# The state of the incremental mode, if enabled with --incremental.
+incrementalState = None
+
 # Find the ADF and Operations directory in the same directory
 # the script is at.
 fileListing = glob.glob(ADFDir + "/*.adf")
@@ -165,7 +690,37 @@ outputOnlyIfFailure = False
 leaveDirty = False
 testCaseFilters = None
 compiledSimulation = False
+# The reference cycle count from which on the compiled simulation is used.
+compiledSimulationThreshold = None
+# The directory and the size limit in MB of the compiled engine cache.
+compiledSimulationCacheDir = None
+compiledSimulationCacheSizeMB = 4096
 loosenResults = False
+# Number of (test case, architecture) pairs to run in parallel (-j).
+parallelJobs = 1
+# How many times to rerun the worsened pairs (--rerun-worsened).
+rerunWorsenedCount = 0
+# Whether to print the compiler pass times (--profile-passes).
+profilePasses = False
+# How much in percentages the compile CPU time and peak memory can grow from
+# the recorded runs without it being an error.
+compileTimeLimit = None
+compileMemoryLimit = None
+# The state file of the incremental mode and the test cases to always run.
+incrementalStateFile = None
+smokeTestFilters = []
+# The history database file and the query to run on it instead of the tests.
+historyDatabaseFile = None
+historyQuery = None
+# Number of the latest recorded runs the moving baseline is computed from.
+movingBaselineRuns = None
+# The directory and the size limit in MB of the scheduled program cache (-k, -K).
+tpefCacheDir = None
+tpefCacheSizeMB = 1024
+# The numbers of scheduling and simulation workers in the pipelined mode (-J).
+pipelineWorkers = None
+# Whether to simulate the programs of each ADF in one ttasim session.
+batchSimulation = False
 
 # How large can the average worsening be without it being
 # an error, thus affect the result of -r
@@ -195,13 +750,23 @@ def ParseCommandLine():
            recompile, leaveDirty, latexTable, moreStats, \
            normalOutput, testCaseFilters, \
            extraCompileFlags, compiledSimulation, worsenedIsErrorLimit,\
-           loosenResults, testRootDir
+           loosenResults, testRootDir, parallelJobs, pipelineWorkers, \
+           tpefCacheDir, tpefCacheSizeMB, historyDatabaseFile, historyQuery, \
+           movingBaselineRuns, rerunWorsenedCount, profilePasses, \
+           compileTimeLimit, compileMemoryLimit, incrementalStateFile, \
+           smokeTestFilters, batchSimulation, compiledSimulationThreshold, \
+           compiledSimulationCacheDir, compiledSimulationCacheSizeMB
 
     try:
         args_start = 1
 
         opts, args = getopt.getopt(\
-            sys.argv[args_start:], "g:a:b:shtTvVCopqrxw:dlLi:e:", ["help"])
+            sys.argv[args_start:], "g:a:b:shtTvVCopqrxw:dlLi:e:j:J:k:K:",
+            ["help", "history-db=", "moving-baseline=", "trend=",
+             "which-regressed=", "rerun-worsened=", "profile-passes",
+             "compile-time-limit=", "compile-memory-limit=", "incremental=",
+             "smoke=", "batch-simulation", "compiled-sim-threshold=",
+             "compiled-sim-cache=", "compiled-sim-cache-size="])
 
     except getopt.GetoptError as e:
         # print help information and exit:
@@ -252,7 +817,7 @@ def ParseCommandLine():
             compiledSimulation = True
         elif o == '-i':
             if a == 'all':
-                moreStats = 'c,rr,rw,oc,opc'.split(',')
+                moreStats = 'c,rr,rw,oc,opc,fu,bus,ct,cc,cm'.split(',')
             else:
                 moreStats = a.split(',')
         elif o == '-b':
@@ -261,6 +826,44 @@ def ParseCommandLine():
             worsenedIsErrorLimit = float(a)
         elif o == '-e':
             testRootDir = a
+        elif o == '-j':
+            parallelJobs = max(1, int(a))
+        elif o == '--incremental':
+            incrementalStateFile = a
+        elif o == '--smoke':
+            smokeTestFilters = a.split(',')
+        elif o == '--compiled-sim-threshold':
+            compiledSimulationThreshold = float(a)
+        elif o == '--compiled-sim-cache':
+            compiledSimulationCacheDir = a
+        elif o == '--compiled-sim-cache-size':
+            compiledSimulationCacheSizeMB = float(a)
+        elif o == '--batch-simulation':
+            batchSimulation = True
+        elif o == '--profile-passes':
+            profilePasses = True
+        elif o == '--compile-time-limit':
+            compileTimeLimit = float(a)
+        elif o == '--compile-memory-limit':
+            compileMemoryLimit = float(a)
+        elif o == '--rerun-worsened':
+            rerunWorsenedCount = max(0, int(a))
+        elif o == '--history-db':
+            historyDatabaseFile = a
+        elif o == '--moving-baseline':
+            movingBaselineRuns = max(1, int(a))
+        elif o in ('--trend', '--which-regressed'):
+            historyQuery = (o, a.split(','))
+        elif o == '-k':
+            tpefCacheDir = a
+        elif o == '-K':
+            tpefCacheSizeMB = float(a)
+        elif o == '-J':
+            workers = a.split(':')
+            if len(workers) != 2:
+                usage()
+                sys.exit(1)
+            pipelineWorkers = tuple(max(1, int(n)) for n in workers)
         elif o == '-x':
             pass
         else:
@@ -276,6 +879,10 @@ def ParseCommandLine():
 
     normalOutput = not latexTable and not csvFormat
 
+# Resource usage of the process last run with runWithTimeout(), None if it
+# timed out.
+lastRunUsage = None
+
 def runWithTimeout(command, timeoutSecs, inputStream = ""):
     """
     Runs the given process until it exits or the given time out is reached.
@@ -283,7 +890,9 @@ def runWithTimeout(command, timeoutSecs, inputStream = ""):
     Returns a triplet of which first value tells whether exited without timeout,
     second gives the process' output from stdout as a string, third the stderr
     """
-    global veryVerboseOutput
+    global veryVerboseOutput, lastRunUsage
+
+    lastRunUsage = None
 
     timePassed = 0.0
     increment = 0.01
@@ -307,8 +916,11 @@ def runWithTimeout(command, timeoutSecs, inputStream = ""):
                 process.stdin.flush()
 
         while True:
-            status = process.poll()
-            if status is not None:
+            # Reap the process ourselves to get its resource usage.
+            pid, status, usage = os.wait4(process.pid, WNOHANG)
+            if pid != 0:
+                process.returncode = os.waitstatus_to_exitcode(status)
+                lastRunUsage = usage
                 # Process terminated succesfully.
                 stdoutSize = os.lseek(stdoutFD, 0, 2)
                 stderrSize = os.lseek(stderrFD, 0, 2)
@@ -405,12 +1017,77 @@ class TestRunResult:
         self.cycleCount = -1
         self.verificationOK = False
 
+# A row of the LLVM pass execution timing report (-time-passes): the time
+# columns, each followed by a percentage, and the pass name.
+passTimingRow = re.compile(r'^\s*((?:[\d.]+\s+\(\s*[\d.]+%\)\s+)+)(.+?)\s*$')
+
+def parse_pass_timings(report):
+    """
+    Returns the wall times of the compiler passes found in the given output.
+
+    The wall time is the fourth time column of the LLVM timing report rows;
+    the times of the passes run several times are summed.
+    """
+    passes = {}
+    for line in report.splitlines():
+        match = passTimingRow.match(line)
+        if match is None or match.group(2) == 'Total':
+            continue
+        times = re.findall(r'([\d.]+)\s+\(', match.group(1))
+        if len(times) < 4:
+            continue
+        passes[match.group(2)] = passes.get(match.group(2), 0.0) + float(times[3])
+    return passes
+
+# Marks the line of the simulator output carrying the statistics record.
+statsRecordMarker = "SCHEDULER_TESTER_STATS "
+
 class SimulationStats:
     def __init__(self):
         self.cycleCount = 0
         self.registerReads = 0
         self.registerWrites = 0
         self.operationExecutions = 0
+        # Trigger counts of each function unit and write counts of each bus.
+        self.fuTriggers = {}
+        self.busWrites = {}
+        # Wall times of the compilation and the simulation in seconds.
+        self.compileTime = None
+        self.simulateTime = None
+        # CPU time in seconds and peak memory in kilobytes of the compilation
+        # and the wall times of the compiler passes, if profiled.
+        self.compileCpuTime = None
+        self.compileMaxRSS = None
+        self.compilePasses = {}
+
+    def setCompileProfile(self, profile):
+        """Stores the compile profile measured by TestCase.schedule()."""
+        if profile is None:
+            return
+        self.compileTime = profile['wall']
+        self.compileCpuTime = profile['cpu']
+        self.compileMaxRSS = profile['maxrss']
+        self.compilePasses = profile['passes']
+
+    def parseRecord(self, record):
+        """
+        Reads the statistics from the JSON record of 'info stats json'.
+
+        Both the interpretive and the compiled simulation provide the full
+        record.
+        """
+        stats = json.loads(record)
+        self.cycleCount = stats["cycles"]
+        self.operationExecutions = stats["executed_operations"]
+        self.registerReads = stats["register_reads"]
+        self.registerWrites = stats["register_writes"]
+        self.fuTriggers = stats["fu_triggers"]
+        self.busWrites = stats["bus_writes"]
+
+    def averageUtilization(self, counts):
+        if not counts or not self.cycleCount:
+            return 0.0
+        return sum(counts.values()) / len(counts) / self.cycleCount
 
     def decodeStatString(self, stat):
         """
@@ -435,6 +1112,20 @@ class SimulationStats:
             except:
                 pass
             return ('operation per cycle', 'opc', '%.2f' % value)
+        elif stat == 'fu':
+            return ('FU utilization', 'fu',
+                    '%.2f' % self.averageUtilization(self.fuTriggers))
+        elif stat == 'bus':
+            return ('bus utilization', 'bus',
+                    '%.2f' % self.averageUtilization(self.busWrites))
+        elif stat == 'ct':
+            return ('compile time (s)', 'ct', '%.2f' % (self.compileTime or 0))
+        elif stat == 'cc':
+            return ('compile CPU time (s)', 'cc',
+                    '%.2f' % (self.compileCpuTime or 0))
+        elif stat == 'cm':
+            return ('compile memory (MB)', 'cm',
+                    '%.1f' % ((self.compileMaxRSS or 0) / 1024.0))
         else:
             print('unknown statistics type:', stat)
             return (None, None, None)
@@ -481,6 +1172,8 @@ class TestCase:
         self.testExtraCompileFlags = extraCompileFlags
         self.description = ""
         self.architectures = []
+        # The unchanged architectures skipped in the incremental mode.
+        self.skippedArchitectures = []
         self.directory = directory
         if directory.startswith('./'):
             self.title = directory[2:]
@@ -528,6 +1221,19 @@ class TestCase:
 
         self.seqCycleCount = -1
 
+        # Moving baseline cycle counts for each architecture, if used.
+        self.baselines = None
+        # Fingerprints of the inputs of each architecture run, if the
+        # incremental mode is used.
+        self.fingerprints = {}
+        # Median compile CPU time and peak memory of the recent runs for each
+        # architecture, if the compile limits are used.
+        self.compileBaselines = {}
+        # Architectures whose worsening was found to be compiler noise.
+        self.noisyResults = set()
+        # Reruns of the worsened results must really compile the program.
+        self.useTPEFCache = True
+
     def setupTestDirectory(self):
         if os.path.lexists("data") and os.readlink("data") != operationDir:
             tryRemove("data")
@@ -625,6 +1331,15 @@ class TestCase:
 
     def schedule(self, archFilename, seqProgFileName, dstProgFileName):
 
+        cacheKey = None
+        # Stays None if the program was not compiled.
+        self.lastCompileProfile = None
+        if tpefCache is not None and self.useTPEFCache:
+            cacheKey = tpefCache.key(seqProgFileName, archFilename,
+                                     self.testExtraCompileFlags)
+            if tpefCache.fetch(cacheKey, dstProgFileName):
+                return True
+
         schedulingCommand = tceccExe + ' ' + self.testExtraCompileFlags + ' '
         if get_backend_cache_dir() != '':
             schedulingCommand += "--plugin-cache-dir=" + get_backend_cache_dir() + " "
@@ -635,13 +1350,23 @@ class TestCase:
         if (veryVerboseOutput):
             schedulingCommand += ' -v '
 
+        if profilePasses:
+            schedulingCommand += ' --llvm-args=-time-passes '
+
         schedulingCommand += ' ' + self.testExtraCompileFlags;
         schedulingCommand += " -o " + dstProgFileName + \
                              " -a " + archFilename + \
                              " " + seqProgFileName
 
 
+        startTime = time.monotonic()
         exitOk, stdoutContents, stderrContents = runWithTimeout(schedulingCommand, schedulingTimeoutSec)
+        if lastRunUsage is not None:
+            self.lastCompileProfile = {
+                'wall': time.monotonic() - startTime,
+                'cpu': lastRunUsage.ru_utime + lastRunUsage.ru_stime,
+                'maxrss': lastRunUsage.ru_maxrss,
+                'passes': parse_pass_timings(stderrContents)}
 
         if not exitOk:
             self.testFailed("scheduling timeout")
@@ -659,78 +1384,97 @@ class TestCase:
         if veryVerboseOutput and len(errmsg) > 0:
             sys.stdout.write("[" + errmsg + "]\n")
 
+        if cacheKey is not None:
+            tpefCache.store(cacheKey, dstProgFileName)
+
         return True
 
-    def simulate(self, archFilename, progFilename):
+    def simulationCommands(self):
+        """Returns the simulator commands that run the loaded program.
 
-        global compiledSimulation
+        The commands end with printing the stats record of the run.
+        """
+        if access("simulate.ttasim", R_OK):
+            script = builtins.open("simulate.ttasim", "r")
+            commands = script.read()
+            if not commands.endswith("\n"):
+                commands += "\n"
+        else:
+            commands = "until 0\n"
 
-        # Create the simulation script.
-        simulationScript = ""
+        # Print all the stats as a single record at the end of the output.
+        # The compiled simulation computes them from the execution counts
+        # of the basic blocks.
+        commands += 'puts "\\n%s[info stats json]"\n' % statsRecordMarker
+        return commands
 
-        if not archFilename == "":
-            simulationScript += "mach " + archFilename + "\n"
+    def compiledSimulationFor(self, architecture):
+        """Returns true if the architecture run should use compiled simulation.
 
-        simulationScript = simulationScript + "prog " + progFilename + "\n"
+        With --compiled-sim-threshold the engine is chosen by the reference
+        cycle count, as the compiled simulation pays off only for the long
+        simulations. The runs without a reference are simulated
+        interpretively.
+        """
+        if compiledSimulation:
+            return True
+        if compiledSimulationThreshold is None:
+            return False
+        predicted = self.referenceCycleCount(architecture)
+        return predicted is not None and predicted >= compiledSimulationThreshold
 
-        if access("simulate.ttasim", R_OK):
-            script = builtins.open("simulate.ttasim", "r")
-            simulationScript = simulationScript + script.read()
+    def simulate(self, archFilename, progFilename, batchOutput=None,
+                 compiled=False):
+        """Simulates the program and reads the stats of the simulation.
+
+        The program is simulated in a ttasim process of its own, with the
+        compiled simulation if compiled is true, unless the (stdout, stderr,
+        simulation time) of the program simulated in a shared batch session
+        is given.
+        """
+
+        if batchOutput is not None:
+            exitOk = True
+            stdoutContents, stderrContents, simulateTime = batchOutput
         else:
-            simulationScript = simulationScript + "until 0\n"
+            # Create the simulation script.
+            simulationScript = ""
 
-        tryRemove("cyclecount")
-        tryRemove('operations_executed')
-        tryRemove('registers_written')
-        tryRemove('registers_read')
-        # Create a script that creates the stat files. Do not overwrite
-            # possible existing files to allow the custom simulation
-            # script to create a stats of its own (for example, in case of
-            # wanting to include only a part of the simulated program in the stats)
-
-        simulationScript = simulationScript + '''
-if ![file exists cyclecount] {
-set cycle_file [open cyclecount w] ; puts $cycle_file "[info proc cycles]"
-flush $cycle_file
-close $cycle_file
-}
-'''
-        if not compiledSimulation:
-                simulationScript += '''
-                if ![file exists operations_executed] {
-                set f [open operations_executed w] ; puts $f "[info stats executed_operations]"
-                flush $f
-                close $f
-                }
-
-                if ![file exists registers_written] {
-                set f [open registers_written w] ; puts $f "[info stats register_writes]"
-                flush $f
-                close $f
-                }
-
-                if ![file exists registers_read] {
-                set f [open registers_read w] ; puts $f "[info stats register_reads]"
-                flush $f
-                close $f
-                }
-                '''
-        simulationScript = simulationScript + "quit\n"
+            if not archFilename == "":
+                simulationScript += "mach " + archFilename + "\n"
 
-        simulationCommand = simulatorExe
+            simulationScript = simulationScript + "prog " + progFilename + "\n"
+            simulationScript += self.simulationCommands()
+            simulationScript = simulationScript + "quit\n"
 
-        if compiledSimulation:
-            simulationCommand += " -q"
+            # The custom simulation script can still write stat files of its
+            # own (for example, in case of wanting to include only a part of
+            # the simulated program in the stats), which override the record.
+            tryRemove("cyclecount")
+            tryRemove('operations_executed')
+            tryRemove('registers_written')
+            tryRemove('registers_read')
+
+            simulationCommand = simulatorExe
 
-        exitOk, stdoutContents, stderrContents = runWithTimeout(simulationCommand,
-                                                                simulationTimeoutSec,
-                                                                simulationScript)
+            if compiled:
+                simulationCommand += " -q"
+
+            startTime = time.monotonic()
+            exitOk, stdoutContents, stderrContents = runWithTimeout(simulationCommand,
+                                                                    simulationTimeoutSec,
+                                                                    simulationScript)
+            simulateTime = time.monotonic() - startTime
 
         if not exitOk:
             self.testFailed("simulation timeout")
             return False
 
-        self.simStdOut = stdoutContents
+        self.simStdOut, marker, record = \
+            stdoutContents.rpartition(statsRecordMarker)
+        if not marker:
+            self.simStdOut = stdoutContents
+            record = None
         self.simStdErr = stderrContents
 
         verbose = ""
@@ -755,7 +1499,22 @@ close $cycle_file
                 return None
 
         self.lastStats = SimulationStats()
-        self.lastStats.cycleCount = getStat('cyclecount')
+        self.lastStats.simulateTime = simulateTime
+        if record is not None:
+            try:
+                self.lastStats.parseRecord(record.splitlines()[0])
+            except (ValueError, KeyError, IndexError):
+                self.lastStats.cycleCount = None
+        else:
+            self.lastStats.cycleCount = None
+
+        for fileName, attribute in (('cyclecount', 'cycleCount'),
+                                    ('operations_executed', 'operationExecutions'),
+                                    ('registers_read', 'registerReads'),
+                                    ('registers_written', 'registerWrites')):
+            value = getStat(fileName)
+            if value is not None:
+                setattr(self.lastStats, attribute, value)
 
         if self.lastStats.cycleCount is None:
             self.testFailed("simulation", "failed to get cycle count " + verbose)
@@ -768,44 +1527,75 @@ close $cycle_file
             self.testFailed("simulation", verbose)
             return False
 
-        self.lastStats.operationExecutions = getStat('operations_executed')
-        self.lastStats.registerReads = getStat('registers_read')
-        self.lastStats.registerWrites = getStat('registers_written')
-
-        self.stats[archFilename] = self.lastStats
         return True
 
-    def runWithArchitecture(self, architecture, seqProgFileBase):
-        """Runs the test case with given architecture definition file.
+    def referenceCycleCount(self, architecture):
+        """Returns the cycle count the run is compared against, or None.
 
-        Returns true in case test passed.
+        The moving baseline from the history database is preferred over the
+        top result, if one is available.
         """
+        if self.baselines is not None and architecture in self.baselines:
+            return self.baselines[architecture]
+        if self.oldResults is None or not architecture in self.oldResults:
+            return None
+        return int(self.oldResults[architecture][-1])
 
-        global normalOutput
+    def runWithArchitecture(self, architecture, seqProgFileBase, progDir=None):
+        """Runs the test case with given architecture definition file.
 
-        archFilename = architecture
-        if not access(archFilename, R_OK):
-            archFilename = ADFDir + "/" + architecture
+        The parallel program is written to progDir, by default to the
+        current directory.
 
-        if not access(archFilename, R_OK):
-            print("Cannot find ", archFilename)
-            sys.exit(2)
+        Returns true in case test passed.
+        """
+        compiled = self.compileWithArchitecture(architecture, seqProgFileBase,
+                                                progDir)
+        if compiled is None:
+            return False
+        return self.simulateWithArchitecture(architecture, *compiled)
 
+    def sequentialProgramFile(self, archFilename, seqProgFileBase,
+                              verbose=False):
+        """Returns the sequential program file matching the machine."""
         machineLittleEndian = "<little-endian/>" in builtins.open(archFilename).read()
         machine64bits = "<bitness64/>" in builtins.open(archFilename).read()
         if machineLittleEndian:
             if (machine64bits):
                 seqProgFile = seqProgFileBase + ".64.bc";
-                if verboseOutput:
+                if verbose:
                     print("Machine is 64-bit. using 64 bc file.")
             else:
                 seqProgFile = seqProgFileBase + ".le.bc";
-                if verboseOutput:
+                if verbose:
                     print("Machine is little endian. using LE bc file.")
         else:
             seqProgFile = seqProgFileBase + ".be.bc";
-            if verboseOutput:
+            if verbose:
                 print("Machine is big endian. using BE bc file.")
+        return seqProgFile
+
+    def compileWithArchitecture(self, architecture, seqProgFileBase,
+                                progDir=None):
+        """Schedules the test program for given architecture definition file.
+
+        The first stage of runWithArchitecture(). Returns the ADF and the
+        parallel program file names and the compile profile, or None if the
+        scheduling failed.
+        """
+
+        global normalOutput
+
+        archFilename = architecture
+        if not access(archFilename, R_OK):
+            archFilename = ADFDir + "/" + architecture
+
+        if not access(archFilename, R_OK):
+            print("Cannot find ", archFilename)
+            sys.exit(2)
+
+        seqProgFile = self.sequentialProgramFile(archFilename, seqProgFileBase,
+                                                 verboseOutput)
 
         if csvFormat:
             sys.stdout.write(self.title + "," + architecture + ",")
@@ -814,8 +1604,6 @@ close $cycle_file
             sys.stdout.write(architecture + ": ")
             sys.stdout.flush()
 
-        success = True
-
         progFileName = ""
         if architecture.lower().endswith(".adf"):
             progFileName = architecture[:-4]
@@ -825,7 +1613,9 @@ close $cycle_file
         progFileName = progFileName + ".tpef"
 
         # always write the TPEF to the current directory
-        progFileName = os.getcwd() + "/" + os.path.basename(progFileName)
+        if progDir is None:
+            progDir = os.getcwd()
+        progFileName = progDir + "/" + os.path.basename(progFileName)
 
         self.parallelPrograms.append(progFileName)
 
@@ -833,26 +1623,45 @@ close $cycle_file
         tryRemove(progFileName)
 
         if not self.schedule(archFilename, seqProgFile, progFileName):
-            return False
+            return None
+
+        return (archFilename, progFileName, self.lastCompileProfile)
+
+    def simulateWithArchitecture(self, architecture, archFilename,
+                                 progFileName, compileProfile=None,
+                                 batchOutput=None):
+        """Simulates and verifies the program scheduled for the architecture.
 
-        if not self.simulate(archFilename, progFileName):
+        The second stage of runWithArchitecture(). The batchOutput is passed
+        to simulate(). Returns true in case test passed.
+        """
+
+        global normalOutput
+
+        success = True
+
+        if not self.simulate(archFilename, progFileName, batchOutput,
+                             self.compiledSimulationFor(architecture)):
             return False
 
         if not self.verifySimulation():
             return False
 
-        if self.oldResults is None or not architecture in self.oldResults:
+        self.lastStats.setCompileProfile(compileProfile)
+        self.stats[architecture] = self.lastStats
+
+        oldResult = self.referenceCycleCount(architecture)
+        if oldResult is None:
             percentage = None
             difference = None
             if normalOutput:
                 sys.stdout.write("OK. cycles: %.0f (first result) (+)" % self.lastStats.cycleCount)
             elif csvFormat:
-                sys.stdout.write("OK,%.0f,-,first\n"
+                sys.stdout.write("OK,%.0f,-,first"
                              % (self.lastStats.cycleCount))
 
             self.improvedRuns = True
         else:
-            oldResult = int(self.oldResults[architecture][-1])
             difference = self.lastStats.cycleCount - oldResult
             percentage = float(int((difference / oldResult)*1000))/10
 
@@ -868,7 +1677,7 @@ close $cycle_file
                 sys.stdout.write("OK. cycles: %.0f difference: %.0f (%.1f%%) (%s)"
                                  % (self.lastStats.cycleCount, difference, percentage, sign))
             elif csvFormat:
-                sys.stdout.write("OK,%.0f,%.0f,%.1f%%\n"
+                sys.stdout.write("OK,%.0f,%.0f,%.1f%%"
                              % (self.lastStats.cycleCount, difference, percentage))
 
 
@@ -878,6 +1687,17 @@ close $cycle_file
                     name, short, value = self.lastStats.decodeStatString(stat)
                     sys.stdout.write(' %s: %s' % (short, value))
             sys.stdout.write('\n')
+            if profilePasses and len(self.lastStats.compilePasses) > 0:
+                slowest = sorted(self.lastStats.compilePasses.items(),
+                                 key=lambda item: -item[1])[:5]
+                sys.stdout.write('  slowest compiler passes: %s\n' % ', '.join(
+                    '%s %.2fs' % (name, wall) for name, wall in slowest))
+        elif csvFormat:
+            if moreStats is not None:
+                for stat in moreStats:
+                    name, short, value = self.lastStats.decodeStatString(stat)
+                    sys.stdout.write(',%s' % value)
+            sys.stdout.write('\n')
 
         self.results[architecture] = (self.lastStats.cycleCount, difference, percentage)
 
@@ -945,15 +1765,13 @@ close $cycle_file
             return False
         return True
 
-    def run(self):
-        """Runs the test case with all architectures.
+    def prepare(self):
+        """Sets up the test directory and recompiles the program if requested.
 
-        Returns true only if all tests passed.
+        Must be called in the test directory. Returns the base name of the
+        sequential program files, or None if the source compilation failed.
         """
-        global latexTable, recompile, normalOutput
-
-        self.oldDir = os.getcwd()
-        os.chdir(self.directory)
+        global recompile
 
         self.setupTestDirectory()
 
@@ -961,22 +1779,33 @@ close $cycle_file
             callSilent("./setup.sh")
             self.setupExecuted = True
 
-        allPassed = True
-
         # LLVM bytecode from LLVM/TCE
         seqProgFileBase = "program"
 
         # Recompile and set names for test programs.
         if recompile:
-            srcCompileOk = self.verifyCompiler(self.testExtraCompileFlags)
-            allPassed = allPassed and srcCompileOk
-
-            if srcCompileOk == False:
+            if not self.verifyCompiler(self.testExtraCompileFlags):
                 self.testFailed("Source compilation failed.")
-                os.chdir(self.oldDir)
-                return False
-            else:
-                seqProgFileBase = "generated_program"
+                return None
+            seqProgFileBase = "generated_program"
+        return seqProgFileBase
+
+    def run(self):
+        """Runs the test case with all architectures.
+
+        Returns true only if all tests passed.
+        """
+        global latexTable, normalOutput
+
+        self.oldDir = os.getcwd()
+        os.chdir(self.directory)
+
+        seqProgFileBase = self.prepare()
+        if seqProgFileBase is None:
+            os.chdir(self.oldDir)
+            return False
+
+        allPassed = True
 
 #        if configFileDefined:
         for arch in self.architectures:
@@ -991,6 +1820,105 @@ close $cycle_file
         os.chdir(self.oldDir)
         return allPassed
 
+    def prepareParallelRuns(self):
+        """Prepares the test case for the -j, -J and batch simulation modes.
+
+        The printout of the preparation is stored to be reported with the
+        results of the test case. Returns the (test case, architecture,
+        sequential program base name) triples to run.
+        """
+        oldDir = os.getcwd()
+        os.chdir(self.directory)
+        realStdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            self.seqProgFileBase = self.prepare()
+            self.prepareOutput = sys.stdout.getvalue()
+        finally:
+            sys.stdout = realStdout
+            os.chdir(oldDir)
+
+        if self.seqProgFileBase is None:
+            return []
+        return [(self, arch, self.seqProgFileBase) for arch in self.architectures]
+
+    def createScratchDir(self):
+        """Creates a private run directory for the test case.
+
+        The scratch directory mirrors the test directory with symbolic links,
+        so the fixed name files the simulation produces (cyclecount,
+        ttasim.out, etc.) do not clash with the other runs of the same test
+        case.
+        """
+        testDir = os.path.abspath(self.directory)
+        scratchDir = tempfile.mkdtemp(dir=get_run_scratch_dir())
+        for entry in os.listdir(testDir):
+            if entry in runOutputFiles:
+                continue
+            os.symlink(os.path.join(testDir, entry),
+                       os.path.join(scratchDir, entry))
+        return scratchDir
+
+    def runInScratchDir(self, stage, *args, scratchDir=None):
+        """Calls the given run stage method in a private directory.
+
+        A new scratch directory is created unless one is given. The directory
+        is removed afterwards.
+        """
+        if scratchDir is None:
+            scratchDir = self.createScratchDir()
+
+        oldDir = os.getcwd()
+        os.chdir(scratchDir)
+        try:
+            return getattr(self, stage)(*args)
+        finally:
+            os.chdir(oldDir)
+            if leaveDirty:
+                print("Left the run directory " + scratchDir, file=sys.stderr)
+            else:
+                shutil.rmtree(scratchDir, ignore_errors=True)
+
+    def reportParallelRuns(self, runs):
+        """Reports the results of the architecture runs done in the -j mode.
+
+        The runs are taken from the given iterator of run_stage_job()
+        results in the order of the architectures. Returns true only if all
+        tests passed.
+        """
+        global failureFound
+
+        sys.stdout.write(self.prepareOutput)
+        if self.seqProgFileBase is None:
+            sys.stdout.flush()
+            return False
+
+        allPassed = True
+        for arch in self.architectures:
+            passed, output, failed, results, stats, improved, programs, \
+                exitCode = next(runs)
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if exitCode is not None:
+                cleanup_and_exit(exitCode)
+
+            self.results.update(results)
+            self.stats.update(stats)
+            self.improvedRuns = self.improvedRuns or improved
+            self.parallelPrograms += programs
+            failureFound = failureFound or failed
+
+            allPassed = passed and allPassed
+            if stopTestingAfterFailingTest and not allPassed:
+                return False
+
+        if not leaveDirty:
+            oldDir = os.getcwd()
+            os.chdir(self.directory)
+            self.cleanupTestDirectory()
+            os.chdir(oldDir)
+        return allPassed
+
     def updateStatisticsFiles(self):
         """Updates the top execution statistics file and the last execution statistics file.
 
@@ -998,7 +1926,16 @@ close $cycle_file
         no sense to update the statistics if the algorithm fails for other test cases.
         """
         timeStamp = time.strftime("%d.%m.%y %H:%M")
+        skippedRows = []
+        if len(self.skippedArchitectures) > 0 and \
+           access(self.directory + "/lastresults.csv", R_OK):
+            reader = csv.reader(builtins.open(self.directory + "/lastresults.csv", "rt"))
+            skippedRows = [row for row in reader
+                           if len(row) > 0 and row[0] in self.skippedArchitectures]
         lastRunWriter = csv.writer(builtins.open(self.directory + "/lastresults.csv", "w"))
+        # Keep the results of the architectures the incremental mode skipped.
+        for row in skippedRows:
+            lastRunWriter.writerow(row)
         for arch in self.architectures:
             lastRunWriter.writerow([arch, timeStamp, "%.0f" %
                                     self.results[arch][0]])
@@ -1006,7 +1943,7 @@ close $cycle_file
         if (topStatsUpdates and self.improvedRuns) or baselineUpdate or loosenResults:
             topStatsWriter = csv.writer(builtins.open(self.directory + "/topresults.csv", "w"))
 
-            for arch in set(self.architectures + (self.oldResults and self.oldResults.keys() or [])):
+            for arch in set(self.architectures + (self.oldResults and list(self.oldResults.keys()) or [])):
                 oldResult = None
                 if self.oldResults is not None and arch in self.oldResults:
                     oldResult = self.oldResults[arch]
@@ -1031,6 +1968,269 @@ close $cycle_file
                     topStatsWriter.writerow([arch] + oldResult)
 
 
+# Files produced in the working directory by a single architecture run.
+runOutputFiles = ["cyclecount", "ttasim.out", "operations_executed",
+                  "registers_read", "registers_written"]
+
+def run_stage_job(job):
+    """Runs a stage of a (test case, architecture) pair in a pool worker.
+
+    The job is a triple of the test case, the name of the stage method and
+    its arguments, optionally followed by the scratch directory to run the
+    stage in. The printout is captured and returned with the results,
+    so the parent process can report them in the order of a serial run.
+    """
+    global failureFound
+
+    testCase, stage, args = job[:3]
+    scratchDir = job[3] if len(job) > 3 else None
+    failureFound = False
+    testCase.results = {}
+    testCase.stats = {}
+    testCase.improvedRuns = False
+    testCase.parallelPrograms = []
+    exitCode = None
+
+    realStdout = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        value = testCase.runInScratchDir(stage, *args, scratchDir=scratchDir)
+    except SystemExit as e:
+        value = None
+        exitCode = e.code
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = realStdout
+
+    return (value, output, failureFound, testCase.results, testCase.stats,
+            testCase.improvedRuns, testCase.parallelPrograms, exitCode)
+
+def combine_stage_runs(compileRun, simulateRun):
+    """Combines the stage results of a pair to the result of a whole run.
+
+    The simulateRun is None if the program was not simulated.
+    """
+    compiled, output, failed, results, stats, improved, programs, \
+        exitCode = compileRun
+    if simulateRun is None:
+        return (False, output, failed, {}, {}, False, programs, exitCode)
+    passed, simOutput, simFailed, results, stats, improved, \
+        simPrograms, exitCode = simulateRun
+    return (passed, output + simOutput, failed or simFailed, results,
+            stats, improved, programs + simPrograms, exitCode)
+
+# Printed after each program of a batch simulation session, to stdout with
+# the simulation time of the program in milliseconds and to stderr alone.
+batchEndMarker = "SCHEDULER_TESTER_END "
+
+# Custom simulation script commands that do not work in a shared session.
+batchUnsafeCommand = re.compile(r"^\s*(quit|exit|mach|prog|conf)\b",
+                                re.MULTILINE)
+
+def run_simulation_batch(job):
+    """Simulates the programs scheduled for one machine in a pool worker.
+
+    The job is a triple of the ADF file name, whether to use the compiled
+    simulation and a list of (test case, architecture, program file name,
+    compile profile) tuples. The machine
+    is loaded to a single ttasim session once, after which the programs are
+    loaded and run back to back, each in a scratch directory of its own.
+    Loading a program resets the simulation state. The programs with a
+    custom simulation script that does not suit a shared session, and the
+    programs the session did not finish, are simulated separately.
+
+    Returns the run_stage_job() results of the programs in the given order.
+    """
+    archFilename, compiled, runs = job
+    scratchDirs = [testCase.createScratchDir() for testCase, a, p, c in runs]
+
+    script = "mach {%s}\n" % archFilename
+    batched = []
+    oldDir = os.getcwd()
+    try:
+        for (testCase, architecture, progFileName, compileProfile), \
+                scratchDir in zip(runs, scratchDirs):
+            os.chdir(scratchDir)
+            commands = testCase.simulationCommands()
+            if batchUnsafeCommand.search(commands):
+                continue
+            batched.append(scratchDir)
+            script += "cd {%s}\n" % scratchDir
+            script += "set scheduler_tester_start [clock milliseconds]\n"
+            script += "prog {%s}\n" % progFileName
+            script += commands
+            script += 'puts "%s[expr {[clock milliseconds] - ' \
+                      '$scheduler_tester_start}]"\n' % batchEndMarker
+            script += 'puts stderr "%s"\n' % batchEndMarker
+    finally:
+        os.chdir(oldDir)
+    script += "quit\n"
+
+    batchOutputs = {}
+    if len(batched) > 0:
+        simulationCommand = simulatorExe
+        if compiled:
+            simulationCommand += " -q"
+        exitOk, stdoutContents, stderrContents = runWithTimeout(
+            simulationCommand, simulationTimeoutSec, script)
+        if not exitOk:
+            stdoutContents = stderrContents = ""
+        stdoutParts = stdoutContents.split(batchEndMarker)
+        stderrParts = stderrContents.split(batchEndMarker + "\n")
+        for index, scratchDir in enumerate(batched):
+            if index + 1 >= len(stdoutParts) or \
+               index + 1 >= len(stderrParts):
+                break
+            milliseconds, newline, rest = stdoutParts[index + 1].partition("\n")
+            stdoutParts[index + 1] = rest
+            try:
+                simulateTime = int(milliseconds) / 1000.0
+            except ValueError:
+                simulateTime = None
+            batchOutputs[scratchDir] = (stdoutParts[index],
+                                        stderrParts[index], simulateTime)
+
+    return [run_stage_job((testCase, "simulateWithArchitecture",
+                           (architecture, archFilename, progFileName,
+                            compileProfile, batchOutputs.get(scratchDir)),
+                           scratchDir))
+            for (testCase, architecture, progFileName, compileProfile),
+                scratchDir in zip(runs, scratchDirs)]
+
+class ArchitecturePipeline:
+    """Runs (test case, architecture) pairs in two pipelined stages.
+
+    The programs are scheduled in one process pool and simulated in another,
+    so the compilations of the upcoming pairs overlap with the simulations of
+    the already scheduled programs. The pairs in flight are bounded so that
+    at most queueLength scheduled programs per simulation worker wait to be
+    simulated.
+    """
+
+    def __init__(self, pairs, compileWorkers, simulateWorkers, queueLength=2):
+        self.pairs = pairs
+        self.compilePool = forkContext.Pool(compileWorkers)
+        self.simulatePool = forkContext.Pool(simulateWorkers)
+        self.slots = threading.Semaphore(
+            compileWorkers + simulateWorkers * (1 + queueLength))
+        self.stopped = False
+        self.runs = [concurrent.futures.Future() for pair in pairs]
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+    def feed(self):
+        for index, (testCase, architecture, seqProgFileBase) in \
+                enumerate(self.pairs):
+            self.slots.acquire()
+            if self.stopped:
+                return
+            job = (testCase, "compileWithArchitecture",
+                   (architecture, seqProgFileBase,
+                    os.path.abspath(testCase.directory)))
+            self.compilePool.apply_async(
+                run_stage_job, (job,),
+                callback=functools.partial(self.compiled, index),
+                error_callback=functools.partial(self.failed, index))
+
+    def compiled(self, index, compileRun):
+        compiled, exitCode = compileRun[0], compileRun[-1]
+        if compiled is None or exitCode is not None:
+            self.finished(index, compileRun, None)
+            return
+        testCase, architecture, seqProgFileBase = self.pairs[index]
+        job = (testCase, "simulateWithArchitecture", (architecture,) + compiled)
+        self.simulatePool.apply_async(
+            run_stage_job, (job,),
+            callback=functools.partial(self.finished, index, compileRun),
+            error_callback=functools.partial(self.failed, index))
+
+    def finished(self, index, compileRun, simulateRun):
+        self.slots.release()
+        self.runs[index].set_result(combine_stage_runs(compileRun, simulateRun))
+
+    def failed(self, index, error):
+        self.slots.release()
+        self.runs[index].set_exception(error)
+
+    def results(self):
+        """Yields the combined results of the pairs in the given order."""
+        for run in self.runs:
+            yield run.result()
+
+    def close(self):
+        self.feeder.join()
+        self.compilePool.close()
+        self.simulatePool.close()
+
+    def join(self):
+        self.compilePool.join()
+        self.simulatePool.join()
+
+    def terminate(self):
+        self.stopped = True
+        self.slots.release(len(self.pairs))
+        self.compilePool.terminate()
+        self.simulatePool.terminate()
+
+class BatchSimulation:
+    """Runs (test case, architecture) pairs grouped by the machine.
+
+    All the programs are scheduled first, after which the programs of each
+    machine and simulation engine are simulated in a single ttasim session
+    by run_simulation_batch(),
+    avoiding the simulator startup, the loading of the OSAL behaviors and
+    the parsing of the ADF per program. The machines are simulated in
+    parallel by the given number of workers.
+    """
+
+    def __init__(self, pairs, workers):
+        self.pairs = pairs
+        self.pool = forkContext.Pool(workers)
+
+    def results(self):
+        """Yields the combined results of the pairs in the given order."""
+        compileRuns = self.pool.map(
+            run_stage_job,
+            [(testCase, "compileWithArchitecture",
+              (architecture, seqProgFileBase,
+               os.path.abspath(testCase.directory)))
+             for testCase, architecture, seqProgFileBase in self.pairs])
+
+        machines = {}
+        for index, compileRun in enumerate(compileRuns):
+            compiled, exitCode = compileRun[0], compileRun[-1]
+            if compiled is None or exitCode is not None:
+                continue
+            testCase, architecture, seqProgFileBase = self.pairs[index]
+            archFilename, progFileName, compileProfile = compiled
+            archFilename = os.path.realpath(
+                os.path.join(testCase.directory, archFilename))
+            useCompiled = testCase.compiledSimulationFor(architecture)
+            machines.setdefault((archFilename, useCompiled), []).append(
+                (index, (testCase, architecture, progFileName,
+                         compileProfile)))
+
+        simulateRuns = {}
+        batches = [(archFilename, useCompiled, [run for index, run in runs])
+                   for (archFilename, useCompiled), runs in machines.items()]
+        for (machine, runs), batchRuns in zip(
+                machines.items(),
+                self.pool.imap(run_simulation_batch, batches)):
+            for (index, run), simulateRun in zip(runs, batchRuns):
+                simulateRuns[index] = simulateRun
+
+        for index, compileRun in enumerate(compileRuns):
+            yield combine_stage_runs(compileRun, simulateRuns.get(index))
+
+    def close(self):
+        self.pool.close()
+
+    def join(self):
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+
 def get_subdirectories(root):
     "Walk does not follow symbolic links. So here's replacement."
     found_subdirs = [root]
@@ -1085,6 +2285,26 @@ class Tester:
                         if not found:
                             continue
                     newCase = TestCase(root)
+                    if compileTimeLimit is not None or \
+                       compileMemoryLimit is not None:
+                        for arch in newCase.architectures:
+                            baseline = historyDatabase.compileBaseline(
+                                newCase.title, arch, movingBaselineRuns or 5)
+                            if baseline is not None:
+                                newCase.compileBaselines[arch] = baseline
+                    if movingBaselineRuns is not None:
+                        newCase.baselines = {}
+                        for arch in newCase.architectures:
+                            baseline = historyDatabase.movingBaseline(
+                                newCase.title, arch, movingBaselineRuns)
+                            if baseline is not None:
+                                newCase.baselines[arch] = baseline
+
+                    if incrementalState is not None and \
+                       not any(root.endswith(smoke) for smoke in smokeTestFilters):
+                        incrementalState.select(newCase)
+                        if len(newCase.architectures) == 0:
+                            continue
 
                     # Push the new test case to our test case sequence
                     self.testCases.append(newCase)
@@ -1108,6 +2328,7 @@ class Tester:
 
         improved = 0
         worsened = 0
+        noisy = 0
         equal = 0
         newResults = 0
         broken = 0
@@ -1128,6 +2349,8 @@ class Tester:
                     else:
                         if difference == 0:
                             equal = equal + 1
+                        elif arch in testCase.noisyResults:
+                            noisy = noisy + 1
                         else:
                             if percentage < 0:
                                 improved = improved + 1
@@ -1163,6 +2386,11 @@ class Tester:
                 failureFound = True
 
 
+        if noisy > 0:
+            sys.stdout.write(
+                "Worsened schedule within the compiler noise for %d/%d case(s).\n"
+                % (noisy, totalCombinations))
+
         if newResults > 0:
             sys.stdout.write(
                 "Got first results for %d/%d case(s).\n" % (newResults, totalCombinations))
@@ -1172,10 +2400,127 @@ class Tester:
                 "Broken schedule for %d/%d case(s). Top results not updated.\n"
                 % (broken, totalCombinations))
 
+        if tpefCache is not None:
+            sys.stdout.write(tpefCache.summary())
+
+        if compiledSimulationCache is not None:
+            sys.stdout.write(compiledSimulationCache.summary())
+
     def updateStatisticsFiles(self):
         for testCase in self.testCases:
             testCase.updateStatisticsFiles()
 
+    def checkCompileRegressions(self):
+        """Reports the runs whose compilation got slower or bigger than the
+        limits allow compared to the recent runs in the history database."""
+        global failureFound
+
+        for testCase in self.testCases:
+            for arch in testCase.architectures:
+                stats = testCase.stats.get(arch)
+                baseline = testCase.compileBaselines.get(arch)
+                if stats is None or baseline is None or \
+                   stats.compileCpuTime is None:
+                    continue
+                for limit, value, reference, unit, scale, floor in (
+                        (compileTimeLimit, stats.compileCpuTime, baseline[0],
+                         "s", 1.0, 0.1),
+                        (compileMemoryLimit, stats.compileMaxRSS, baseline[1],
+                         "MB", 1024.0, 1024)):
+                    # Ignore the differences under the floor which are
+                    # mostly measurement noise.
+                    if limit is None or not reference or \
+                       value - reference < floor or \
+                       value <= reference * (1 + limit / 100.0):
+                        continue
+                    sys.stdout.write(
+                        "COMPILE REGRESSION %s %s: %.1f %s, recent runs %.1f %s "
+                        "(+%.1f%%)\n"
+                        % (testCase.title, arch, value / scale, unit,
+                           reference / scale, unit,
+                           (value - reference) / reference * 100))
+                    failureFound = True
+
+    def rerunWorsened(self):
+        """Reruns the worsened pairs to tell regressions from compiler noise.
+
+        Each worsened (test case, architecture) pair is rerun
+        rerunWorsenedCount times in parallel. The worsening is considered
+        noise if any of the runs reaches the reference cycle count, otherwise
+        it is reported against the median of the runs.
+        """
+        worsened = [(testCase, arch) for testCase in self.testCases
+                    for arch in testCase.architectures
+                    if arch in testCase.results and
+                    testCase.results[arch][1] is not None and
+                    testCase.results[arch][1] > 0]
+        if len(worsened) == 0:
+            return
+
+        worsenedCases = []
+        for testCase, arch in worsened:
+            if testCase not in worsenedCases:
+                worsenedCases.append(testCase)
+
+        get_backend_cache_dir()
+        get_run_scratch_dir()
+        for testCase in worsenedCases:
+            testCase.useTPEFCache = False
+            testCase.prepareParallelRuns()
+
+        # The program is written to the private scratch directory of each
+        # run, as the reruns of a pair would overwrite each other's program
+        # in the test directory.
+        jobs = []
+        for testCase, arch in worsened:
+            if testCase.seqProgFileBase is None:
+                continue
+            jobs += [((testCase, arch),
+                      (testCase, "runWithArchitecture",
+                       (arch, testCase.seqProgFileBase)))] * \
+                    rerunWorsenedCount
+
+        pool = forkContext.Pool(parallelJobs if parallelJobs > 1
+                                else multiprocessing.cpu_count())
+        runs = pool.map(run_stage_job, [job for pair, job in jobs])
+        pool.close()
+        pool.join()
+
+        samples = dict(((id(testCase), arch), [testCase.results[arch][0]])
+                       for testCase, arch in worsened)
+        for ((testCase, arch), job), run in zip(jobs, runs):
+            if run[0] and arch in run[3]:
+                samples[(id(testCase), arch)].append(run[3][arch][0])
+
+        for testCase, arch in worsened:
+            cycles = samples[(id(testCase), arch)]
+            reference = testCase.referenceCycleCount(arch)
+            median = statistics.median(cycles)
+            difference = median - reference
+            percentage = float(int((difference / reference)*1000))/10
+            if min(cycles) <= reference:
+                testCase.noisyResults.add(arch)
+                verdict = "within noise"
+            else:
+                testCase.results[arch] = (testCase.results[arch][0],
+                                          difference, percentage)
+                verdict = "regression (%.1f%%)" % percentage
+            if normalOutput:
+                sys.stdout.write(
+                    "%s %s: reference %.0f, median %.0f, range %.0f..%.0f "
+                    "over %d run(s): %s\n"
+                    % (testCase.title, arch, reference, median, min(cycles),
+                       max(cycles), len(cycles), verdict))
+
+        if not leaveDirty:
+            oldDir = os.getcwd()
+            for testCase in worsenedCases:
+                os.chdir(testCase.directory)
+                testCase.cleanupTestDirectory()
+                os.chdir(oldDir)
+        if normalOutput:
+            print()
+
     def initOperations(self):
         curdir = os.getcwd()
         os.chdir(operationDir)
@@ -1185,12 +2530,35 @@ class Tester:
     def runTests(self):
         global normalOutput
 
-        self.initOperations()
+        if incrementalState is None or incrementalState.operationsChanged():
+            self.initOperations()
 
         testsDone = 0
         allSuccessful = True
         self.archs = []
 
+        pool = None
+        if parallelJobs > 1 or pipelineWorkers is not None or batchSimulation:
+            # Create the shared directories before forking the workers.
+            get_backend_cache_dir()
+            get_run_scratch_dir()
+            pairs = []
+            for testCase in self.testCases:
+                pairs += testCase.prepareParallelRuns()
+            if batchSimulation:
+                pool = BatchSimulation(pairs, parallelJobs)
+                runs = pool.results()
+            elif pipelineWorkers is not None:
+                pool = ArchitecturePipeline(pairs, *pipelineWorkers)
+                runs = pool.results()
+            else:
+                pool = forkContext.Pool(parallelJobs)
+                runs = pool.imap(run_stage_job,
+                                 [(testCase, "runWithArchitecture",
+                                   (arch, seqProgFileBase,
+                                    os.path.abspath(testCase.directory)))
+                                  for testCase, arch, seqProgFileBase in pairs])
+
         for testCase in self.testCases:
 
             if normalOutput:
@@ -1199,9 +2567,15 @@ class Tester:
                 if len(testCase.description) > 0:
                     print(testCase.description)
 
-            allSuccessful = testCase.run() and allSuccessful
+            if pool is None:
+                allSuccessful = testCase.run() and allSuccessful
+            else:
+                allSuccessful = testCase.reportParallelRuns(runs) and \
+                                allSuccessful
 
             if stopTestingAfterFailingTest and not allSuccessful:
+                if pool is not None:
+                    pool.terminate()
                 return
 
             if normalOutput:
@@ -1220,6 +2594,28 @@ class Tester:
 
             testsDone += 1
 
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if rerunWorsenedCount > 0:
+            self.rerunWorsened()
+
+        if compileTimeLimit is not None or compileMemoryLimit is not None:
+            self.checkCompileRegressions()
+
+        if tpefCache is not None:
+            tpefCache.evict()
+
+        if compiledSimulationCache is not None:
+            compiledSimulationCache.evict()
+
+        if historyDatabase is not None:
+            historyDatabase.record(self.testCases)
+
+        if incrementalState is not None:
+            incrementalState.record(self.testCases)
+
         if normalOutput:
             self.printSummary()
 
@@ -1304,13 +2700,39 @@ class Tester:
 def cleanup_and_exit(retval):
     if backendCacheDir is not None:
         os.system("rm -fr " + backendCacheDir)
+    if runScratchDir is not None and not leaveDirty:
+        shutil.rmtree(runScratchDir, ignore_errors=True)
     sys.exit(retval)
 
 def main():
-    global failureFound, outputOnlyIfFailure
+    global failureFound, outputOnlyIfFailure, makeCommand, tpefCache, \
+           historyDatabase, incrementalState, compiledSimulationCache
     ParseCommandLine()
     if not (verboseOutput or veryVerboseOutput):
         makeCommand += " -s "
+    if tpefCacheDir is not None:
+        tpefCache = TPEFCache(tpefCacheDir, tpefCacheSizeMB)
+    if compiledSimulationCacheDir is not None:
+        compiledSimulationCache = CompiledSimulationCache(
+            compiledSimulationCacheDir, compiledSimulationCacheSizeMB)
+    if historyDatabaseFile is not None:
+        historyDatabase = HistoryDatabase(historyDatabaseFile)
+    elif historyQuery is not None or movingBaselineRuns is not None or \
+         compileTimeLimit is not None or compileMemoryLimit is not None:
+        print("--trend, --which-regressed, --moving-baseline and the compile "
+              "limits need --history-db.")
+        cleanup_and_exit(1)
+
+    if incrementalStateFile is not None:
+        incrementalState = IncrementalState(incrementalStateFile)
+
+    if historyQuery is not None:
+        query, args = historyQuery
+        if query == '--trend':
+            historyDatabase.printTrend(*args[:2])
+        else:
+            historyDatabase.printRegressions(*args[:2])
+        cleanup_and_exit(0)
     try:
         testCases = Tester()
     except TestBenchException as e:
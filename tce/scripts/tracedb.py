@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Copyright (c) 2002-2009 Tampere University.
+
+    This file is part of TTA-Based Codesign Environment (TCE).
+
+    Permission is hereby granted, free of charge, to any person obtaining a
+    copy of this software and associated documentation files (the "Software"),
+    to deal in the Software without restriction, including without limitation
+    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+    and/or sell copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+    THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+    DEALINGS IN THE SOFTWARE.
+"""
+"""
+NumPy access to the ttasim trace databases (see ExecutionTrace).
+
+The database is opened read-only. Tables are streamed in chunks with
+fetchmany() into NumPy arrays, and the aggregations are computed chunk
+by chunk, so that large traces need neither row-by-row Python code nor
+memory for the whole table. Text columns are converted to integer codes
+indexing the sorted distinct values of the column. The codes and the
+arrays that are reused by several queries are built on their first use
+and cached.
+
+Used as a script, prints a summary of the given trace database:
+
+tracedb.py myprogram.tpef.trace
+
+-*- mode: python -*-
+"""
+import sys
+import os.path
+import urllib.parse
+
+try:
+    import sqlite3
+except Exception:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except Exception:
+        sys.stderr.write("pysqlite for SQLite 3 library required\n")
+        sys.exit(1)
+
+try:
+    import numpy as np
+except ImportError:
+    sys.stderr.write("NumPy required\n")
+    raise
+
+TEXT = "text"
+BOOLEAN = "boolean"
+
+# The columns of the tables written by ExecutionTrace and their types,
+# either a NumPy type, TEXT or BOOLEAN.
+SCHEMA = {
+    "instruction_execution":
+        [("cycle", "i8"), ("address", "i8")],
+    "procedure_address_range":
+        [("first_address", "i8"), ("last_address", "i8"),
+         ("procedure_name", TEXT)],
+    "bus_activity":
+        [("cycle", "i8"), ("bus", TEXT), ("segment", TEXT),
+         ("squash", BOOLEAN), ("data_as_int", "i8"),
+         ("data_as_double", "f8")],
+    "concurrent_register_file_access":
+        [("register_file", TEXT), ("reads", "i8"), ("writes", "i8"),
+         ("count", "i8")],
+    "register_access":
+        [("register_file", TEXT), ("register_index", "i8"),
+         ("reads", "i8"), ("writes", "i8")],
+    "fu_operation_triggers":
+        [("function_unit", TEXT), ("operation", TEXT), ("count", "i8")],
+    "bus_write_counts":
+        [("bus", TEXT), ("writes", "i8")],
+    "socket_write_counts":
+        [("socket", TEXT), ("writes", "i8")],
+    "totals":
+        [("value_name", TEXT), ("integer_value", "i8")],
+}
+
+DEFAULT_CHUNK_ROWS = 1 << 16
+
+
+class TraceDB(object):
+    """Read-only access to a trace database as NumPy arrays."""
+
+    def __init__(self, trace_file, chunk_rows=DEFAULT_CHUNK_ROWS):
+        if not os.path.exists(trace_file):
+            raise Exception("%s not found" % trace_file)
+        self.trace_file = trace_file
+        self.chunk_rows = chunk_rows
+        self.conn = sqlite3.connect(
+            "file:%s?mode=ro" %
+            urllib.parse.quote(os.path.abspath(trace_file)), uri=True)
+        # Caches of the lazily built lookup structures.
+        self._tables = None
+        self._names = {}
+        self._name_arrays = {}
+        self._profile = None
+        self._procedures = None
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def tables(self):
+        """Returns the names of the trace tables present in the database."""
+        if self._tables is None:
+            cursor = self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table';")
+            self._tables = set(row[0] for row in cursor) & set(SCHEMA)
+        return sorted(self._tables)
+
+    def names(self, table, column):
+        """Returns the distinct values of a text column in code order.
+
+        The arrays of table() and chunks() refer to these by their index.
+        """
+        self._check_column(table, column)
+        key = (table, column)
+        if key not in self._names:
+            cursor = self.conn.execute(
+                "SELECT DISTINCT %s FROM %s WHERE %s IS NOT NULL;" %
+                (column, table, column))
+            self._names[key] = sorted(row[0] for row in cursor)
+            self._name_arrays[key] = np.array(self._names[key], dtype=str)
+        return self._names[key]
+
+    def chunks(self, table, columns=None, where=None, parameters=()):
+        """Yields the rows of a table as structured arrays of chunk_rows rows.
+
+        Text columns are given as codes indexing names(), boolean columns
+        as bool and missing REAL values as NaN.
+        """
+        columns, expressions = self._select(table, columns)
+        fetch_dtype = self._dtype(table, columns, fetch=True)
+        dtype = self._dtype(table, columns)
+        text_columns = [column for column in columns
+                        if self._type(table, column) == TEXT]
+        query = "SELECT %s FROM %s" % (", ".join(expressions), table)
+        if where is not None:
+            query += " WHERE " + where
+        cursor = self.conn.cursor()
+        cursor.arraysize = self.chunk_rows
+        try:
+            cursor.execute(query, parameters)
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                if not text_columns:
+                    yield np.array(rows, dtype=dtype)
+                    continue
+                fetched = np.array(rows, dtype=fetch_dtype)
+                chunk = np.empty(len(fetched), dtype=dtype)
+                for column in columns:
+                    if column in text_columns:
+                        chunk[column] = self._codes(
+                            table, column, fetched[column])
+                    else:
+                        chunk[column] = fetched[column]
+                yield chunk
+        finally:
+            cursor.close()
+
+    def table(self, table, columns=None, where=None, parameters=(),
+              decode=True):
+        """Returns the columns of a table as a dict of NumPy arrays.
+
+        With decode, text columns are string arrays, otherwise codes
+        indexing names().
+        """
+        columns = self._columns(table, columns)
+        parts = list(self.chunks(table, columns, where, parameters))
+        if parts:
+            data = np.concatenate(parts)
+        else:
+            data = np.empty(0, dtype=self._dtype(table, columns))
+        result = {}
+        for column in columns:
+            values = data[column]
+            if decode and self._type(table, column) == TEXT:
+                self.names(table, column)
+                names = np.append(self._name_arrays[(table, column)], "")
+                # Code -1 picks the empty string appended last.
+                values = names[values]
+            result[column] = values
+        return result
+
+    def totals(self):
+        """Returns the totals table as a dict (e.g. 'cycle_count')."""
+        if "totals" not in self.tables():
+            return {}
+        cursor = self.conn.execute(
+            "SELECT value_name, integer_value FROM totals;")
+        return dict(cursor.fetchall())
+
+    def cycle_count(self):
+        return self.totals().get("cycle_count")
+
+    def instruction_profile(self):
+        """Returns the executed addresses and their cycle counts.
+
+        Counted from instruction_execution. If that was not traced, read
+        from the '.profile' file saved with profile_data_saving.
+        """
+        if self._profile is not None:
+            return self._profile
+        counts = np.zeros(0, dtype=np.int64)
+        if "instruction_execution" in self.tables():
+            for chunk in self.chunks("instruction_execution", ["address"]):
+                chunk_counts = np.bincount(chunk["address"])
+                if len(chunk_counts) > len(counts):
+                    chunk_counts[:len(counts)] += counts
+                    counts = chunk_counts
+                else:
+                    counts[:len(chunk_counts)] += chunk_counts
+        addresses = np.flatnonzero(counts)
+        counts = counts[addresses]
+        profile_file = self.trace_file + ".profile"
+        if len(addresses) == 0 and os.path.exists(profile_file):
+            profile = np.loadtxt(profile_file, dtype=np.int64, ndmin=2)
+            if len(profile):
+                addresses, counts = profile[:, 0], profile[:, 1]
+        self._profile = (addresses, counts)
+        return self._profile
+
+    def procedure_ranges(self):
+        """Returns the procedure address ranges sorted by first address.
+
+        A tuple of the first addresses, the last addresses and the names.
+        """
+        if self._procedures is None:
+            if "procedure_address_range" in self.tables():
+                ranges = self.table("procedure_address_range")
+            else:
+                ranges = {"first_address": np.empty(0, dtype=np.int64),
+                          "last_address": np.empty(0, dtype=np.int64),
+                          "procedure_name": np.empty(0, dtype=str)}
+            order = np.argsort(ranges["first_address"], kind="stable")
+            self._procedures = (ranges["first_address"][order],
+                                ranges["last_address"][order],
+                                ranges["procedure_name"][order])
+        return self._procedures
+
+    def procedure_cycles(self):
+        """Returns the cycles spent in each procedure, most cycles first.
+
+        A list of (procedure name, cycles). The cycles at addresses not
+        covered by procedure_address_range are reported as None.
+        """
+        addresses, counts = self.instruction_profile()
+        first, last, names = self.procedure_ranges()
+        procedure = np.searchsorted(first, addresses, side="right") - 1
+        covered = procedure >= 0
+        covered[covered] = addresses[covered] <= last[procedure[covered]]
+        cycles = np.bincount(procedure[covered], weights=counts[covered],
+                             minlength=len(names)).astype(np.int64)
+        result = [(str(name), int(count))
+                  for name, count in zip(names, cycles) if count > 0]
+        result.sort(key=lambda item: item[1], reverse=True)
+        unattributed = int(counts[~covered].sum())
+        if unattributed > 0:
+            result.append((None, unattributed))
+        return result
+
+    def bus_utilization(self, window=1000):
+        """Returns the utilization of each bus per window of cycles.
+
+        Computed from the bus_activity table, counting the cycles in which
+        a bus carried a non-squashed move. A tuple of the bus names, the
+        first cycles of the windows and an array of ratios indexed by
+        [bus, window].
+        """
+        if "bus_activity" not in self.tables():
+            return [], np.empty(0, dtype=np.int64), np.empty((0, 0))
+        buses = self.names("bus_activity", "bus")
+        cycles = self.cycle_count()
+        if cycles is None:
+            cycles = self._max("bus_activity", "cycle") + 1
+        windows = max(1, -(-cycles // window))
+        counts = np.zeros(len(buses) * windows, dtype=np.int64)
+        # Segments of a bus carry the same move, count the first one only.
+        segments = self.names("bus_activity", "segment")
+        first_segment = np.zeros(len(buses), dtype=np.int64)
+        for bus, segment in self.conn.execute(
+                "SELECT bus, MIN(segment) FROM bus_activity GROUP BY bus;"):
+            first_segment[buses.index(bus)] = segments.index(segment)
+        for chunk in self.chunks("bus_activity", ["cycle", "bus", "segment"],
+                                 "squash <> 'TRUE'"):
+            chunk = chunk[chunk["segment"] == first_segment[chunk["bus"]]]
+            cell = (chunk["bus"] * windows +
+                    np.minimum(chunk["cycle"] // window, windows - 1))
+            counts += np.bincount(cell, minlength=len(counts))
+        starts = np.arange(windows, dtype=np.int64) * window
+        lengths = np.minimum(starts + window, max(cycles, 1)) - starts
+        return buses, starts, counts.reshape(len(buses), windows) / lengths
+
+    def bus_utilization_histogram(self, window=1000, bins=10):
+        """Returns per bus histograms of the window utilizations.
+
+        A tuple of the bus names, the bin edges over [0, 1] and an array
+        of window counts indexed by [bus, bin].
+        """
+        buses, starts, ratios = self.bus_utilization(window)
+        edges = np.linspace(0.0, 1.0, bins + 1)
+        histogram = np.array(
+            [np.histogram(ratio, edges)[0] for ratio in ratios],
+            dtype=np.int64).reshape(len(buses), bins)
+        return buses, edges, histogram
+
+    def bus_write_utilization(self):
+        """Returns the fraction of cycles each bus was written (bus -> ratio).
+
+        Computed from the bus_write_counts saved with utilization_data_saving,
+        which does not need a bus_activity trace.
+        """
+        cycles = self.cycle_count()
+        if not cycles or "bus_write_counts" not in self.tables():
+            return {}
+        writes = self.table("bus_write_counts")
+        return dict((str(bus), float(count) / cycles)
+                    for bus, count in zip(writes["bus"], writes["writes"]))
+
+    def register_file_pressure(self):
+        """Returns the distribution of concurrent accesses of each RF.
+
+        A dict register file -> dict of 'reads', 'writes' and 'cycles'
+        arrays telling in how many cycles the given count of reads and
+        writes happened, and 'mean_accesses', the average count of
+        accesses per cycle over the simulation. Saved by ttasim with
+        rf_tracking.
+        """
+        if "concurrent_register_file_access" not in self.tables():
+            return {}
+        access = self.table("concurrent_register_file_access",
+                            decode=False)
+        files = self.names("concurrent_register_file_access",
+                           "register_file")
+        cycles = self.cycle_count()
+        pressure = {}
+        for code, name in enumerate(files):
+            rows = access["register_file"] == code
+            reads = access["reads"][rows]
+            writes = access["writes"][rows]
+            counts = access["count"][rows]
+            accesses = int(((reads + writes) * counts).sum())
+            pressure[name] = {
+                "reads": reads,
+                "writes": writes,
+                "cycles": counts,
+                "mean_accesses":
+                    float(accesses) / cycles if cycles else None,
+            }
+        return pressure
+
+    def register_accesses(self, register_file):
+        """Returns the register indices and their read and write counts."""
+        access = self.table(
+            "register_access", ["register_index", "reads", "writes"],
+            "register_file = ?", (register_file,))
+        order = np.argsort(access["register_index"], kind="stable")
+        return (access["register_index"][order], access["reads"][order],
+                access["writes"][order])
+
+    def _max(self, table, column):
+        self._check_column(table, column)
+        value = self.conn.execute(
+            "SELECT MAX(%s) FROM %s;" % (column, table)).fetchone()[0]
+        return 0 if value is None else value
+
+    def _check_column(self, table, column):
+        if table not in self.tables():
+            raise Exception("No table %s in %s" % (table, self.trace_file))
+        if column not in dict(SCHEMA[table]):
+            raise Exception("No column %s in table %s" % (column, table))
+
+    def _columns(self, table, columns):
+        if table not in self.tables():
+            raise Exception("No table %s in %s" % (table, self.trace_file))
+        if columns is None:
+            return [column for column, column_type in SCHEMA[table]]
+        for column in columns:
+            self._check_column(table, column)
+        return list(columns)
+
+    def _type(self, table, column):
+        return dict(SCHEMA[table])[column]
+
+    def _dtype(self, table, columns, fetch=False):
+        """Returns the structured dtype of the columns.
+
+        With fetch, the dtype of the fetched rows, which have the text
+        columns as Python strings instead of codes.
+        """
+        types = {TEXT: "O" if fetch else "i8", BOOLEAN: "?"}
+        return [(column, types.get(self._type(table, column),
+                                   self._type(table, column)))
+                for column in columns]
+
+    def _codes(self, table, column, values):
+        """Returns the codes of text values, -1 for values not in names()."""
+        self.names(table, column)
+        names = self._name_arrays[(table, column)]
+        if len(names) == 0:
+            return np.full(len(values), -1, dtype=np.int64)
+        values = values.astype(str)
+        codes = np.minimum(np.searchsorted(names, values), len(names) - 1)
+        return np.where(names[codes] == values, codes, -1)
+
+    def _select(self, table, columns):
+        """Returns the columns and their SELECT expressions."""
+        columns = self._columns(table, columns)
+        expressions = []
+        for column in columns:
+            column_type = self._type(table, column)
+            if column_type == BOOLEAN:
+                expressions.append("%s = 'TRUE'" % column)
+            elif column_type == "i8":
+                expressions.append("IFNULL(%s, 0)" % column)
+            else:
+                expressions.append(column)
+        return columns, expressions
+
+def print_summary(trace):
+    cycles = trace.cycle_count()
+    print("cycles: %s" % cycles)
+
+    procedures = trace.procedure_cycles()
+    if procedures:
+        print("\n%-40s %12s" % ("procedure", "cycles"))
+        for name, count in procedures:
+            print("%-40s %12d" % (name or "(unknown)", count))
+
+    utilization = trace.bus_write_utilization()
+    if not utilization:
+        buses, starts, ratios = trace.bus_utilization()
+        utilization = dict(zip(buses, ratios.mean(axis=1)))
+    if utilization:
+        print("\n%-40s %12s" % ("bus", "utilization"))
+        for bus in sorted(utilization):
+            print("%-40s %11.1f%%" % (bus, 100.0 * utilization[bus]))
+
+    pressure = trace.register_file_pressure()
+    if pressure:
+        print("\n%-40s %12s" % ("register file", "accesses/cycle"))
+        for name in sorted(pressure):
+            mean = pressure[name]["mean_accesses"]
+            print("%-40s %12s" %
+                  (name, "-" if mean is None else "%.2f" % mean))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: %s TRACEDB\n" % sys.argv[0])
+        sys.exit(1)
+    with TraceDB(sys.argv[1]) as trace:
+        print_summary(trace)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Test module for tracedb"""
+import contextlib
+import io
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from tracedb import TraceDB, print_summary
+
+EXECUTION_TRACE_SOURCE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..", "src", "applibs", "TraceDB", "ExecutionTrace.cc")
+
+
+def create_trace(file_name):
+    """Creates an empty trace database with the tables of ExecutionTrace."""
+    with open(EXECUTION_TRACE_SOURCE) as source:
+        definitions = re.findall(
+            r'const std::string CQ_\w+ =\s*((?:"[^"]*"\s*)+);', source.read())
+    conn = sqlite3.connect(file_name)
+    for definition in definitions:
+        conn.execute("".join(re.findall(r'"([^"]*)"', definition)))
+    return conn
+
+
+class TestTraceDB(unittest.TestCase):
+    """Aggregations over trace databases"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.trace_file = os.path.join(self.directory, "test.tpef.trace")
+        self.conn = create_trace(self.trace_file)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def open_trace(self):
+        self.conn.commit()
+        return TraceDB(self.trace_file, chunk_rows=7)
+
+    def test_summary_of_empty_tables(self):
+        """Tables that ttasim created but did not fill are empty results"""
+        self.conn.executemany(
+            "INSERT INTO instruction_execution VALUES(?, ?)",
+            [(cycle, cycle % 5) for cycle in range(20)])
+        self.conn.execute("INSERT INTO totals VALUES('cycle_count', 20)")
+        with self.open_trace() as trace:
+            self.assertEqual(trace.procedure_cycles(), [(None, 20)])
+            buses, starts, ratios = trace.bus_utilization(10)
+            self.assertEqual(buses, [])
+            self.assertEqual(ratios.shape, (0, 2))
+            self.assertEqual(trace.register_file_pressure(), {})
+            self.assertEqual(len(trace.table("bus_activity")["bus"]), 0)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                print_summary(trace)
+            self.assertIn("cycles: 20", output.getvalue())
+
+    def test_many_procedures(self):
+        """Procedure attribution does not depend on the procedure count"""
+        procedures = 2000
+        self.conn.executemany(
+            "INSERT INTO procedure_address_range VALUES(?, ?, ?)",
+            [(2 * index, 2 * index, "proc%d" % index)
+             for index in range(procedures)])
+        self.conn.executemany(
+            "INSERT INTO instruction_execution VALUES(?, ?)",
+            [(cycle, cycle % (2 * procedures)) for cycle in range(6000)])
+        with self.open_trace() as trace:
+            cycles = dict(trace.procedure_cycles())
+            self.assertEqual(len(cycles), procedures + 1)
+            self.assertEqual(cycles["proc0"], 2)
+            self.assertEqual(cycles["proc1999"], 1)
+            self.assertEqual(cycles[None], 3000)
+
+    def test_bus_utilization(self):
+        """Squashed moves and extra segments are not counted"""
+        self.conn.executemany(
+            "INSERT INTO bus_activity(cycle, bus, segment, squash) "
+            "VALUES(?, ?, ?, ?)",
+            [(0, "B1", "seg0", "FALSE"), (0, "B1", "seg1", "FALSE"),
+             (1, "B1", "seg0", "TRUE"), (2, "B2", "seg0", "FALSE"),
+             (3, "B2", "seg0", "FALSE")])
+        self.conn.execute("INSERT INTO totals VALUES('cycle_count', 4)")
+        with self.open_trace() as trace:
+            buses, starts, ratios = trace.bus_utilization(2)
+            self.assertEqual(buses, ["B1", "B2"])
+            self.assertEqual(list(starts), [0, 2])
+            self.assertEqual(ratios.tolist(), [[0.5, 0.0], [0.0, 1.0]])
+            self.assertEqual(list(trace.table("bus_activity")["bus"]),
+                             ["B1", "B1", "B1", "B2", "B2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -215,3 +215,14 @@ CompiledSimCompiler::compileToSO(
     return compileFile(path, COMPILED_SIM_SO_FLAGS + flags, ".so", verbose);
 }
 
+/**
+ * Returns the compiler and the global compile flags in use.
+ *
+ * The compiled engine depends on these in addition to the generated code.
+ *
+ * @return The compiler command and the global compile flags.
+ */
+std::string
+CompiledSimCompiler::configuration() const {
+    return compiler_ + " " + globalCompileFlags_;
+}
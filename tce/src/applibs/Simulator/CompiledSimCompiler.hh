@@ -58,6 +58,8 @@ public:
         const std::string& path,
         const std::string& flags = "",
         bool verbose = false) const;
+
+    std::string configuration() const;
     
     /// cpp flags used for compiled simulation
     static const char* COMPILED_SIM_CPP_FLAGS;
@@ -32,6 +32,14 @@
  */
 
 #include <cstdlib>
+#include <cstdio>
+#include <fstream>
+#include <sstream>
+#include <iterator>
+#include <functional>
+#include <algorithm>
+#include <vector>
+#include <utime.h>
 
 #include "SimulatorFrontend.hh"
 #include "CompiledSimController.hh"
@@ -49,6 +57,7 @@
 #include "SimulationEventHandler.hh"
 #include "Conversion.hh"
 #include "Machine.hh"
+#include "Environment.hh"
 
 using std::endl;
 using namespace TTAMachine;
@@ -70,7 +79,7 @@ CompiledSimController::CompiledSimController(
     const TTAProgram::Program& program, bool leaveDirty) : 
     TTASimulationController(frontend, machine, program),
     pluginTools_(true, false), compiledSimulationPath_(""), 
-    leaveDirty_(leaveDirty) {
+    leaveDirty_(leaveDirty), cachedEngine_(false) {
 
 #ifdef DEBUG_COMPILED_SIMULATION
     leaveDirty_ = true;
@@ -238,6 +247,11 @@ CompiledSimController::runUntil(UIntWord address) {
  * Resets the simulation so it can be started from the beginning.
  *
  * Resets everything to initial values (program counter, clock cycles etc.)
+ *
+ * In case the environment variable TTASIM_COMPILED_SIM_CACHE names a
+ * directory, the statically compiled engines are stored there and reused by
+ * the later simulations that generate identical code, that is, simulate the
+ * same program on the same machine with the same simulation options.
  */
 void 
 CompiledSimController::reset() {
@@ -248,7 +262,32 @@ CompiledSimController::reset() {
     
     deleteGeneratedFiles();
         
-    compiledSimulationPath_ = FileSystem::createTempDirectory();
+    cachedEngine_ = false;
+
+    // The engine is generated next to the cached engines, so it can be
+    // stored to the cache by renaming.
+    std::string cacheDirectory =
+        Environment::environmentVariable("TTASIM_COMPILED_SIM_CACHE");
+    if (cacheDirectory != "" && frontend_.staticCompilation() &&
+        FileSystem::createDirectory(cacheDirectory)) {
+        cacheDirectory = FileSystem::absolutePathOf(cacheDirectory);
+        // FileSystem::createTempDirectory() takes the name from rand()
+        // seeded with the current time, so the simulators started within
+        // the same second would generate to the same directory. mkdtemp()
+        // creates a unique one atomically.
+        std::string pattern = cacheDirectory +
+            FileSystem::DIRECTORY_SEPARATOR + "tmp_engine_XXXXXX";
+        std::vector<char> tempPath(pattern.begin(), pattern.end());
+        tempPath.push_back('\0');
+        if (mkdtemp(&tempPath[0]) != NULL) {
+            compiledSimulationPath_ = &tempPath[0];
+        } else {
+            compiledSimulationPath_ = "";
+        }
+    } else {
+        cacheDirectory = "";
+        compiledSimulationPath_ = FileSystem::createTempDirectory();
+    }
     if (compiledSimulationPath_ == "") {
         Application::logStream() 
             << "Cannot create temporary path "
@@ -274,14 +313,35 @@ CompiledSimController::reset() {
     procedureBBRelations_ = generator.procedureBBRelations();
 
     CompiledSimCompiler compiler;
+
+    std::string cachedPath = "";
+    if (cacheDirectory != "") {
+        cachedPath = cachedEnginePath(cacheDirectory, compiler);
+    }
     
-    // Compile everything when using static compiled simulation
-    if (frontend_.staticCompilation()) {
+    if (cachedPath != "" && isCachedEngine(cachedPath)) {
+        // The generated code only served for identifying the engine.
+        FileSystem::removeFileOrDirectory(compiledSimulationPath_);
+        compiledSimulationPath_ = cachedPath;
+        cachedEngine_ = true;
+        // Keeps the recently used engines for the cache eviction.
+        utime(cachedPath.c_str(), NULL);
+    } else if (frontend_.staticCompilation()) {
+        // Compile everything when using static compiled simulation
         if (compiler.compileDirectory(compiledSimulationPath_, "", false) 
             != 0) {
             Application::logStream() << "Compilation aborted." << endl;
             return;
         }
+        // Another simulator process might have stored the same engine
+        // meanwhile, in which case the renaming fails and the engine is
+        // used from the temporary path.
+        if (cachedPath != "" &&
+            std::rename(
+                compiledSimulationPath_.c_str(), cachedPath.c_str()) == 0) {
+            compiledSimulationPath_ = cachedPath;
+            cachedEngine_ = true;
+        }
     } else { // Compile main engine file
         compiler.compileToSO(compiledSimulationPath_ 
             + FileSystem::DIRECTORY_SEPARATOR + "CompiledSimulationEngine.cc");
@@ -362,10 +422,12 @@ CompiledSimController::compiledSimulation() {
 
 /**
  * Will delete all generated code files if leaveDirty_ is not set
+ *
+ * The engines stored to the engine cache are never deleted.
  */
 void 
 CompiledSimController::deleteGeneratedFiles() {
-    if (leaveDirty_) {
+    if (leaveDirty_ || cachedEngine_) {
         return;
     }
     
@@ -473,3 +535,78 @@ CompiledSimController::prepareToStop(StopReason reason) {
     TTASimulationController::prepareToStop(reason);
     compiledSimulation()->requestToStop();
 }
+
+/**
+ * Returns the contents of the given file.
+ */
+static std::string
+fileContents(const std::string& fileName) {
+    std::ifstream file(fileName.c_str());
+    return std::string(
+        (std::istreambuf_iterator<char>(file)),
+        std::istreambuf_iterator<char>());
+}
+
+/**
+ * Returns the path of the cached engine for the generated code.
+ *
+ * The engine is identified by a hash of the generated code files and the
+ * compiler configuration. The code is generated from the machine and the
+ * program, so it changes with them, with the simulation options and with
+ * the simulator version.
+ *
+ * @param cacheDirectory The engine cache directory.
+ * @param compiler The compiler the engine is compiled with.
+ * @return The path of the engine in the cache directory.
+ */
+std::string
+CompiledSimController::cachedEnginePath(
+    const std::string& cacheDirectory,
+    const CompiledSimCompiler& compiler) const {
+
+    std::vector<std::string> files =
+        FileSystem::directoryContents(compiledSimulationPath_, false);
+    std::sort(files.begin(), files.end());
+
+    std::ostringstream key;
+    key << compiler.configuration();
+    for (std::size_t i = 0; i < files.size(); ++i) {
+        key << '\0' << FileSystem::fileOfPath(files.at(i)) << '\0'
+            << fileContents(files.at(i));
+    }
+
+    std::ostringstream name;
+    name << std::hex << std::hash<std::string>()(key.str());
+    return cacheDirectory + FileSystem::DIRECTORY_SEPARATOR + "engine_" +
+        name.str();
+}
+
+/**
+ * Checks if the cached engine is complete and compiled from the same code.
+ *
+ * The generated code files are compared, so a hash collision cannot load
+ * a wrong engine.
+ *
+ * @param cachedPath The path of the cached engine.
+ * @return True, if the cached engine can be used.
+ */
+bool
+CompiledSimController::isCachedEngine(const std::string& cachedPath) const {
+    if (!FileSystem::fileExists(
+            cachedPath + FileSystem::DIRECTORY_SEPARATOR +
+            "CompiledSimulationEngine.so")) {
+        return false;
+    }
+
+    std::vector<std::string> files =
+        FileSystem::directoryContents(compiledSimulationPath_, false);
+    for (std::size_t i = 0; i < files.size(); ++i) {
+        std::string cachedFile = cachedPath + FileSystem::DIRECTORY_SEPARATOR +
+            FileSystem::fileOfPath(files.at(i));
+        if (!FileSystem::fileExists(cachedFile) ||
+            fileContents(files.at(i)) != fileContents(cachedFile)) {
+            return false;
+        }
+    }
+    return true;
+}
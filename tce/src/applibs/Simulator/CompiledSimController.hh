@@ -40,6 +40,7 @@
 #include "CompiledSimCodeGenerator.hh"
 
 class CompiledSimulation;
+class CompiledSimCompiler;
 struct ProcedureBBRelations;
 
 namespace TTAProgram {
@@ -109,6 +110,11 @@ private:
     CompiledSimController(const CompiledSimController&);
     /// Assignment not allowed.
     CompiledSimController& operator=(const CompiledSimController&);
+
+    std::string cachedEnginePath(
+        const std::string& cacheDirectory,
+        const CompiledSimCompiler& compiler) const;
+    bool isCachedEngine(const std::string& cachedPath) const;
       
     /// Used for loading the compiled simulation plugin
     PluginTools pluginTools_;    
@@ -121,6 +127,8 @@ private:
     
     /// True, if the simulation should leave all the generated code files
     bool leaveDirty_;
+    /// True, if the generated files are in the engine cache and must be kept
+    bool cachedEngine_;
     
     /// A map containing the basic blocks' start..end pairs
     CompiledSimCodeGenerator::AddressMap basicBlocks_;
@@ -1115,7 +1115,7 @@ public:
 
 /**
  * Implementation of "info stats". The following sub-commands are supported:
- * "executed_operations", "register_reads" and "register_writes"
+ * "executed_operations", "register_reads", "register_writes" and "json".
  */
 class InfoStatsCommand : public SimControlLanguageSubCommand {
 public:
@@ -1160,66 +1160,22 @@ public:
                    
         const TTAMachine::Machine& mach = 
             parent().simulatorFrontend().machine();
-        
-        ClockCycleCount totalOperationExecutions = 0;
-        ClockCycleCount totalRegisterReads = 0;
-        ClockCycleCount totalRegisterWrites = 0;        
-
-        const TTAMachine::Machine::FunctionUnitNavigator& fuNav =
-            mach.functionUnitNavigator();
-
-        const TTAMachine::Machine::RegisterFileNavigator& rfNav =
-                mach.registerFileNavigator();
 
         if (command == "executed_operations") {
-            for (int i = 0; i <= fuNav.count(); ++i) {
-                TTAMachine::FunctionUnit* fu = NULL;
-                if (i < fuNav.count())
-                    fu = fuNav.item(i);
-                else
-                    fu = mach.controlUnit();
-                assert(fu != NULL);
-
-                for (int j = 0; j < fu->operationCount(); ++j) {
-                    const TTAMachine::HWOperation* op = fu->operation(j);
-                    assert (op != NULL);
-                    totalOperationExecutions += stats.operationExecutions(
-                    fu->name(), StringTools::stringToUpper(op->name()));
-                }
-            }
             parent().interpreter()->setResult(
-                   static_cast<double>(totalOperationExecutions));
+                static_cast<double>(operationExecutions(stats, mach)));
             return true;
         } else if (command == "register_reads") {
-            for (int i = 0; i < rfNav.count(); ++i) {
-                TTAMachine::RegisterFile* rf = rfNav.item(i);
-                assert(rf != NULL);
-
-                int lastReg = 0;
-                lastReg = rf->numberOfRegisters() - 1;
-                for (int reg = 0; reg <= lastReg; ++reg) {
-                    totalRegisterReads += stats.registerReads(rf->name(), reg);
-                }
-            }
             parent().interpreter()->setResult(
-                   static_cast<double>(totalRegisterReads));
+                static_cast<double>(registerAccesses(stats, mach, false)));
             return true;
-            
         } else if (command == "register_writes") {
-            for (int i = 0; i < rfNav.count(); ++i) {
-                TTAMachine::RegisterFile* rf = rfNav.item(i);
-                assert(rf != NULL);
-
-                int lastReg = 0;
-                lastReg = rf->numberOfRegisters() - 1;
-                for (int reg = 0; reg <= lastReg; ++reg) {
-                    totalRegisterWrites += stats.registerWrites(rf->name(), reg);
-                }
-            }
             parent().interpreter()->setResult(
-                   static_cast<double>(totalRegisterWrites));
+                static_cast<double>(registerAccesses(stats, mach, true)));
+            return true;
+        } else if (command == "json") {
+            parent().interpreter()->setResult(json(stats, mach));
             return true;
-            
         } else {
             parent().interpreter()->setError(
                 SimulatorToolbox::textGenerator().text(
@@ -1227,6 +1183,100 @@ public:
             return false;
         }
     }
+
+private:
+    /**
+     * Returns the total count of executed operations, including the ones
+     * of the control unit.
+     */
+    ClockCycleCount operationExecutions(
+        const UtilizationStats& stats, const TTAMachine::Machine& mach) {
+
+        ClockCycleCount total = 0;
+        const TTAMachine::Machine::FunctionUnitNavigator& fuNav =
+            mach.functionUnitNavigator();
+        for (int i = 0; i <= fuNav.count(); ++i) {
+            TTAMachine::FunctionUnit* fu = NULL;
+            if (i < fuNav.count())
+                fu = fuNav.item(i);
+            else
+                fu = mach.controlUnit();
+            assert(fu != NULL);
+
+            for (int j = 0; j < fu->operationCount(); ++j) {
+                const TTAMachine::HWOperation* op = fu->operation(j);
+                assert (op != NULL);
+                total += stats.operationExecutions(
+                    fu->name(), StringTools::stringToUpper(op->name()));
+            }
+        }
+        return total;
+    }
+
+    /**
+     * Returns the total count of register writes or reads.
+     */
+    ClockCycleCount registerAccesses(
+        const UtilizationStats& stats, const TTAMachine::Machine& mach,
+        bool writes) {
+
+        ClockCycleCount total = 0;
+        const TTAMachine::Machine::RegisterFileNavigator& rfNav =
+            mach.registerFileNavigator();
+        for (int i = 0; i < rfNav.count(); ++i) {
+            TTAMachine::RegisterFile* rf = rfNav.item(i);
+            assert(rf != NULL);
+
+            for (int reg = 0; reg < rf->numberOfRegisters(); ++reg) {
+                if (writes) {
+                    total += stats.registerWrites(rf->name(), reg);
+                } else {
+                    total += stats.registerReads(rf->name(), reg);
+                }
+            }
+        }
+        return total;
+    }
+
+    /**
+     * Returns all the statistics as a single JSON object.
+     *
+     * In addition to the totals, the object contains the trigger counts of
+     * each function unit and the write counts of each bus, from which
+     * their utilizations can be computed against the cycle count.
+     */
+    std::string json(
+        const UtilizationStats& stats, const TTAMachine::Machine& mach) {
+
+        std::ostringstream result;
+        result
+            << "{\"cycles\": "
+            << parent().simulatorFrontend().cycleCount()
+            << ", \"executed_operations\": "
+            << operationExecutions(stats, mach)
+            << ", \"register_reads\": "
+            << registerAccesses(stats, mach, false)
+            << ", \"register_writes\": "
+            << registerAccesses(stats, mach, true)
+            << ", \"fu_triggers\": {";
+
+        const TTAMachine::Machine::FunctionUnitNavigator& fuNav =
+            mach.functionUnitNavigator();
+        for (int i = 0; i < fuNav.count(); ++i) {
+            result << (i > 0 ? ", " : "") << "\"" << fuNav.item(i)->name()
+                   << "\": " << stats.triggerCount(fuNav.item(i)->name());
+        }
+
+        result << "}, \"bus_writes\": {";
+        const TTAMachine::Machine::BusNavigator& busNav =
+            mach.busNavigator();
+        for (int i = 0; i < busNav.count(); ++i) {
+            result << (i > 0 ? ", " : "") << "\"" << busNav.item(i)->name()
+                   << "\": " << stats.busWrites(busNav.item(i)->name());
+        }
+        result << "}}";
+        return result.str();
+    }
 };
 
 
@@ -335,7 +335,13 @@ SimulatorTextGenerator::SimulatorTextGenerator() {
                 
         "\tstats register_writes\n\n"
                 
-        "Prints the total count of register writes.");
+        "Prints the total count of register writes.\n\n"
+
+        "\tstats json\n\n"
+
+        "Prints the cycle count, the totals above and the trigger counts of "
+        "each function unit and the write counts of each bus as a single "
+        "JSON object.");
         
     addText(
         Texts::TXT_INTERP_HELP_BREAK,
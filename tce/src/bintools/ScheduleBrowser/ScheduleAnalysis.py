@@ -0,0 +1,115 @@
+"""Schedule quality analysis shared by the browser and ScheduleAnalyzer.
+
+The functions work on the dictionaries returned by
+ScheduleData.browser_data(). Loop carried dependences are ignored, as
+they do not constrain the moves within the dumped piece of code.
+"""
+
+from collections import defaultdict
+
+def node_cycles(schedule):
+    """Returns the cycles of the scheduled nodes (node id -> cycle)."""
+    cycles = {}
+    for cycle, slots in schedule.iteritems():
+        for node in slots.itervalues():
+            cycles[node] = cycle
+    return cycles
+
+def schedule_length(schedule):
+    """Returns the number of cycles in the schedule."""
+    if not schedule:
+        return 0
+    # Schedule cycles are zero-based
+    return max(schedule.iterkeys()) + 1
+
+def earliest_cycle(incoming_deps, cycles):
+    """Find out the earliest cycle when the move could
+    be scheduled based on dependences only."""
+
+    earliest_cycle = 0
+
+    for src_node, dep_kind, latency, loop in incoming_deps:
+        if not loop and cycles.has_key(src_node):
+            earliest_cycle = max(earliest_cycle,
+                                 cycles[src_node] + int(latency))
+
+    return earliest_cycle
+
+def resource_constrained_nodes(schedule, incoming_dependences, cycles=None):
+    """Returns the nodes scheduled later than their dependences require.
+
+    These moves could potentially be scheduled earlier if more resources
+    were available.
+    """
+    if cycles is None:
+        cycles = node_cycles(schedule)
+    return [node for node, cycle in cycles.iteritems()
+            if earliest_cycle(incoming_dependences.get(node, ()),
+                              cycles) < cycle]
+
+def critical_path_length(schedule, incoming_dependences,
+                         outgoing_dependences, cycles=None):
+    """Returns the length in cycles of the longest dependence chain.
+
+    Only the dependences between scheduled nodes are taken into account,
+    so this is the schedule length that unlimited resources would give.
+    """
+    if cycles is None:
+        cycles = node_cycles(schedule)
+    if not cycles:
+        return 0
+
+    # Longest path in topological order of the non-loop dependences.
+    predecessors = {}
+    ready = []
+    for node in cycles:
+        count = 0
+        for src_node, dep_kind, latency, loop in \
+                incoming_dependences.get(node, ()):
+            if not loop and cycles.has_key(src_node):
+                count += 1
+        predecessors[node] = count
+        if count == 0:
+            ready.append(node)
+
+    start = dict.fromkeys(cycles, 0)
+    while ready:
+        node = ready.pop()
+        for dst_node, dep_kind, latency, loop in \
+                outgoing_dependences.get(node, ()):
+            if loop or not cycles.has_key(dst_node):
+                continue
+            start[dst_node] = max(start[dst_node], start[node] + int(latency))
+            predecessors[dst_node] -= 1
+            if predecessors[dst_node] == 0:
+                ready.append(dst_node)
+
+    return max(start.itervalues()) + 1
+
+def bus_occupancy(schedule, length=None):
+    """Returns the fraction of the cycles each slot is used (slot -> ratio)."""
+    if length is None:
+        length = schedule_length(schedule)
+    moves = defaultdict(int)
+    for slots in schedule.itervalues():
+        for slot in slots:
+            moves[slot] += 1
+    return dict((slot, float(count) / length)
+                for slot, count in moves.iteritems())
+
+def analyze(schedule, incoming_dependences, outgoing_dependences):
+    """Returns the quality figures of one schedule as a dictionary."""
+    cycles = node_cycles(schedule)
+    length = schedule_length(schedule)
+    critical_path = critical_path_length(schedule, incoming_dependences,
+                                         outgoing_dependences, cycles)
+    return {
+        "moves": len(cycles),
+        "schedule_length": length,
+        "critical_path_length": critical_path,
+        "slack": length - critical_path,
+        "resource_constrained_moves":
+            len(resource_constrained_nodes(schedule, incoming_dependences,
+                                           cycles)),
+        "bus_occupancy": bus_occupancy(schedule, length),
+        }
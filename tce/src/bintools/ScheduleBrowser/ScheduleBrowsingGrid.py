@@ -3,6 +3,7 @@ import re
 import  wx.grid as gridlib
 from collections import defaultdict
 from Utils import dependence_label, constant_factory
+from ScheduleAnalysis import resource_constrained_nodes
 
 class DependenceSummaryFrame(wx.Frame):
 
@@ -37,6 +38,97 @@ class DependenceSummaryFrame(wx.Frame):
         self.Fit()
 
 
+class ScheduleTable(gridlib.PyGridTableBase):
+    """Virtual table serving the cells of a schedule on demand.
+
+    Only the cells the grid draws are ever asked for, so opening a huge
+    schedule does not cost a wx call per cell. The highlighted cells are
+    kept in a sparse map from (row, column) to colour.
+    """
+
+    def __init__(self, rows, column_to_label_map, cell_to_node_map, labels):
+        gridlib.PyGridTableBase.__init__(self)
+        self.rows_ = rows
+        self.column_to_label_map_ = column_to_label_map
+        self.cell_to_node_map_ = cell_to_node_map
+        self.labels_ = labels
+        self.highlights_ = {}
+        # Number of highlighted cells on each row, for the row labels.
+        self.highlighted_rows_ = defaultdict(int)
+        # One shared attribute per colour.
+        self.attributes_ = {}
+
+    def GetNumberRows(self):
+        return self.rows_
+
+    def GetNumberCols(self):
+        return len(self.column_to_label_map_)
+
+    def IsEmptyCell(self, row, col):
+        return not self.cell_to_node_map_.has_key((row, col))
+
+    def GetValue(self, row, col):
+        node = self.cell_to_node_map_.get((row, col))
+        if node is None:
+            return "..."
+        return self.labels_[node]
+
+    def SetValue(self, row, col, value):
+        pass
+
+    def GetColLabelValue(self, col):
+        return "%s" % self.column_to_label_map_[col]
+
+    def GetRowLabelValue(self, row):
+        if self.highlighted_rows_.get(row):
+            return "%s ==>" % row
+        return "%s" % row
+
+    def GetAttr(self, row, col, kind):
+        colour = self.highlights_.get((row, col))
+        if colour is None:
+            return None
+        if not self.attributes_.has_key(colour):
+            attr = gridlib.GridCellAttr()
+            attr.SetBackgroundColour(colour)
+            self.attributes_[colour] = attr
+        attr = self.attributes_[colour]
+        attr.IncRef()
+        return attr
+
+    def highlight(self, row, col, colour):
+        if not self.highlights_.has_key((row, col)):
+            self.highlighted_rows_[row] += 1
+        self.highlights_[(row, col)] = colour
+
+    def unhighlight(self, row, col):
+        if self.highlights_.has_key((row, col)):
+            del self.highlights_[(row, col)]
+            self.highlighted_rows_[row] -= 1
+            if self.highlighted_rows_[row] == 0:
+                del self.highlighted_rows_[row]
+
+    def set_highlights(self, highlights):
+        """Replaces the highlights with the given (row, column) -> colour map.
+
+        Returns the cells whose colour changed and the rows whose label
+        changed.
+        """
+        changed_cells = [cell for cell, colour in self.highlights_.iteritems()
+                         if highlights.get(cell) != colour]
+        changed_cells += [cell for cell in highlights
+                          if not self.highlights_.has_key(cell)]
+
+        old_rows = set(self.highlighted_rows_)
+        for row, col in changed_cells:
+            if highlights.has_key((row, col)):
+                self.highlight(row, col, highlights[(row, col)])
+            else:
+                self.unhighlight(row, col)
+        changed_rows = old_rows.symmetric_difference(self.highlighted_rows_)
+        return changed_cells, changed_rows
+
+
 class ScheduleBrowsingGrid(gridlib.Grid):
     
     def __init__(self, parent, schedule, incoming_dependences, outgoing_dependences, labels,
@@ -47,14 +139,13 @@ class ScheduleBrowsingGrid(gridlib.Grid):
         self.column_to_label_map_ = {}
         self.label_to_column_map_ = {}
         self.schedule_ = schedule
-	self.incoming_dependences_ = defaultdict(list)
+        self.incoming_dependences_ = defaultdict(list)
         self.incoming_dependences_.update(incoming_dependences)
-	self.outgoing_dependences_ = defaultdict(list)
+        self.outgoing_dependences_ = defaultdict(list)
         self.outgoing_dependences_.update(outgoing_dependences)
         self.labels_ = labels
-        self.highlighted_cells_ = []
         self.node_to_cell_map_ = defaultdict(constant_factory(None))
-	self.cell_to_node_map_ = {}
+        self.cell_to_node_map_ = {}
         self.dependence_colour_ = dependence_colour
         self.selected_instruction_ = selected_instruction
         self.cursor_instruction_ = cursor_instruction
@@ -76,28 +167,33 @@ class ScheduleBrowsingGrid(gridlib.Grid):
                     self.node_to_cell_map_[schedule[cycle][slot]] = (cycle, self.label_to_column_map_[slot])
                     self.cell_to_node_map_[(cycle, self.label_to_column_map_[slot])] = schedule[cycle][slot]
 
-	# Schedule cycles are zero-based
-	rows = rows + 1
-
-        self.CreateGrid(rows, columns)
+        # Schedule cycles are zero-based
+        rows = rows + 1
+
+        # Indexes for the highlighting actions, so that they do not need to
+        # scan the whole schedule or all the dependences.
+        self.label_to_nodes_ = defaultdict(list)
+        for node in self.cell_to_node_map_.itervalues():
+            self.label_to_nodes_[labels[node]].append(node)
+
+        self.dependence_sources_ = defaultdict(list)
+        for deplist in self.incoming_dependences_.itervalues():
+            for node, kind, latency, loop in deplist:
+                self.dependence_sources_[kind].append(node)
+        self.dependence_sinks_ = defaultdict(list)
+        for deplist in self.outgoing_dependences_.itervalues():
+            for node, kind, latency, loop in deplist:
+                self.dependence_sinks_[kind].append(node)
+
+        self.resource_constrained_cells_ = None
+
+        self.table_ = ScheduleTable(rows, self.column_to_label_map_,
+                                    self.cell_to_node_map_, labels)
+        self.SetTable(self.table_, True)
         self.Bind(gridlib.EVT_GRID_SELECT_CELL, self.OnSelectCell)
         self.Bind(gridlib.EVT_GRID_CELL_RIGHT_CLICK, self.OnCellRightClick)
         self.Bind(gridlib.EVT_GRID_CELL_LEFT_DCLICK, self.OnCellLeftDClick)
 
-        for col in self.column_to_label_map_.keys():
-            self.SetColLabelValue(col, "%s" % self.column_to_label_map_[col])
-
-	for row in range(0, rows):
-            self.SetRowLabelValue(row, "%s" % row)
-            for col in range(0, columns):
-                slot = self.column_to_label_map_[col]
-                self.SetCellBackgroundColour(row, col, "white")
-                cycle = row
-                if schedule.has_key(cycle) and schedule[cycle].has_key(slot):
-                    self.SetCellValue(row, col, labels[schedule[cycle][slot]])
-                else:
-                    self.SetCellValue(row, col, "...")
-
         self.InstallGridHint(self.GetCellValue)
         self.EnableEditing(False)
 
@@ -125,34 +221,44 @@ class ScheduleBrowsingGrid(gridlib.Grid):
     def set_loop_edge_inclusion(self, state):
         self.include_loop_edges_ = state
 
-    def unhighlight_cells(self):
-        for r,c in self.highlighted_cells_:
-            self.SetCellBackgroundColour(r, c, "white")
-            self.SetRowLabelValue(r, "%s" % r)
-
-            # Without this, the grid is not always updated on screen.
-            self.ForceRefresh()
+    # Above this many changed cells, repainting the whole grid is cheaper
+    # than invalidating the cells one by one.
+    MAX_CELL_REFRESHES = 1000
 
-        self.highlighted_cells_ = []
+    def set_highlights(self, highlights):
+        """Highlights exactly the cells of the (row, column) -> colour map.
 
-    def unhighlight_cell(self, row, col):
-        self.SetCellBackgroundColour(row, col, "white")
-        self.SetRowLabelValue(row, "%s" % row)
+        Only the cells and the row labels whose state changed since the
+        previous action are repainted.
+        """
+        changed_cells, changed_rows = self.table_.set_highlights(highlights)
 
-        # Without this, the grid is not always updated on screen.
-        self.ForceRefresh()
+        if len(changed_cells) > self.MAX_CELL_REFRESHES:
+            self.ForceRefresh()
+            return
 
-        if (row, col) in self.highlighted_cells_:
-            self.highlighted_cells_.remove((row, col))
+        grid_window = self.GetGridWindow()
+        for row, col in changed_cells:
+            rect = self.CellToRect(row, col)
+            x, y = self.CalcScrolledPosition(rect.GetX(), rect.GetY())
+            grid_window.RefreshRect(
+                wx.Rect(x, y, rect.GetWidth(), rect.GetHeight()), False)
+        if changed_rows:
+            self.GetGridRowLabelWindow().Refresh()
 
-    def highlight_cell(self, row, column, colour):
-        self.highlighted_cells_.append((row, column))
-        self.SetCellBackgroundColour(row, column, colour)
+    def unhighlight_cells(self):
+        self.set_highlights({})
 
-        self.SetRowLabelValue(row, "%s ==>" % row)
+    def unhighlight_cell(self, row, col):
+        highlights = dict(self.table_.highlights_)
+        if highlights.has_key((row, col)):
+            del highlights[(row, col)]
+            self.set_highlights(highlights)
 
-        # Without this, the grid is not always updated on screen.
-        self.ForceRefresh()
+    def highlight_cell(self, row, column, colour):
+        highlights = dict(self.table_.highlights_)
+        highlights[(row, column)] = colour
+        self.set_highlights(highlights)
 
 
     def OnSelectCell(self, evt):
@@ -193,7 +299,7 @@ class ScheduleBrowsingGrid(gridlib.Grid):
         evt.Skip()
 
     def highlight_dependences(self, row, column):
-        self.unhighlight_cells()
+        highlights = {}
         if self.cell_to_node_map_.has_key((row, column)):
             incoming_count = 0
             outgoing_count = 0
@@ -205,53 +311,46 @@ class ScheduleBrowsingGrid(gridlib.Grid):
                     incoming_count += 1
                     entry = self.node_to_cell_map_[n]
                     if entry:
-                        r, c = entry
-                        self.highlight_cell(r, c, self.dependence_colour_[t])
+                        highlights[entry] = self.dependence_colour_[t]
 
             for n,t,l,loop in self.outgoing_dependences_[node]:
                 if not loop or self.include_loop_edges_:
                     outgoing_count += 1
                     entry = self.node_to_cell_map_[n]
                     if entry:
-                        r, c = entry
-                        self.highlight_cell(r, c, self.dependence_colour_[t])
+                        highlights[entry] = self.dependence_colour_[t]
 
+            self.set_highlights(highlights)
             self.GetTopLevelParent().SetStatusFields(["%s incoming dependences" % incoming_count,
                                                       "%s outgoing dependences" % outgoing_count])
 
             self.GetTopLevelParent().Layout()
         else:
+            self.set_highlights(highlights)
             self.GetTopLevelParent().SetStatusFields(["0 incoming dependences",
                                                       "0 outgoing dependences"])
 
     def highlight_dependence_kind(self, dep_kind, show_source, show_sink):
         """Highlight sources of the specified kind of dependence."""
 
-        self.unhighlight_cells()
-
+        highlights = {}
+        nodes = []
         if show_source:
-            for deplist in self.incoming_dependences_.values():
-                for node, kind, latency, loop in deplist:
-                    if kind == dep_kind:
-                        entry = self.node_to_cell_map_[node]
-                        if entry:
-                            r, c = entry
-                            self.highlight_cell(r, c, self.dependence_colour_[kind])
+            nodes += self.dependence_sources_[dep_kind]
         if show_sink:
-            for deplist in self.outgoing_dependences_.values():
-                for node, kind, latency, loop in deplist:
-                    if kind == dep_kind:
-                        entry = self.node_to_cell_map_[node]
-                        if entry:
-                            r, c = entry
-                            self.highlight_cell(r, c, self.dependence_colour_[kind])
+            nodes += self.dependence_sinks_[dep_kind]
+        for node in nodes:
+            entry = self.node_to_cell_map_[node]
+            if entry:
+                highlights[entry] = self.dependence_colour_[dep_kind]
 
+        self.set_highlights(highlights)
         self.GetTopLevelParent().SetStatusFields(["", ""])
 
     def highlight_matching_cells(self, regexp):
-        """Highlights cells whose contents matches regexp."""
+        """Highlights the moves whose label matches regexp.
 
-        self.unhighlight_cells()
+        The regexp is matched once against each distinct label."""
 
         try:
             search_re = re.compile(regexp)
@@ -259,68 +358,26 @@ class ScheduleBrowsingGrid(gridlib.Grid):
             self.GetTopLevelParent().SetStatusFields(["Error in search regexp", ""])
             return
 
-        matches = 0
-        for row in range(0, self.GetNumberRows()):
-            for col in range(0, self.GetNumberCols()):
-                if search_re.search(self.GetCellValue(row, col)):
-                    self.highlight_cell(row, col, 'yellow')
-                    matches = matches + 1
+        highlights = {}
+        for label, nodes in self.label_to_nodes_.iteritems():
+            if search_re.search(label):
+                for node in nodes:
+                    highlights[self.node_to_cell_map_[node]] = 'yellow'
 
-        self.GetTopLevelParent().SetStatusFields(["%d matches" % matches, ""])
+        self.set_highlights(highlights)
+        self.GetTopLevelParent().SetStatusFields(["%d matches" % len(highlights), ""])
 
     def highlight_resource_constrained_cells(self):
         """Highlight cells whose moves could be scheduled earlier."""
 
-        def earliest_cycle(incoming_deps):
-            """Find out the earliest cycle when the move could
-            be scheduled based on dependences only."""
-
-            earliest_cycle = 0
-
-            for src_node, dep_kind, latency, loop in incoming_deps:
-                entry = self.node_to_cell_map_[src_node]
-                if entry:
-                    src_row, src_col = entry
-                    earliest_cycle = max(earliest_cycle, src_row + latency)
-
-            return earliest_cycle
-
-
-
-        highlighted = []
-        count = 0
-
-        self.unhighlight_cells()
-
-        for row in range(0, self.GetNumberRows()):
-            for col in range(0, self.GetNumberCols()):
-                if self.cell_to_node_map_.has_key((row, col)):
-                    cell = self.cell_to_node_map_[(row, col)]
-                    incoming_deps = self.incoming_dependences_[cell]
-
-                    # Highlight cell if scheduled later.
-                    if earliest_cycle(incoming_deps) < row:
-                        self.highlight_cell(row, col, 'orange')
-                        highlighted.append((row, col))
-                        count = count + 1
-
-        for row, col in highlighted:
-            cell = self.cell_to_node_map_[(row, col)]
-            for dst_node, dep_kind, latency, loop in self.outgoing_dependences_[cell]:
-
-                # If there is a trigger dependence from this move to a triggering
-                # move and the trigger is constrained by data dependences, then
-                # scheduling this move earlier would not help.
-                if (dep_kind == "T"):
-                    dst_cell = self.node_to_cell_map_[dst_node]
-                    if dst_cell:
-                        dst_row, dst_col = dst_cell
-                        dst_incoming_deps = self.incoming_dependences_[dst_cell]
-                        dst_operation_deps = filter(lambda src, kind, lat: kind == "O",
-                                                    dst_incoming_deps)
-                        if earliest_cycle(dst_operation_deps) < dst_row:
-                            self.highlight_cell(row, col, 'yellow')
-                            count = count - 1
-                            break
-                        
+        # The result depends only on the schedule, so it is computed once.
+        if self.resource_constrained_cells_ is None:
+            highlights = {}
+            for node in resource_constrained_nodes(self.schedule_,
+                                                   self.incoming_dependences_):
+                highlights[self.node_to_cell_map_[node]] = 'orange'
+            self.resource_constrained_cells_ = (highlights, len(highlights))
+
+        highlights, count = self.resource_constrained_cells_
+        self.set_highlights(highlights)
         self.GetTopLevelParent().SetStatusFields(["%d resource constrained moves" % count, ""])
@@ -1,93 +1,319 @@
 import xml.parsers.expat
 import sys
+import os
+import marshal
+import multiprocessing
+from array import array
 from collections import defaultdict
-import itertools
 
-def constant_factory(value):
-    return itertools.repeat(value).next
+# The dependence reasons and types in the order of their codes in the edge
+# kind column of ScheduleData.
+DEPENDENCE_REASONS = [u"reg", u"mem", u"fu", u"op", u"ra"]
+DEPENDENCE_TYPES = [u"unknown", u"raw", u"war", u"waw", u"trg"]
 
-class XMLScheduleParser:
+# (reason, type) -> edge kind code.
+KIND_CODES = dict(((reason, dep_type), r * len(DEPENDENCE_TYPES) + t)
+                  for r, reason in enumerate(DEPENDENCE_REASONS)
+                  for t, dep_type in enumerate(DEPENDENCE_TYPES))
+
+# Changed whenever the layout of the cache files changes.
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".cache"
+
+class ScheduleData:
+    """Compact columnar model of one dumped schedule.
+
+    The node ids, labels and slot names are interned to a single string
+    table. The nodes and the edges are kept in parallel int arrays, the
+    nodes indexed by their position and the edges referring to the nodes
+    by their positions. Unscheduled nodes have the cycle and slot -1.
+    """
+
+    NODE_COLUMNS = ["node_id_", "node_label_", "node_cycle_", "node_slot_"]
+    EDGE_COLUMNS = ["edge_source_", "edge_sink_", "edge_kind_",
+                    "edge_latency_", "edge_loop_"]
 
     def __init__(self):
-        self.parser_ = xml.parsers.expat.ParserCreate()
-        self.parser_.StartElementHandler = self.start_element_handler
-        self.parser_.EndElementHandler = self.end_element_handler
-        self.parser_.CharacterDataHandler = self.character_data_handler
+        self.name_ = u""
+        self.strings_ = []
+        for column in self.NODE_COLUMNS + self.EDGE_COLUMNS:
+            setattr(self, column, array('i'))
+        # Only needed while building.
+        self.string_index_ = {}
+        self.node_index_ = {}
+
+    def intern(self, string):
+        index = self.string_index_.get(string)
+        if index is None:
+            index = len(self.strings_)
+            self.strings_.append(string)
+            self.string_index_[string] = index
+        return index
+
+    def node(self, node_id):
+        """Returns the position of the node, adding it if not seen yet."""
+        index = self.node_index_.get(node_id)
+        if index is None:
+            index = len(self.node_id_)
+            self.node_id_.append(self.intern(node_id))
+            self.node_label_.append(-1)
+            self.node_cycle_.append(-1)
+            self.node_slot_.append(-1)
+            self.node_index_[node_id] = index
+        return index
+
+    def add_node(self, node_id, label, cycle, slot):
+        index = self.node(node_id)
+        self.node_label_[index] = self.intern(label)
+        if cycle is not None:
+            self.node_cycle_[index] = cycle
+            self.node_slot_[index] = self.intern(slot)
+
+    def add_edge(self, source, sink, reason, dep_type, latency, loop):
+        self.edge_source_.append(self.node(source))
+        self.edge_sink_.append(self.node(sink))
+        self.edge_kind_.append(KIND_CODES[(reason, dep_type)])
+        self.edge_latency_.append(latency)
+        self.edge_loop_.append(loop)
+
+    def finish(self):
+        """Drops the lookup tables only needed while building."""
+        self.string_index_ = {}
+        self.node_index_ = {}
+
+    def node_count(self):
+        return len(self.node_id_)
+
+    def edge_count(self):
+        return len(self.edge_source_)
+
+    @staticmethod
+    def kind(code):
+        """Returns the (reason, type) pair of an edge kind code."""
+        return (DEPENDENCE_REASONS[code // len(DEPENDENCE_TYPES)],
+                DEPENDENCE_TYPES[code % len(DEPENDENCE_TYPES)])
+
+    def statistics(self):
+        statistics = defaultdict(int)
+        for code in self.edge_kind_:
+            statistics[self.kind(code)] += 1
+        return statistics
+
+    def browser_data(self):
+        """Returns the schedule in the dictionary form the browser uses.
+
+        Returns a tuple of the schedule (cycle -> slot -> node id), the
+        incoming and the outgoing dependences (node id -> list of (node id,
+        kind, latency, loop)), the labels of the scheduled nodes (node id ->
+        label) and the statistics (kind -> edge count).
+        """
+        strings = self.strings_
+        schedule = defaultdict(dict)
+        labels = {}
+        for index in xrange(self.node_count()):
+            if self.node_cycle_[index] >= 0:
+                node_id = strings[self.node_id_[index]]
+                labels[node_id] = strings[self.node_label_[index]]
+                schedule[self.node_cycle_[index]][
+                    strings[self.node_slot_[index]]] = node_id
+
+        incoming_dependences = defaultdict(list)
+        outgoing_dependences = defaultdict(list)
+        for edge in xrange(self.edge_count()):
+            source = strings[self.node_id_[self.edge_source_[edge]]]
+            sink = strings[self.node_id_[self.edge_sink_[edge]]]
+            kind = self.kind(self.edge_kind_[edge])
+            latency = self.edge_latency_[edge]
+            loop = bool(self.edge_loop_[edge])
+            incoming_dependences[sink].append((source, kind, latency, loop))
+            outgoing_dependences[source].append((sink, kind, latency, loop))
+
+        return (schedule, incoming_dependences, outgoing_dependences, labels,
+                self.statistics())
 
-        self.schedule_ = defaultdict(dict)
-        self.incoming_dependences_ = defaultdict(list)
-        self.outgoing_dependences_ = defaultdict(list)
-        self.labels_ = {}
-        self.statistics_ = defaultdict(constant_factory(0))
+    def save(self, file_name):
+        columns = {}
+        for column in self.NODE_COLUMNS + self.EDGE_COLUMNS:
+            columns[column] = getattr(self, column).tostring()
+        f = open(file_name, "wb")
+        try:
+            marshal.dump((CACHE_VERSION, self.name_, self.strings_, columns), f)
+        finally:
+            f.close()
 
+    @classmethod
+    def load(cls, file_name):
+        """Loads a saved schedule, returns None if the file is not usable."""
+        try:
+            f = open(file_name, "rb")
+            try:
+                version, name, strings, columns = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != CACHE_VERSION:
+            return None
+        data = cls()
+        data.name_ = name
+        data.strings_ = strings
+        for column in cls.NODE_COLUMNS + cls.EDGE_COLUMNS:
+            values = array('i')
+            values.fromstring(columns[column])
+            setattr(data, column, values)
+        return data
 
-        # Stack to keep track of element hierarchy
-        self.element_stack_ = [('TOP', [])]
-        
-        self.nodes_ = []
-        self.edges_ = []
+class XMLScheduleParser:
+    """Streaming parser of the --dump-ddgs-xml schedule dumps.
+
+    Only the fields of the node or edge element being parsed are kept in
+    memory, the rest goes directly to a ScheduleData.
+    """
 
-        self.cvalue_ = ""
-        self.cdata_elements_ = ["id", "label", "cycle", "slot", "loop"]
+    # Elements whose character data is a field of the enclosing node or
+    # edge. The dumps spell the latency and the loop distance of an edge
+    # "lat" and "dist".
+    cdata_elements_ = frozenset(["id", "label", "cycle", "slot", "loop",
+                                 "latency", "lat", "dist"])
+    # Edge kind elements -> the field they set.
+    kind_elements_ = dict([(t, "type") for t in DEPENDENCE_TYPES] +
+                          [(r, "reason") for r in DEPENDENCE_REASONS])
+
+    def __init__(self):
+        self.data_ = None
 
     def parse(self, xml_file_name):
-        f = open(xml_file_name)
-        self.parser_.ParseFile(f)
-        return (self.schedule_,
-                self.incoming_dependences_,
-                self.outgoing_dependences_,
-                self.labels_,
-                self.statistics_)
+        """Parses the dump, returns it in the form ScheduleBrowsingGrid uses.
+
+        See ScheduleData.browser_data().
+        """
+        return self.parse_data(xml_file_name).browser_data()
+
+    def parse_data(self, xml_file_name):
+        """Parses the dump to a ScheduleData."""
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self.start_element_handler
+        parser.EndElementHandler = self.end_element_handler
+        parser.CharacterDataHandler = self.character_data_handler
+        # Delivers the text of an element in one piece in most cases.
+        parser.buffer_text = True
+        parser.buffer_size = 1 << 16
+
+        self.data_ = ScheduleData()
+        # Whether a node or an edge element is open.
+        self.in_item_ = False
+        self.fields_ = {}
+        self.nrefs_ = []
+        self.cvalue_ = u""
+
+        f = open(xml_file_name, "rb")
+        try:
+            parser.ParseFile(f)
+        finally:
+            f.close()
+
+        data = self.data_
+        data.finish()
+        self.data_ = None
+        return data
 
     def start_element_handler(self, name, attributes):
-        self.element_stack_.append((name, {}))
-        self.cvalue_ = ""
+        if name == "node" or name == "edge":
+            self.in_item_ = True
+            self.fields_ = {}
+            self.nrefs_ = []
+        self.cvalue_ = u""
 
     def end_element_handler(self, name):
-        tag, value = self.element_stack_.pop()
-        parent_tag, parent_value = self.element_stack_[-1]
-        if tag in self.cdata_elements_:
-            parent_value[tag] = self.cvalue_
-        elif parent_tag == "edge" and tag == "nref":
-            if parent_value.has_key("source"):
-                parent_value["sink"] = self.cvalue_
-            else:
-                parent_value["source"] = self.cvalue_
-        elif (parent_tag == "edge"
-            and tag in ["unknown", "raw", "war", "waw", "trg"]):
-            parent_value["type"] = tag
-        elif (parent_tag == "edge"
-            and tag in ["reg", "mem", "fu", "op", "ra"]):
-            parent_value["reason"] = tag
-        elif tag == "node":
-            self.handle_node(value)
-        elif tag == "edge":
-            self.handle_edge(value)
-        self.cvalue_ = ""
+        if name in self.cdata_elements_:
+            if self.in_item_:
+                self.fields_[name] = self.cvalue_
+            elif name == "label":
+                self.data_.name_ = self.cvalue_
+        elif name == "nref":
+            self.nrefs_.append(self.cvalue_)
+        elif name in self.kind_elements_:
+            self.fields_[self.kind_elements_[name]] = name
+        elif name == "node":
+            self.in_item_ = False
+            self.handle_node(self.fields_)
+        elif name == "edge":
+            self.in_item_ = False
+            self.fields_["source"], self.fields_["sink"] = self.nrefs_
+            self.handle_edge(self.fields_)
 
     def character_data_handler(self, data):
         self.cvalue_ += data
 
     def handle_node(self, node_data):
-        if node_data.has_key("cycle"):
-            self.schedule_[int(node_data["cycle"])][node_data["slot"]] = node_data["id"]
-            self.labels_[node_data["id"]] = node_data["label"]
+        if "cycle" in node_data:
+            self.data_.add_node(node_data["id"], node_data["label"],
+                                int(node_data["cycle"]), node_data["slot"])
+        else:
+            self.data_.add_node(node_data["id"], node_data.get("label", u""),
+                                None, None)
 
     def handle_edge(self, edge_data):
-        kind = (edge_data["reason"], edge_data["type"])
-        if edge_data.has_key("latency"):
-            latency = edge_data["latency"]
-        else:
-            latency = 0
-        if edge_data.has_key("loop"):
-            loop = True
-        else:
-            loop = False
-        self.incoming_dependences_[edge_data["sink"]].append((edge_data["source"], kind, latency, loop))
-        self.outgoing_dependences_[edge_data["source"]].append((edge_data["sink"], kind, latency, loop))
-        self.statistics_[kind] += 1
-                                
+        latency = int(edge_data.get("lat", edge_data.get("latency", 0)))
+        loop = "dist" in edge_data or "loop" in edge_data
+        self.data_.add_edge(edge_data["source"], edge_data["sink"],
+                            edge_data["reason"], edge_data["type"],
+                            latency, loop)
+
+def load_schedule(xml_file_name, use_cache=True):
+    """Returns the ScheduleData of the dump.
+
+    The parsed dump is saved to a binary cache file next to the XML file,
+    from which it is loaded as long as the XML file is not modified.
+    """
+    cache_file_name = xml_file_name + CACHE_SUFFIX
+    if use_cache:
+        try:
+            fresh = (os.path.getmtime(cache_file_name) >=
+                     os.path.getmtime(xml_file_name))
+        except OSError:
+            fresh = False
+        if fresh:
+            data = ScheduleData.load(cache_file_name)
+            if data is not None:
+                return data
+
+    data = XMLScheduleParser().parse_data(xml_file_name)
+    if use_cache:
+        # Written under a temporary name, so that parallel loaders never
+        # see a partial cache file.
+        temp_file_name = "%s.%d" % (cache_file_name, os.getpid())
+        try:
+            data.save(temp_file_name)
+            os.rename(temp_file_name, cache_file_name)
+        except (IOError, OSError):
+            # The cache is an optimization only, e.g. the directory might
+            # not be writable.
+            try:
+                os.remove(temp_file_name)
+            except OSError:
+                pass
+    return data
+
+def load_schedules(xml_file_names, processes=1, use_cache=True):
+    """Returns the ScheduleData of each dump, in the order of the files.
+
+    With processes > 1 the dumps are parsed in parallel worker processes.
+    """
+    if processes <= 1 or len(xml_file_names) <= 1:
+        return [load_schedule(name, use_cache) for name in xml_file_names]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_load_schedule_worker,
+                        [(name, use_cache) for name in xml_file_names])
+    finally:
+        pool.close()
+        pool.join()
+
+def _load_schedule_worker(args):
+    return load_schedule(*args)
 
 if __name__ == "__main__":
-    p = XMLScheduleParser()
-    print p.parse(sys.argv[1])
+    for data in load_schedules(sys.argv[1:]):
+        print "%s: %d nodes, %d edges" % (data.name_, data.node_count(),
+                                          data.edge_count())
@@ -35,6 +35,18 @@ import time
 import math
 import traceback
 import signal
+import selectors
+import resource
+import json
+import asyncio
+import hashlib
+import shutil
+import collections
+import threading
+import concurrent.futures
+import contextlib
+import xml.etree.ElementTree as ElementTree
+import itertools
 from io import StringIO
 
 try:
@@ -46,112 +58,238 @@ except:
 
 from difflib import unified_diff
 from optparse import OptionParser
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+
+class ProcessUsage(object):
+    """Wall clock and CPU time consumed by a single supervised child process.
+
+    The peak resident set size (maxrss) is in kilobytes."""
+    def __init__(self, wall=0.0, user=0.0, system=0.0, maxrss=0):
+        self.wall = wall
+        self.user = user
+        self.system = system
+        self.maxrss = maxrss
+
+    def cpu(self):
+        return self.user + self.system
+
+    def __add__(self, other):
+        return ProcessUsage(self.wall + other.wall, self.user + other.user,
+                            self.system + other.system,
+                            max(self.maxrss, other.maxrss))
+
+def _read_output_file(fd, fileName, close=True):
+    """Reads the whole contents of the given output temp file.
+
+    The file is closed and removed in case close is True."""
+    size = os.lseek(fd, 0, 2)
+    os.lseek(fd, 0, 0)
+    contents = os.read(fd, size).decode('utf-8')
+    if close:
+        os.close(fd)
+        os.remove(fileName)
+    return contents
+
+def _wait_for_exit(process, deadline):
+    """Waits until the given process exits or the deadline is reached.
+
+    Uses a pidfd to sleep in the kernel until the child exits, so no
+    polling is needed. The child is reaped with wait4 to get its resource
+    usage. Falls back to Popen.wait() and RUSAGE_CHILDREN deltas on platforms
+    without pidfd support.
+
+    Returns the ProcessUsage of the child (without the wall time), or None
+    on timeout."""
+    pidfd = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            pidfd = None
 
-def run_with_timeout(command, timeoutSecs, inputStream = "", combinedOutput=True):
-    """
-    Runs the given process until it exits or the given time out is reached.
+    if pidfd is None:
+        childrenBefore = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            process.wait(max(0.0, deadline - time.monotonic()))
+        except TimeoutExpired:
+            return None
+        childrenAfter = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # The peak memory of the children cannot be computed as a delta,
+        # this is the peak of all the children waited for so far.
+        return ProcessUsage(
+            0.0, childrenAfter.ru_utime - childrenBefore.ru_utime,
+            childrenAfter.ru_stime - childrenBefore.ru_stime,
+            childrenAfter.ru_maxrss)
 
-    Returns a tuple: (bool:timeout, str:stdout, str:stderr, int:exitcode)
-    """
-    timePassed = 0.0
-    increment = 0.01
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(pidfd, selectors.EVENT_READ)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0.0:
+                    return None
+                if selector.select(remaining):
+                    break
+        (_, status, rusage) = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return ProcessUsage(0.0, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+    finally:
+        os.close(pidfd)
+
+def _start_process(command, inputStream, combinedOutput, cwd, outputToFile=False):
+    """Starts the given shell command with its output going to temp files.
 
+    Returns a tuple: (Popen:process, float:startTime, outputFiles) where
+    outputFiles is passed to _collect_output() after the process is done."""
     stderrFD, errFile = tempfile.mkstemp()
     if combinedOutput:
         stdoutFD, outFile = stderrFD, errFile
     else:
         stdoutFD, outFile = tempfile.mkstemp()
 
-    process =  Popen(command, shell=True, stdin=PIPE,
+    startTime = time.monotonic()
+    process =  Popen(command, shell=True, stdin=PIPE, cwd=cwd,
                      stdout=stdoutFD, stderr=stderrFD, close_fds=False, universal_newlines=True)
 
     if process is None:
         print("Could not create process")
         sys.exit(1)
-    try:
-        if inputStream != "":
-            for line in inputStream:
-                process.stdin.write(line.strip() + '\n')
-                process.stdin.flush()
-            process.stdin.close()
 
-        while True:
-            status = process.poll()
-            if status is not None:
-                # Process terminated succesfully.
-                stdoutSize = os.lseek(stdoutFD, 0, 2)
-                stderrSize = os.lseek(stderrFD, 0, 2)
-
-                os.lseek(stdoutFD, 0, 0)
-                os.lseek(stderrFD, 0, 0)
-
-                stdoutContents = os.read(stdoutFD, stdoutSize).decode('utf-8')
-                os.close(stdoutFD)
-                os.remove(outFile)
-
-                if not combinedOutput:
-                    stderrContents = os.read(stderrFD, stderrSize).decode('utf-8')
-                    os.close(stderrFD)
-                    os.remove(errFile)
-                else:
-                    stderrContents = stdoutContents
+    if inputStream != "":
+        for line in inputStream:
+            process.stdin.write(line.strip() + '\n')
+            process.stdin.flush()
+        process.stdin.close()
 
-                return (False, stdoutContents, stderrContents, process.returncode)
+    return (process, startTime,
+            (stdoutFD, outFile, stderrFD, errFile, combinedOutput, outputToFile))
+
+def _collect_output(outputFiles):
+    """Returns the (stdout, stderr) contents and removes the temp files.
+
+    In case the output was requested to a file, returns the names of the
+    closed temp files instead. The caller is responsible for removing them."""
+    (stdoutFD, outFile, stderrFD, errFile, combinedOutput, outputToFile) = outputFiles
+    if outputToFile:
+        os.close(stdoutFD)
+        if not combinedOutput:
+            os.close(stderrFD)
+        return (outFile, errFile)
+    stdoutContents = _read_output_file(stdoutFD, outFile)
+    if not combinedOutput:
+        stderrContents = _read_output_file(stderrFD, errFile)
+    else:
+        stderrContents = stdoutContents
+    return (stdoutContents, stderrContents)
 
-            if timePassed < timeoutSecs:
-                time.sleep(increment)
-                timePassed = timePassed + increment
-            else:
-                # time out, kill the process.
-                stdoutSize = os.lseek(stdoutFD, 0, 2)
-                stderrSize = os.lseek(stderrFD, 0, 2)
-
-                os.lseek(stdoutFD, 0, 0)
-                stdoutContents = os.read(stdoutFD, stdoutSize).decode('utf-8')
-                os.close(stdoutFD)
-                os.remove(outFile)
-
-                if not combinedOutput:
-                    os.lseek(stderrFD, 0, 0)
-                    stderrContents = os.read(stderrFD, stderrSize).decode('utf-8')
-                    os.close(stderrFD)
-                    os.remove(errFile)
-                else:
-                    stderrContents = stdoutContents
-                os.kill(process.pid, signal.SIGTSTP)
-                return (True, stdoutContents, stderrContents, process.returncode)
+def run_with_timeout(command, timeoutSecs, inputStream = "", combinedOutput=True,
+                     cwd=None, outputToFile=False):
+    """
+    Runs the given process until it exits or the given time out is reached.
+
+    The time out is a wall clock deadline counted from the process start.
+    If outputToFile is True, the returned stdout and stderr are the names of
+    temp files containing the output instead of the output itself.
+
+    Returns a tuple:
+    (bool:timeout, str:stdout, str:stderr, int:exitcode, ProcessUsage:usage)
+    """
+    (process, startTime, outputFiles) = \
+        _start_process(command, inputStream, combinedOutput, cwd, outputToFile)
+    try:
+        childUsage = _wait_for_exit(process, startTime + timeoutSecs)
+        return _finish_process(process, startTime, outputFiles, childUsage)
     except Exception:
-        print(traceback.format_exc(), file=sys.stderr)
-        # if something threw exception (e.g. ctrl-c)
-        stderrContents = ''
-        stdoutContents = ''
+        return _abort_process(process, startTime, outputFiles)
+
+def _abort_process(process, startTime, outputFiles):
+    """Stops the process after an exception and collects its output.
+
+    Returns the run_with_timeout() result of the interrupted run."""
+    print(traceback.format_exc(), file=sys.stderr)
+    # if something threw exception (e.g. ctrl-c)
+    stderrContents = ''
+    stdoutContents = ''
+    usage = ProcessUsage()
+    usage.wall = time.monotonic() - startTime
+    try:
         os.kill(process.pid, signal.SIGTSTP)
-        try:
-            # time out, kill the process.
-            # time out, kill the process.
-            stdoutSize = os.lseek(stdoutFD, 0, 2)
-            stderrSize = os.lseek(stderrFD, 0, 2)
-
-            os.lseek(stdoutFD, 0, 0)
-            stdoutContents = os.read(stdoutFD, stdoutSize).decode('utf-8')
-            os.close(stdoutFD)
-            os.remove(outFile)
-
-            if not combinedOutput:
-                os.lseek(stderrFD, 0, 0)
-                stderrContents = os.read(stderrFD, stderrSize).decode('utf-8')
-            else:
-                os.close(stderrFD)
-                os.remove(errFile)
-                stderrContents = stdoutContents
+    except:
+        pass
+    try:
+        (stdoutContents, stderrContents) = _collect_output(outputFiles)
+    except:
+        pass
 
-            os.kill(process.pid, signal.SIGTSTP)
-        except:
-            pass
+    return (False, stdoutContents, stderrContents, process.returncode, usage)
+
+def _finish_process(process, startTime, outputFiles, childUsage):
+    """Stops a timed out process and builds the run_with_timeout() result."""
+    timeout = childUsage is None
+    usage = ProcessUsage() if timeout else childUsage
+    usage.wall = time.monotonic() - startTime
+
+    if timeout:
+        # time out, kill the process.
+        os.kill(process.pid, signal.SIGTSTP)
+
+    (stdoutContents, stderrContents) = _collect_output(outputFiles)
+    return (timeout, stdoutContents, stderrContents, process.returncode, usage)
 
-        return (False, stdoutContents, stderrContents, process.returncode)
+async def _wait_for_exit_async(process, deadline):
+    """Asynchronous version of _wait_for_exit().
 
+    Waits for the pidfd of the child from the running event loop. Falls back
+    to running _wait_for_exit() in an executor thread without pidfd support."""
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        return await loop.run_in_executor(None, _wait_for_exit, process, deadline)
+
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await asyncio.wait_for(exited, max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+    (_, status, rusage) = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return ProcessUsage(0.0, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+
+async def run_with_timeout_async(command, timeoutSecs, inputStream = "",
+                                 combinedOutput=True, cwd=None, outputToFile=False):
+    """Asynchronous version of run_with_timeout() for the asyncio scheduler.
+
+    Returns the same tuple as run_with_timeout()."""
+    (process, startTime, outputFiles) = \
+        _start_process(command, inputStream, combinedOutput, cwd, outputToFile)
+    try:
+        childUsage = await _wait_for_exit_async(process, startTime + timeoutSecs)
+        return _finish_process(process, startTime, outputFiles, childUsage)
+    except asyncio.CancelledError:
+        # The run is abandoned (e.g. ctrl-c or the loop shutting down), so
+        # kill the child and remove its output files before passing the
+        # cancellation on.
+        try:
+            process.kill()
+            process.wait()
+        except OSError:
+            pass
+        try:
+            output = _collect_output(outputFiles)
+            if outputToFile:
+                for name in set(output):
+                    os.unlink(name)
+        except OSError:
+            pass
+        raise
+    except Exception:
+        return _abort_process(process, startTime, outputFiles)
 
 def run_command(command, echoStdout=False, echoStderr=False, echoCmd=False,
                 stdoutFD=None, stderrFD=None, stdinFile=None):
@@ -196,9 +334,12 @@ def create_temp_file(suffix=""):
     tempfiles.append(tf[1])
     return tf
 
+tempdirs = []
 def cleanup_and_exit(retval=0):
     for tf in tempfiles:
         os.unlink(tf)
+    for td in tempdirs:
+        shutil.rmtree(td, ignore_errors=True)
     sys.exit(retval)
 
 def parse_options():
@@ -225,28 +366,214 @@ def parse_options():
                       default=False,
                       help="Use ANSI color codes for highlighting the output. " + \
                       "Does not check that the terminal supports them..")
-    if mp_supported:
-        parser.add_option("-p", "--parallel-processes", dest="par_process_count", type="int",
-                          default=multiprocessing.cpu_count(),
-                          help="The number of parallel processes to use for running the test dirs. " + \
-                              "Use 1 to disable parallel execution.")
-        parser.add_option("-a", "--all-parallel", dest="all_parallel", action="store_true",
-                          help="Assume all tests can be ran in parallel (after running all initialize files first). ")
+    parser.add_option("--results-file", dest="results_file", type="string",
+                      default=None,
+                      help="Write a JSON Lines record with the verdict, exit code, " + \
+                      "the wall and CPU times and the peak memory use of each test case " + \
+                      "to the given file.")
+    parser.add_option("-x", "--junit-xml", dest="junit_file", type="string",
+                      default=None,
+                      help="Write the results of the test cases to the given file in " + \
+                      "the JUnit XML format.")
+    parser.add_option("--index-file", dest="index_file", type="string",
+                      default=None,
+                      help="The file to cache the loaded test case metadata to. Only the " + \
+                      "test case files modified after the previous run are loaded again. " + \
+                      "Default is a file in the --cache-dir specific to the working dir. " + \
+                      "Give an empty string to disable.")
+    parser.add_option("-H", "--history-file", dest="history_file", type="string",
+                      default=None,
+                      help="The file to store the test case durations and resource use to. " + \
+                      "The durations of the earlier runs are used to start the longest " + \
+                      "tests first. " + \
+                      "Default is a file in the --cache-dir specific to the working dir. " + \
+                      "Give an empty string to disable.")
+    parser.add_option("--cpu-regression-limit", dest="cpu_regression_limit", type="float",
+                      default=None,
+                      help="Fail test cases whose CPU time grew more than the given " + \
+                      "percentage from the test history. A '### perf-budget: N' line in " + \
+                      "the test case overrides the limit for that test case.")
+    parser.add_option("--rss-regression-limit", dest="rss_regression_limit", type="float",
+                      default=None,
+                      help="Fail test cases whose peak memory use grew more than the given " + \
+                      "percentage from the test history.")
+    parser.add_option("--cache", dest="use_cache", action="store_true",
+                      default=False,
+                      help="Skip the test cases that passed earlier with identical test " + \
+                      "files, verification data and tested binaries. The passing test " + \
+                      "cases are stored to the cache.")
+    parser.add_option("--no-cache", dest="force_run", action="store_true",
+                      default=False,
+                      help="Execute all test cases even if found in the result cache.")
+    parser.add_option("--cache-dir", dest="cache_dir", type="string",
+                      default=default_cache_dir(),
+                      help="The directory of the result cache. Default is %default.")
+    parser.add_option("--stream-verify", dest="stream_verify", action="store_true",
+                      default=False,
+                      help="Verify the test output line by line from the output file instead " + \
+                      "of loading it to memory. Stops at the first difference and outputs " + \
+                      "only the lines around it to the differences file.")
+    parser.add_option("--warm-tools", dest="warm_tools", action="store_true",
+                      default=False,
+                      help="Run the tested TCE binaries directly instead of through their " + \
+                      "libtool wrapper scripts and prefetch libtce and the OSAL operation " + \
+                      "sets to the page cache before running the tests.")
+    parser.add_option("-y", "--asyncio", dest="asyncio_scheduler", action="store_true",
+                      default=False,
+                      help="Run the initializers, test cases and finalizers directly as " + \
+                      "subprocesses of a single asyncio event loop instead of a process pool. " + \
+                      "The test cases of a dir start as soon as the dir is initialized. " + \
+                      "At most --parallel-processes subprocesses run at the same time.")
+    parser.add_option("-p", "--parallel-processes", dest="par_process_count", type="int",
+                      default=os.cpu_count() or 1,
+                      help="The number of parallel processes to use for running the test dirs. " + \
+                          "Use 1 to disable parallel execution. In the asyncio mode this is " + \
+                          "the CPU budget against which the test cases are admitted. The test " + \
+                          "cases can declare their CPU use with a '### cpu: N' line, otherwise " + \
+                          "it is estimated from the test history.")
+    parser.add_option("--memory-budget", dest="memory_budget", type="string",
+                      default=None,
+                      help="The memory budget of the asyncio mode, e.g. 16G. Default is the " + \
+                      "physical memory. The test cases can declare their memory use with a " + \
+                      "'### memory: SIZE' line, otherwise their peak RSS in the test history " + \
+                      "is used.")
+    parser.add_option("-a", "--all-parallel", dest="all_parallel", action="store_true",
+                      default=False,
+                      help="Assume all tests can be ran in parallel (after running all initialize files first). ")
 
     (options, args) = parser.parse_args()
 
-    if options.dump_output and mp_supported:
+    if options.memory_budget is None:
+        options.memory_budget = physical_memory_kb()
+    else:
+        try:
+            options.memory_budget = parse_memory_size(options.memory_budget)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if options.index_file is None:
+        options.index_file = default_state_file(options.cache_dir, "index")
+    if options.index_file == "":
+        options.index_file = None
+    else:
+        options.index_file = os.path.abspath(options.index_file)
+
+    if options.history_file is None:
+        options.history_file = default_state_file(options.cache_dir, "history")
+    if options.history_file == "":
+        options.history_file = None
+    else:
+        options.history_file = os.path.abspath(options.history_file)
+
+    if options.results_file is not None:
+        options.results_file = os.path.abspath(options.results_file)
+    if options.junit_file is not None:
+        options.junit_file = os.path.abspath(options.junit_file)
+
+    if options.dump_output:
         options.par_process_count = 1
 
     return (options, args)
 
+def _lines_or_empty(lines):
+    # An empty output is compared as a single empty line like in the
+    # non-streaming verification.
+    empty = True
+    for line in lines:
+        empty = False
+        yield line
+    if empty:
+        yield ""
+
+def first_difference_diff(expected, produced, context=3,
+                          fromfile="expected.stdout", tofile="produced.stdout"):
+    """Compares two iterables of lines until their first difference.
+
+    Only the context lines before the difference and the context lines after
+    it are kept in memory. Returns an empty list in case the lines are equal,
+    otherwise unified diff formatted lines around the first difference."""
+    expected = _lines_or_empty(expected)
+    produced = _lines_or_empty(produced)
+    before = collections.deque(maxlen=context)
+    line_number = 0
+    for (expected_line, produced_line) in itertools.zip_longest(expected, produced):
+        if expected_line == produced_line:
+            before.append(expected_line)
+            line_number += 1
+            continue
+
+        expected_lines = [x for x in [expected_line] if x is not None]
+        expected_lines += list(itertools.islice(expected, context))
+        produced_lines = [x for x in [produced_line] if x is not None]
+        produced_lines += list(itertools.islice(produced, context))
+
+        start = line_number - len(before) + 1
+        diff = ["--- %s\n" % fromfile, "+++ %s\n" % tofile,
+                "@@ -%d,%d +%d,%d @@\n" % \
+                    (start, len(before) + len(expected_lines),
+                     start, len(before) + len(produced_lines))]
+        diff += [" " + x for x in before]
+        diff += ["-" + x for x in expected_lines]
+        diff += ["+" + x for x in produced_lines]
+        return [x if x.endswith("\n") else x + "\n" for x in diff]
+    return []
+
+class TestCaseResult(object):
+    """Collects the outcome of all the runs of a single test case."""
+    def __init__(self, test_path, perf_budget=None):
+        self.test_path = test_path
+        self.perf_budget = perf_budget
+        self.ok = True
+        self.timeout = False
+        self.exitcode = None
+        self.usage = ProcessUsage()
+        self.start_time = time.time()
+        # True in case the test case was not executed because it
+        # passed earlier with the same inputs.
+        self.cached = False
+
+    def add_run(self, timeout, exitcode, usage):
+        self.timeout = self.timeout or timeout
+        self.exitcode = exitcode
+        self.usage = self.usage + usage
+
+    def record(self):
+        """Returns the result as a dict for the machine-readable results."""
+        if self.cached:
+            verdict = "cached-pass"
+        elif self.timeout:
+            verdict = "timeout"
+        elif self.ok:
+            verdict = "pass"
+        else:
+            verdict = "fail"
+        return {"test": self.test_path, "verdict": verdict,
+                "timeout": self.timeout, "maxrss": self.usage.maxrss,
+                "perf_budget": self.perf_budget,
+                "exitcode": self.exitcode,
+                "wall": round(self.usage.wall, 6),
+                "user": round(self.usage.user, 6),
+                "sys": round(self.usage.system, 6)}
+
 output_diff_file = None
+result_cache = None
 class IntegrationTestCase(object):
     """Represents a single integration/system test case in the TCE test suite.
 
     Also handles the loading of test case data from the test case metadata/script
     files."""
-    def __init__(self, test_case_file):
+
+    # The attributes loaded from the test case file. These are stored to
+    # the test discovery index.
+    index_attributes = ["valid", "description", "bin", "args", "type",
+                        "verification_data_dir", "xstdout", "ignore_stdout",
+                        "perf_budget", "cpu_weight", "memory_weight"]
+
+    def __init__(self, test_case_file, index_entry=None):
+        """Loads the test case from the given file.
+
+        If index_entry is given, the attributes are taken from it instead of
+        parsing the file, see index_entry()."""
         self._file_name = test_case_file
         self.test_dir = os.path.dirname(test_case_file) or "."
 
@@ -261,7 +588,22 @@ class IntegrationTestCase(object):
         self.xstderr = None
         self.stdin = ""
         self.valid = False
-        if test_case_file.endswith(".testdesc"):
+        # The result cache key of the test case, if the cache is enabled.
+        self.cache_key = None
+        # The allowed CPU time and peak memory increase of the test case in
+        # percents, overrides the limits given in the command line.
+        self.perf_budget = None
+        # The number of CPUs and the memory in kB the test case declares
+        # to use, None if not declared.
+        self.cpu_weight = None
+        self.memory_weight = None
+        # The (CPUs, memory in kB) reserved for the test case by the asyncio
+        # scheduler.
+        self.resources = (1.0, 0)
+        if index_entry is not None:
+            for name in index_entry.keys():
+                setattr(self, name, index_entry[name])
+        elif test_case_file.endswith(".testdesc"):
             self._load_legacy_testdesc()
         elif os.path.basename(test_case_file).startswith("tcetest_") and \
                 os.path.basename(test_case_file).endswith(".sh"):
@@ -289,14 +631,15 @@ class IntegrationTestCase(object):
                 clean_str += line
             return clean_str.strip()
 
-    def _load_verification_data(self):
+    def _load_verification_data(self, base_dir="."):
 
-        out_files = glob.glob(os.path.join(self.verification_data_dir, "*_output.txt"))
+        data_dir = os.path.join(base_dir, self.verification_data_dir)
+        out_files = glob.glob(os.path.join(data_dir, "*_output.txt"))
 
         for out_file in out_files:
             index = os.path.basename(out_file)[0:-len("output.txt")]
             in_files_pattern = \
-                os.path.join(self.verification_data_dir, index + "*.txt")
+                os.path.join(data_dir, index + "*.txt")
             in_files = glob.glob(in_files_pattern)
 
             in_files.remove(out_file)
@@ -309,7 +652,7 @@ class IntegrationTestCase(object):
             else:
                 # Support also files without running index number in front.
                 # E.g. ld32_st32_output.txt and ld32_st32.txt (input).
-                no_index_file = os.path.join(self.verification_data_dir, index[0:-1] + ".txt")
+                no_index_file = os.path.join(data_dir, index[0:-1] + ".txt")
                 if os.path.exists(no_index_file):
                     in_file = index[0:-1] + ".txt"
                 else:
@@ -367,6 +710,21 @@ class IntegrationTestCase(object):
         self.description = m.group(1).strip()
         self.bin = os.path.join(".", os.path.basename(self._file_name))
 
+        m = re.search(r"###\sperf-budget:\s*([0-9.]+)", contents)
+        if m:
+            self.perf_budget = float(m.group(1))
+
+        m = re.search(r"###\scpu:\s*([0-9.]+)", contents)
+        if m:
+            self.cpu_weight = float(m.group(1))
+
+        m = re.search(r"###\smemory:\s*(\S+)", contents)
+        if m:
+            try:
+                self.memory_weight = parse_memory_size(m.group(1))
+            except ValueError as e:
+                print("%s: %s" % (self._file_name, e), file=sys.stderr)
+
         m = re.search(r"###\sxstdout:\s(.*)", contents)
         if not m:
             self.xstdout = None
@@ -390,6 +748,19 @@ class IntegrationTestCase(object):
 
         self.valid = True
 
+    def index_entry(self):
+        """Returns the loaded attributes as a JSON serializable dict."""
+        return dict([(x, getattr(self, x)) for x in self.index_attributes
+                     if hasattr(self, x)])
+
+    def test_path(self):
+        """Returns the normalized path of the test case file.
+
+        Used as the key of the test case in the machine-readable results
+        and the duration history."""
+        return os.path.normpath(
+            os.path.join(self.test_dir, os.path.basename(self._file_name)))
+
     def __str__(self):
         return ("description: %s\n" + \
                 "type:        %s\n" + \
@@ -398,51 +769,81 @@ class IntegrationTestCase(object):
                 "data dir:    %s\n") % \
             (self.description, self.type, self.bin, self.args, self.verification_data_dir)
 
-    def execute(self, stdout_stream=sys.stdout):
-        """Assumes CWD is in the test directory when this is called."""
+    def _is_disabled(self, base_dir):
+        # The test case might have been disabled in ./initialize
+        return os.path.exists(
+            os.path.join(base_dir, os.path.basename(self._file_name) + ".disabled"))
 
-        if os.path.exists(os.path.basename(self._file_name) + ".disabled"):
-            # The test case might have been disabled in ./initialize
-            return True
+    def _begin(self, stdout_stream, base_dir):
+        """Prints the test case header and loads its verification data.
 
+        Returns the TestCaseResult to collect the runs into."""
         if options.print_successful:
             stdout_stream.write(self._file_name + ": " + self.description + "...")
             stdout_stream.flush()
 
-        all_ok = True
+        result = TestCaseResult(self.test_path(), self.perf_budget)
 
-        start_time = time.time()
+        self._load_verification_data(base_dir)
+        return result
 
-        self._load_verification_data()
-
-        for test_data in self._test_data:
-            stdin_fn = test_data[0]
-            if stdin_fn is not None:
-                stdin_fn = os.path.join(self.verification_data_dir, stdin_fn)
-                stdinStimulus = open(stdin_fn, 'r').readlines()
-            else:
-                stdinStimulus = self.stdin
+    def _stdin_for(self, test_data, base_dir):
+        """Returns the stdin file name and the stdin lines for a test run."""
+        stdin_fn = test_data[0]
+        if stdin_fn is not None:
+            stdin_fn = os.path.join(self.verification_data_dir, stdin_fn)
+            stdinStimulus = open(os.path.join(base_dir, stdin_fn), 'r').readlines()
+        else:
+            stdinStimulus = self.stdin
+        return (stdin_fn, stdinStimulus)
 
-            outputTemp = create_temp_file(".out")
-            (timeout, stdoutStr, stderrStr, exitcode) = \
-                run_with_timeout(self.bin + " " + self.args, options.timeout, inputStream=stdinStimulus)
+    def _verify_run(self, test_data, base_dir, stdin_fn, run, result, stdout_stream):
+        """Verifies the output and exit code of a single run of the test."""
+        try:
+            self._verify_run_output(test_data, base_dir, stdin_fn, run, result,
+                                    stdout_stream)
+        finally:
+            if options.stream_verify and os.path.exists(run[1]):
+                # The run produced its output to a temp file.
+                os.remove(run[1])
+
+    def _verify_run_output(self, test_data, base_dir, stdin_fn, run, result,
+                           stdout_stream):
+        (timeout, stdoutStr, stderrStr, exitcode, usage) = run
+        result.add_run(timeout, exitcode, usage)
+
+        if timeout:
+            if options.output_diff:
+                output_diff_file.write("FAIL (timeout %ss): " % options.timeout + \
+                                       self._file_name + ": " + self.description + " (%s) " % stdin_fn + "\n")
+            result.ok = False
+            return
 
-            if timeout:
-                if options.output_diff:
-                    output_diff_file.write("FAIL (timeout %ss): " % options.timeout + \
-                                           self._file_name + ": " + self.description + " (%s) " % stdin_fn + "\n")
-                all_ok = False
-                continue
+        stdout_fn = test_data[1]
+        if stdout_fn is not None:
+            stdout_fn = os.path.join(base_dir, self.verification_data_dir, stdout_fn)
 
-            stdout = StringIO(stdoutStr)
-            gotOut = stdout.readlines()
+        stdoutDiff = []
+        if options.stream_verify:
+            # The produced and expected outputs are compared directly from
+            # the files, thus the memory use does not depend on their size.
+            gotOut = lambda: open(stdoutStr, errors='replace')
+            if not self.ignore_stdout:
+                with gotOut() as produced:
+                    if stdout_fn is not None:
+                        with open(stdout_fn, errors='replace') as expected:
+                            stdoutDiff = first_difference_diff(expected, produced)
+                    else:
+                        stdoutDiff = first_difference_diff(self.xstdout or [], produced)
+        else:
+            gotOut = lambda: StringIO(stdoutStr)
 
-            stdout_fn = test_data[1]
             if stdout_fn is not None:
-                correctOut = open(os.path.join(self.verification_data_dir, stdout_fn)).readlines()
+                correctOut = open(stdout_fn).readlines()
             else:
                 correctOut = self.xstdout
 
+            producedOut = gotOut().readlines()
 
             # Allow checking only against the script exit code. In this case the
             # xstdout can be completely empty. It is marked a list with an empty
@@ -450,48 +851,60 @@ class IntegrationTestCase(object):
             if correctOut is None or correctOut == []:
                 correctOut = [""]
 
-            if gotOut is None or gotOut == []:
-                gotOut = [""]
+            if producedOut is None or producedOut == []:
+                producedOut = [""]
 
             if not self.ignore_stdout:
-                stdoutDiff = list(unified_diff(correctOut, gotOut,
+                stdoutDiff = list(unified_diff(correctOut, producedOut,
                                                fromfile="expected.stdout", tofile="produced.stdout"))
-            if options.dump_output:
-                stdout_stream.write(stdoutStr)
-
-            if not self.ignore_stdout and len(stdoutDiff) > 0:
-                if options.output_diff:
-                    stdin_fn_out = ""
-                    if stdin_fn is not None: stdin_fn_out = ' (%s)' % stdin_fn
-                    output_diff_file.write("FAIL: " + self._file_name + ": " + self.description + \
-                                               "%s" % stdin_fn_out + "\n")
-                    for line in stdoutDiff:
-                        output_diff_file.write(line)
-                    output_diff_file.flush()
-                all_ok = False
-
-            if exitcode != 0:
-                if options.output_diff:
-                    output_diff_file.write("FAIL: " + self._file_name + ": " + self.description + \
-                                               " [nonzero ({0}) exit code]\n".format(exitcode))
-                    if self.ignore_stdout and gotOut:
-                        # In case we ignore stdout in the verification, it might still
-                        # contain useful information for debugging the failed error code,
-                        # thus let's dump it to the log here.
-                        for line in gotOut:
-                            output_diff_file.write(line)
-                    output_diff_file.flush()
-                all_ok = False
+        if options.dump_output:
+            with gotOut() as produced:
+                shutil.copyfileobj(produced, stdout_stream)
+
+        if not self.ignore_stdout and len(stdoutDiff) > 0:
+            if options.output_diff:
+                stdin_fn_out = ""
+                if stdin_fn is not None: stdin_fn_out = ' (%s)' % stdin_fn
+                output_diff_file.write("FAIL: " + self._file_name + ": " + self.description + \
+                                           "%s" % stdin_fn_out + "\n")
+                for line in stdoutDiff:
+                    output_diff_file.write(line)
+                output_diff_file.flush()
+            result.ok = False
+
+        if exitcode != 0:
+            if options.output_diff:
+                output_diff_file.write("FAIL: " + self._file_name + ": " + self.description + \
+                                           " [nonzero ({0}) exit code]\n".format(exitcode))
+                if self.ignore_stdout:
+                    # In case we ignore stdout in the verification, it might still
+                    # contain useful information for debugging the failed error code,
+                    # thus let's dump it to the log here.
+                    with gotOut() as produced:
+                        shutil.copyfileobj(produced, output_diff_file)
+                output_diff_file.flush()
+            result.ok = False
 
-            if options.print_successful:
-                stdout_stream.write(".")
-                stdout_stream.flush()
+        if options.print_successful:
+            stdout_stream.write(".")
+            stdout_stream.flush()
+
+    def _finish(self, result, stdout_stream):
+        """Reports the verdict of the test case and returns it."""
+        all_ok = result.ok
 
         # Free some memory.
         self._test_data = []
 
-        end_time = time.time()
-        duration = end_time - start_time
+        record = result.record()
+        # A result exceeding its resource use budget is reported as a
+        # failure by the collector, thus it is not cached as a pass either.
+        if all_ok and result_cache is not None and self.cache_key is not None \
+                and not options.dump_output and \
+                (collector is None or len(collector.regressions(record)) == 0):
+            result_cache.add(self.cache_key, result.test_path)
+
+        duration = time.time() - result.start_time
         duration_str = "(%dm%.3fs)" % \
             (duration / 60, duration % 60)
         if not options.print_successful and not all_ok and not options.dump_output:
@@ -510,20 +923,535 @@ class IntegrationTestCase(object):
                 # at least with my terminal. Need to reset stderr too here.
                 sys.stderr.write(ansi_color_setup())
 
+        report_result(record)
         return all_ok
 
-def get_fs_tree(root):
-    """Returns all files found starting from the given root path.
+    def execute(self, stdout_stream=sys.stdout):
+        """Assumes CWD is in the test directory when this is called."""
+
+        if self._is_disabled("."):
+            return True
 
-    Does not include directories."""
-    found_files = []
-    for f in os.listdir(root):
-        full_path = os.path.join(root, f)
-        if not os.path.isdir(full_path):
-            found_files.append(os.path.join(root, f))
-        else:
-            found_files += get_fs_tree(os.path.join(root, f))
-    return found_files
+        result = self._begin(stdout_stream, ".")
+
+        for test_data in self._test_data:
+            (stdin_fn, stdinStimulus) = self._stdin_for(test_data, ".")
+            run = run_with_timeout(self.bin + " " + self.args, options.timeout,
+                                   inputStream=stdinStimulus,
+                                   outputToFile=options.stream_verify)
+            self._verify_run(test_data, ".", stdin_fn, run, result, stdout_stream)
+
+        return self._finish(result, stdout_stream)
+
+    async def execute_async(self, budget, stdout_stream):
+        """Executes the test case from an asyncio event loop.
+
+        Does not change the CWD, the test runs are started in the test
+        directory. Each run reserves the resources of the test case from
+        the given ResourceBudget while it executes."""
+
+        if self._is_disabled(self.test_dir):
+            return True
+
+        result = self._begin(stdout_stream, self.test_dir)
+
+        for test_data in self._test_data:
+            (stdin_fn, stdinStimulus) = self._stdin_for(test_data, self.test_dir)
+            async with budget.reserve(*self.resources):
+                run = await run_with_timeout_async(
+                    self.bin + " " + self.args, options.timeout,
+                    inputStream=stdinStimulus, cwd=self.test_dir,
+                    outputToFile=options.stream_verify)
+            self._verify_run(test_data, self.test_dir, stdin_fn, run, result,
+                             stdout_stream)
+
+        return self._finish(result, stdout_stream)
+
+class ResultCollector(object):
+    """Receives the printouts and the result records of the test cases.
+
+    Writes the records to the JSON Lines results file as they arrive and
+    the JUnit XML file at the end. The pool worker processes send their
+    printouts and records through a queue which is drained by a thread in
+    the main process, thus only the main process writes to stdout and to
+    the results files."""
+    def __init__(self, results_file=None, junit_file=None, history=None):
+        self.records = []
+        # Set to False in case a test exceeded its resource use budget.
+        self.perf_ok = True
+        self._history = history
+        self._junit_file = junit_file
+        self._results_stream = None
+        if results_file is not None:
+            self._results_stream = open(results_file, "w")
+        self._queue = None
+        self._drain_thread = None
+
+    def output(self, text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    def result(self, record):
+        self._check_budgets(record)
+        self.records.append(record)
+        if self._results_stream is not None:
+            self._results_stream.write(json.dumps(record, sort_keys=True) + "\n")
+            self._results_stream.flush()
+
+    def regressions(self, record):
+        """Returns the resource use regressions of the test, see TestHistory."""
+        if self._history is None:
+            return []
+        cpu_limit = options.cpu_regression_limit
+        rss_limit = options.rss_regression_limit
+        if record["perf_budget"] is not None:
+            cpu_limit = rss_limit = record["perf_budget"]
+        return self._history.regressions(record, cpu_limit, rss_limit)
+
+    def _check_budgets(self, record):
+        """Compares the resource use of the test against the history."""
+        regressions = self.regressions(record)
+        if len(regressions) == 0:
+            return
+        record["verdict"] = "perf-regression"
+        record["regressions"] = regressions
+        self.perf_ok = False
+        self.output("%s: PERF REGRESSION (%s)\n" % \
+                        (record["test"], ", ".join(regressions)))
+
+    def start_queue(self):
+        """Returns a queue the worker processes can send their reports to."""
+        self._queue = multiprocessing.Queue()
+        self._drain_thread = threading.Thread(target=self._drain)
+        self._drain_thread.daemon = True
+        self._drain_thread.start()
+        return self._queue
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            (kind, payload) = item
+            if kind == "output":
+                self.output(payload)
+            else:
+                self.result(payload)
+
+    def stop_queue(self):
+        """Waits until the reports sent before this call have been handled.
+
+        Must be called only after the worker processes have exited."""
+        if self._queue is None:
+            return
+        self._queue.put(None)
+        self._drain_thread.join()
+        self._queue = None
+
+    def close(self):
+        if self._results_stream is not None:
+            self._results_stream.close()
+        if self._junit_file is not None:
+            self._write_junit_xml()
+
+    def _write_junit_xml(self):
+        suite = ElementTree.Element("testsuite", name="systemtest")
+        failures = 0
+        total_time = 0.0
+        for record in self.records:
+            test_dir, test_name = os.path.split(record["test"])
+            case = ElementTree.SubElement(
+                suite, "testcase", classname=test_dir.replace(os.sep, ".") or ".",
+                name=test_name, time="%.3f" % record["wall"])
+            total_time += record["wall"]
+            properties = ElementTree.SubElement(case, "properties")
+            for name in ["user", "sys", "maxrss"]:
+                ElementTree.SubElement(properties, "property", name=name,
+                                       value=str(record[name]))
+            if record["verdict"] in ["fail", "timeout"]:
+                failures += 1
+                ElementTree.SubElement(
+                    case, "failure", type=record["verdict"],
+                    message="%s (exit code %s)" % (record["verdict"], record["exitcode"]))
+            elif record["verdict"] == "perf-regression":
+                failures += 1
+                ElementTree.SubElement(
+                    case, "failure", type=record["verdict"],
+                    message=", ".join(record["regressions"]))
+            elif record["verdict"] == "cached-pass":
+                ElementTree.SubElement(case, "system-out").text = \
+                    "Passed earlier with identical inputs, not executed."
+        suite.set("tests", str(len(self.records)))
+        suite.set("failures", str(failures))
+        suite.set("errors", "0")
+        suite.set("time", "%.3f" % total_time)
+        ElementTree.ElementTree(suite).write(
+            self._junit_file, encoding="utf-8", xml_declaration=True)
+
+# The collector of the main process and the queue to it from the pool
+# worker processes.
+collector = None
+collector_queue = None
+
+def init_pool_worker(queue):
+    global collector_queue
+    collector_queue = queue
+
+def report_output(text):
+    """Sends a test case printout to the collector."""
+    if collector_queue is not None:
+        collector_queue.put(("output", text))
+    else:
+        collector.output(text)
+
+def report_result(record):
+    """Sends a test case result record to the collector."""
+    if collector_queue is not None:
+        collector_queue.put(("result", record))
+    else:
+        collector.result(record)
+
+# Resource use below these is not checked for regressions.
+MIN_REGRESSION_CPU_SECS = 0.5
+MIN_REGRESSION_RSS_KB = 16 * 1024
+
+class TestHistory(object):
+    """Wall clock durations, CPU times and peak memory use of the test cases
+    measured in the earlier runs.
+
+    The durations are used to start the longest test dirs and test cases
+    first, so a few long tests do not end up running alone at the end of
+    a parallel run. The CPU times and memory use are the baseline for
+    detecting performance regressions."""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.tests = {}
+        if file_name is None or not os.path.exists(file_name):
+            return
+        try:
+            with open(file_name) as history_file:
+                self.tests = json.load(history_file).get("tests", {})
+        except (ValueError, OSError, AttributeError):
+            print("Ignoring a broken test history file %s." % file_name,
+                  file=sys.stderr)
+            self.tests = {}
+
+    def _default_estimate(self):
+        # Tests without history are assumed to take the average time.
+        durations = [x["wall"] for x in self.tests.values()]
+        if len(durations) == 0:
+            return 0.0
+        return sum(durations) / len(durations)
+
+    def estimate(self, test_case, default=None):
+        """Returns the expected wall clock duration of the test case."""
+        if default is None:
+            default = self._default_estimate()
+        return self.tests.get(test_case.test_path(), {}).get("wall", default)
+
+    def dir_estimate(self, test_cases, default=None):
+        """Returns the expected duration of running the cases in sequence."""
+        if default is None:
+            default = self._default_estimate()
+        return sum([self.estimate(x, default) for x in test_cases])
+
+    def longest_first(self, test_dirs):
+        """Returns the test dirs dict reordered by the longest-job-first rule.
+
+        Both the dirs and the test cases inside them are sorted by their
+        expected duration in decreasing order."""
+        default = self._default_estimate()
+        key = lambda x: -self.estimate(x, default)
+        dirs = sorted(test_dirs.keys(),
+                      key=lambda x: -self.dir_estimate(test_dirs[x], default))
+        return dict([(x, sorted(test_dirs[x], key=key)) for x in dirs])
+
+    def resources(self, test_case):
+        """Returns the (CPUs, memory in kB) the test case is expected to use.
+
+        The values declared in the test case are used if given. Otherwise
+        the CPUs are estimated from the ratio of the CPU and wall times and
+        the memory from the peak RSS measured earlier."""
+        old = self.tests.get(test_case.test_path(), {})
+        cpus = test_case.cpu_weight
+        if cpus is None:
+            cpus = 1.0
+            if old.get("wall", 0.0) > 0.0:
+                cpus = max(1.0, round(old.get("cpu", 0.0) / old["wall"], 1))
+        memory_kb = test_case.memory_weight
+        if memory_kb is None:
+            memory_kb = old.get("maxrss", 0)
+        return (cpus, memory_kb)
+
+    def regressions(self, record, cpu_limit, rss_limit):
+        """Returns descriptions of the resource use regressions of a test.
+
+        The limits are the allowed increase in percents against the stored
+        history, None disables the check. Small absolute values are ignored
+        as they are dominated by noise."""
+        old = self.tests.get(os.path.normpath(record["test"]))
+        if old is None or record["verdict"] != "pass":
+            return []
+        found = []
+        cpu = record["user"] + record["sys"]
+        old_cpu = old.get("cpu", 0.0)
+        if cpu_limit is not None and cpu >= MIN_REGRESSION_CPU_SECS and \
+                cpu > old_cpu * (1.0 + cpu_limit / 100.0):
+            found.append("CPU time %.2fs -> %.2fs" % (old_cpu, cpu))
+        old_rss = old.get("maxrss", 0)
+        if rss_limit is not None and record["maxrss"] >= MIN_REGRESSION_RSS_KB and \
+                record["maxrss"] > old_rss * (1.0 + rss_limit / 100.0):
+            found.append("peak RSS %dkB -> %dkB" % (old_rss, record["maxrss"]))
+        return found
+
+    def update(self, records):
+        for record in records:
+            # Only the fresh passing results are accepted as the new
+            # baseline. The failed and timed out runs did not complete
+            # their work and the regressed results would hide the
+            # regression in the next run.
+            if record["verdict"] != "pass":
+                continue
+            self.tests[os.path.normpath(record["test"])] = \
+                {"wall": record["wall"], "cpu": record["user"] + record["sys"],
+                 "maxrss": record["maxrss"]}
+
+    def save(self):
+        if self.file_name is None:
+            return
+        # Write to a temp file first so an interrupted run does not
+        # leave a truncated history behind.
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        temp_name = self.file_name + ".tmp"
+        with open(temp_name, "w") as history_file:
+            json.dump({"tests": self.tests}, history_file, sort_keys=True,
+                      indent=1)
+        os.replace(temp_name, self.file_name)
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME",
+                                os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "tce", "systemtest")
+
+def default_state_file(cache_dir, kind):
+    """Returns the default path of the index or the history file.
+
+    The test cases are keyed by their paths relative to the working dir,
+    thus each working dir gets its own files in the cache dir instead of
+    writing them to the source tree."""
+    cwd_hash = hashlib.sha256(os.getcwd().encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s-%s.json" % (kind, cwd_hash))
+
+class TestResultCache(object):
+    """Remembers the content hashes of the test cases that passed.
+
+    The key of a test case covers the test case file, the other files in
+    its test dir tree, its verification data, and the tested TCE binaries
+    (and libtce) the test case file refers to. The files the harness itself
+    writes (the index, the history, the results and the cache) are not part
+    of the key. A test case with a key found in the cache passed earlier
+    with identical inputs, thus it can be skipped."""
+    def __init__(self, cache_dir, harness_files=()):
+        self.cache_dir = cache_dir
+        # Absolute paths of the harness state files, also matching their
+        # temporary files written next to them.
+        self._harness_files = [x for x in harness_files if x is not None] + \
+            [os.path.abspath(cache_dir)]
+        # Hashes of the already read files, keyed by (path, mtime, size).
+        self._file_hashes = {}
+        self._binary_patterns = [
+            (x, re.compile(r"(?<![\w.-])%s(?![\w.-])" % re.escape(x)))
+            for x in tested_binaries]
+
+    def _file_hash(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return "missing"
+        memo_key = (path, st.st_mtime_ns, st.st_size)
+        if memo_key not in self._file_hashes:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            self._file_hashes[memo_key] = digest.hexdigest()
+        return self._file_hashes[memo_key]
+
+    def _is_harness_file(self, path):
+        path = os.path.abspath(path)
+        return any(path == x or path.startswith(x + ".") or
+                   path.startswith(x + os.sep) for x in self._harness_files)
+
+    def _dir_files(self, path):
+        """Returns the regular files in the given dir tree in a stable order.
+
+        Skips the ignored_test_dirs, the disabled files and the harness
+        state files."""
+        found = []
+        for (root, dirs, files) in os.walk(path):
+            dirs[:] = sorted(x for x in dirs if x not in ignored_test_dirs and
+                             not self._is_harness_file(os.path.join(root, x)))
+            found += [os.path.join(root, x) for x in sorted(files)
+                      if not x.endswith(".disabled") and
+                      not self._is_harness_file(os.path.join(root, x))]
+        return found
+
+    def key(self, test_case):
+        """Returns the content hash identifying the inputs of the test case."""
+        digest = hashlib.sha256()
+        def add(name, path):
+            digest.update(("%s %s\n" % (name, self._file_hash(path))).encode())
+
+        test_dir = test_case.test_dir
+        add("test case " + os.path.basename(test_case._file_name),
+            test_case._file_name)
+        for path in self._dir_files(test_dir):
+            add(os.path.relpath(path, test_dir), path)
+
+        # The verification data is usually in the test dir tree, but can
+        # also be given relative to it from elsewhere.
+        data_dir = os.path.join(test_dir, test_case.verification_data_dir)
+        relative_data_dir = os.path.relpath(data_dir, test_dir)
+        if os.path.isdir(data_dir) and (relative_data_dir == os.pardir or
+                                        relative_data_dir.startswith(
+                                            os.pardir + os.sep)):
+            for path in self._dir_files(data_dir):
+                add(os.path.relpath(path, test_dir), path)
+
+        contents = open(test_case._file_name, errors="replace").read() + \
+            " " + test_case.bin + " " + test_case.args
+        for (binary, pattern) in self._binary_patterns:
+            if pattern.search(contents) is None:
+                continue
+            binary_path = shutil.which(binary)
+            if binary_path is not None:
+                add(binary, binary_path)
+        for lib in sorted(glob.glob(os.path.join(
+                os.environ.get("TCE_BUILD_ROOT", ""), "src", ".libs", "libtce*.so*"))):
+            add(os.path.basename(lib), lib)
+
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key)
+
+    def contains(self, key):
+        return os.path.exists(self._entry(key))
+
+    def add(self, key, test_path):
+        """Stores the key of a passed test case."""
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        temp_name = "%s.%d.tmp" % (entry, os.getpid())
+        with open(temp_name, "w") as entry_file:
+            json.dump({"test": test_path, "time": time.time()}, entry_file)
+        os.replace(temp_name, entry)
+
+def remove_cached_test_cases(test_dirs):
+    """Removes the test cases found in the result cache from the test dirs.
+
+    The removed test cases are reported as passed from cache. Test dirs
+    without remaining test cases are dropped, so their initialize and
+    finalize scripts are not ran either."""
+    remaining_dirs = dict()
+    for test_dir in test_dirs.keys():
+        remaining = []
+        for test_case in test_dirs[test_dir]:
+            test_case.cache_key = result_cache.key(test_case)
+            if options.force_run or not result_cache.contains(test_case.cache_key):
+                remaining.append(test_case)
+                continue
+            if options.print_successful:
+                sys.stdout.write("%s: %s...OK (cached)\n" % \
+                                     (test_case._file_name, test_case.description))
+            result = TestCaseResult(test_case.test_path())
+            result.cached = True
+            collector.result(result.record())
+        if len(remaining):
+            remaining_dirs[test_dir] = remaining
+    sys.stdout.flush()
+    return remaining_dirs
+
+# Dirs that contain only build artifacts or version control data, never
+# test cases.
+ignored_test_dirs = set([".deps", ".libs", ".git", ".svn", "autom4te.cache",
+                         "__pycache__"])
+
+def is_test_case_file(name):
+    return name.endswith(".testdesc") or \
+        (name.startswith("tcetest_") and name.endswith(".sh"))
+
+def scan_test_case_files(root):
+    """Returns (path, stat) of the test case files found under the root dir.
+
+    Does not descend to the ignored_test_dirs or the symlinked dirs and
+    stats only the files with test case file names."""
+    found = []
+    dirs = [root]
+    while len(dirs):
+        try:
+            entries = os.scandir(dirs.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                # Symlinked dirs are not followed, like in os.walk(), as
+                # they could form loops.
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignored_test_dirs:
+                        dirs.append(entry.path)
+                elif is_test_case_file(entry.name):
+                    found.append((entry.path, entry.stat()))
+    return found
+
+class TestDiscoveryIndex(object):
+    """Caches the loaded test case attributes between the runs.
+
+    The entries are keyed by the test case file path and are valid as
+    long as the modification time and size of the file do not change."""
+
+    # Increase when IntegrationTestCase.index_attributes change.
+    version = 2
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.entries = {}
+        self._changed = False
+        if file_name is None or not os.path.exists(file_name):
+            return
+        try:
+            with open(file_name) as index_file:
+                index = json.load(index_file)
+            if index.get("version") == self.version:
+                self.entries = index["entries"]
+        except (ValueError, OSError, KeyError, AttributeError):
+            self.entries = {}
+
+    def test_case(self, path, st):
+        """Returns the IntegrationTestCase of the given file from the index.
+
+        Loads the test case from the file in case it is not indexed or has
+        changed since."""
+        key = os.path.abspath(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry["mtime"] == st.st_mtime_ns and \
+                entry["size"] == st.st_size:
+            return IntegrationTestCase(path, entry["attributes"])
+        test_case = IntegrationTestCase(path)
+        self.entries[key] = {"mtime": st.st_mtime_ns, "size": st.st_size,
+                             "attributes": test_case.index_entry()}
+        self._changed = True
+        return test_case
+
+    def save(self):
+        if self.file_name is None or not self._changed:
+            return
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        temp_name = "%s.%d.tmp" % (self.file_name, os.getpid())
+        with open(temp_name, "w") as index_file:
+            json.dump({"version": self.version, "entries": self.entries},
+                      index_file)
+        os.replace(temp_name, self.file_name)
 
 def get_fs_tree_dirs(root, max_depth=10, ignoredirs=[".deps", ".libs"]):
     """Returns all dirs found starting from the given root path.
@@ -542,13 +1470,33 @@ def get_fs_tree_dirs(root, max_depth=10, ignoredirs=[".deps", ".libs"]):
 
     return found_dirs
 
-def find_test_cases(root):
-    fs_tree = get_fs_tree(root)
+def find_test_cases(root, index_file=None):
+    """Returns the valid test cases found under the given root dir.
+
+    The subdirs of the root are scanned in parallel threads, which helps
+    mostly with cold disk caches and network file systems. The test case
+    files are loaded through the discovery index stored to index_file."""
+    subdirs = []
+    found = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in ignored_test_dirs:
+                    subdirs.append(entry.path)
+            elif is_test_case_file(entry.name):
+                found.append((entry.path, entry.stat()))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        for subdir_found in executor.map(scan_test_case_files, subdirs):
+            found += subdir_found
+
+    index = TestDiscoveryIndex(index_file)
     test_cases = []
-    for f in fs_tree:
-        test_case = IntegrationTestCase(f)
+    for (path, st) in sorted(found, key=lambda x: x[0]):
+        test_case = index.test_case(path, st)
         if test_case.valid:
             test_cases.append(test_case)
+    index.save()
     return test_cases
 
 def init_test_dir(test_dir):
@@ -584,11 +1532,7 @@ def run_test_case_par(test_case):
 
     stdout_str = stdout_stream.getvalue()
     if len(stdout_str):
-        # todo: should use a lock here.
-        # seems not so easy to get a lock to the processes in a Pool
-        sys.stdout.write("[%s] " % os.getpid())
-        sys.stdout.write(stdout_str)
-        sys.stdout.flush()
+        report_output("[%s] %s" % (os.getpid(), stdout_str))
 
     os.chdir(top_dir)
 
@@ -609,11 +1553,8 @@ def run_test_dir_par(test_dir, test_cases):
         all_ok = test_case.execute(stdout_stream) and all_ok
         stdout_str = stdout_stream.getvalue()
         if len(stdout_str):
-            # todo: should use a lock here.
-            # seems not so easy to get a lock to the processes in a Pool
-            for line in stdout_str.splitlines():
-                sys.stdout.write("[%s] %s\n" % (os.getpid(), line))
-            sys.stdout.flush()
+            report_output("".join(["[%s] %s\n" % (os.getpid(), line)
+                                   for line in stdout_str.splitlines()]))
 
     os.chdir(top_dir)
 
@@ -621,7 +1562,6 @@ def run_test_dir_par(test_dir, test_cases):
 
     return all_ok
 
-
 def process_test_dir_seq(test_dir, test_cases):
 
     top_dir = os.getcwd()
@@ -643,7 +1583,7 @@ def run_test_dirs_in_parallel(test_dirs):
 
     all_ok = True
 
-    exec_pool = Pool(options.par_process_count)
+    exec_pool = Pool(options.par_process_count, init_pool_worker, (collector_queue,))
     exec_results = []
     for test_dir in test_dirs.keys():
         exec_results.append(exec_pool.apply_async(run_test_dir_par, (test_dir, test_dirs[test_dir])))
@@ -654,7 +1594,7 @@ def run_test_dirs_in_parallel(test_dirs):
     return all_ok
 
 def run_initializers_in_parallel(test_dirs):
-    initializer_pool = Pool(options.par_process_count)
+    initializer_pool = Pool(options.par_process_count, init_pool_worker, (collector_queue,))
     initializer_results = []
 
     for test_dir in test_dirs.keys():
@@ -665,7 +1605,7 @@ def run_initializers_in_parallel(test_dirs):
     initializer_pool.join()
 
 def run_finalizers_in_parallel(test_dirs):
-    finalizer_pool = Pool(options.par_process_count)
+    finalizer_pool = Pool(options.par_process_count, init_pool_worker, (collector_queue,))
     finalizer_results = []
 
     for test_dir in test_dirs.keys():
@@ -683,17 +1623,151 @@ def run_all_tests_in_parallel(test_dirs):
     # scheduler_tester.py uses constant name files for functioning.
     run_initializers_in_parallel(test_dirs)
 
-    exec_pool = Pool(options.par_process_count)
+    # Submit the test cases of all dirs longest first.
+    all_test_cases = sum(test_dirs.values(), [])
+    all_test_cases.sort(key=lambda x: -test_history.estimate(x))
+
+    exec_pool = Pool(options.par_process_count, init_pool_worker, (collector_queue,))
     exec_results = []
-    for test_dir in test_dirs.keys():
-        for test_case in test_dirs[test_dir]:
-            exec_results.append(exec_pool.apply_async(run_test_case_par, (test_case, )))
+    for test_case in all_test_cases:
+        exec_results.append(exec_pool.apply_async(run_test_case_par, (test_case, )))
     exec_pool.close()
     all_ok = all([x.get(options.timeout) for x in exec_results])
     exec_pool.join()
 
     run_finalizers_in_parallel(test_dirs)
 
+    return all_ok
+
+class ResourceBudget(object):
+    """Admits work in the asyncio scheduler against a CPU and memory budget.
+
+    The work is admitted in the order it asks for the resources, so a
+    test needing many CPUs is not starved by a stream of smaller tests.
+    Work needing more than the whole budget is clamped to the budget, that
+    is, it runs alone."""
+    def __init__(self, cpus, memory_kb):
+        self.cpus = cpus
+        self.memory_kb = memory_kb
+        self._free_cpus = cpus
+        self._free_memory_kb = memory_kb
+        self._waiters = collections.deque()
+
+    def _fits(self, cpus, memory_kb):
+        return cpus <= self._free_cpus and memory_kb <= self._free_memory_kb
+
+    def _take(self, cpus, memory_kb):
+        self._free_cpus -= cpus
+        self._free_memory_kb -= memory_kb
+
+    async def acquire(self, cpus, memory_kb):
+        """Waits until the resources are available and takes them.
+
+        Returns the (cpus, memory_kb) actually taken."""
+        cpus = min(cpus, self.cpus)
+        memory_kb = min(memory_kb, self.memory_kb)
+        if len(self._waiters) == 0 and self._fits(cpus, memory_kb):
+            self._take(cpus, memory_kb)
+            return (cpus, memory_kb)
+        admitted = asyncio.get_running_loop().create_future()
+        self._waiters.append((cpus, memory_kb, admitted))
+        await admitted
+        return (cpus, memory_kb)
+
+    def release(self, cpus, memory_kb):
+        self._free_cpus += cpus
+        self._free_memory_kb += memory_kb
+        while len(self._waiters) and self._fits(*self._waiters[0][0:2]):
+            (cpus, memory_kb, admitted) = self._waiters.popleft()
+            self._take(cpus, memory_kb)
+            admitted.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, cpus, memory_kb):
+        taken = await self.acquire(cpus, memory_kb)
+        try:
+            yield
+        finally:
+            self.release(*taken)
+
+def parse_memory_size(size):
+    """Converts a memory size like 512M or 2G to kilobytes.
+
+    A plain number is in megabytes."""
+    m = re.match(r"^\s*([0-9.]+)\s*([kKmMgG]?)[bB]?\s*$", size)
+    if m is None:
+        raise ValueError("Illegal memory size '%s'." % size)
+    multiplier = {"k": 1, "m": 1024, "g": 1024 * 1024, "": 1024}
+    return int(float(m.group(1)) * multiplier[m.group(2).lower()])
+
+def physical_memory_kb():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+async def run_dir_script_async(test_dir, script, budget, resources):
+    """Runs the ./initialize or ./finalize script of the test dir, if any."""
+    if not os.access(os.path.join(test_dir, script), os.X_OK):
+        return
+    async with budget.reserve(*resources):
+        await run_with_timeout_async("./" + script + " > /dev/null 2>&1",
+                                     options.timeout, cwd=test_dir)
+
+async def run_test_case_async(test_case, budget):
+    stdout_stream = StringIO()
+    ok = await test_case.execute_async(budget, stdout_stream)
+    # All output is written from the single event loop thread, thus
+    # the test case printouts cannot interleave.
+    collector.output(stdout_stream.getvalue())
+    return ok
+
+async def run_test_dir_async(test_dir, test_cases, budget):
+    """Runs the initialize -> test cases -> finalize chain of a test dir.
+
+    The test cases of the dir are started as soon as the dir has been
+    initialized. They are ran in parallel with each other only in the
+    --all-parallel mode."""
+    # The dir scripts often build what the test cases use, assume they
+    # need as much resources as the heaviest test case of the dir.
+    dir_resources = (max([x.resources[0] for x in test_cases]),
+                     max([x.resources[1] for x in test_cases]))
+    await run_dir_script_async(test_dir, "initialize", budget, dir_resources)
+    if options.all_parallel:
+        results = await asyncio.gather(
+            *[run_test_case_async(x, budget) for x in test_cases])
+    else:
+        results = [await run_test_case_async(x, budget) for x in test_cases]
+    await run_dir_script_async(test_dir, "finalize", budget, dir_resources)
+    return all(results)
+
+async def run_test_dirs_async(test_dirs):
+    # The budget limits the CPUs and memory used by the child processes
+    # running at the same time, instead of the number of worker processes.
+    budget = ResourceBudget(options.par_process_count, options.memory_budget)
+    for test_cases in test_dirs.values():
+        for test_case in test_cases:
+            test_case.resources = test_history.resources(test_case)
+    results = await asyncio.gather(
+        *[run_test_dir_async(x, test_dirs[x], budget) for x in test_dirs.keys()])
+    return all(results)
+
+def run_tests_with_asyncio(test_dirs):
+    """Runs all the test dirs as subprocesses of a single event loop."""
+    return asyncio.run(run_test_dirs_async(test_dirs))
+
+# The TCE binaries the test cases exercise.
+tested_binaries = ["blocks_translator", "buildcompressor", "buildestimatorplugin",
+                   "buildexplorerplugin", "buildicdecoderplugin", "buildopset",
+                   "c2vhdl", "createbem", "createhdb", "dictionary_tool",
+                   "dump_instruction_execution_trace", "dumptpef",
+                   "estimate", "explore", "generatebits", "generate_cachegrind",
+                   "generateprocessor", "hdbeditor", "llvm-tce", "machine_instruction_info",
+                   "mc-stats", "minimize-ic", "osed", "pareto-vis", "prode",
+                   "proxim", "tceasm", "tcecc", "tce-config", "tcedisasm", "tpef2pasm",
+                   "tceoclextgen", "tceopgen",
+                   "testhdb", "testosal", "ttasim", "ttasim-tandem",
+                   "ttaunittester", "viewbem", "rtlstats", "generatetests"]
 
 def setup_exec_env():
     """Sets up the execution environment variables."""
@@ -715,17 +1789,7 @@ def setup_exec_env():
     subtreeroots = ["scripts", "src/bintools", "src/codesign", "src/procgen"]
     # If any of the dirs inside the subtreeroots contains at least one
     # of these tested binaries, put the dir to the PATH.
-    wanted_binaries = ["blocks_translator", "buildcompressor", "buildestimatorplugin",
-                       "buildexplorerplugin", "buildicdecoderplugin", "buildopset",
-                       "c2vhdl", "createbem", "createhdb", "dictionary_tool",
-                       "dump_instruction_execution_trace", "dumptpef",
-                       "estimate", "explore", "generatebits", "generate_cachegrind",
-                       "generateprocessor", "hdbeditor", "llvm-tce", "machine_instruction_info",
-                       "mc-stats", "minimize-ic", "osed", "pareto-vis", "prode",
-                       "proxim", "tceasm", "tcecc", "tce-config", "tcedisasm", "tpef2pasm",
-                       "tceoclextgen", "tceopgen",
-                       "testhdb", "testosal", "ttasim", "ttasim-tandem",
-                       "ttaunittester", "viewbem", "rtlstats", "generatetests"]
+    wanted_binaries = list(tested_binaries)
     tce_path_env = ""
     max_depth = 2
     for root in subtreeroots:
@@ -759,9 +1823,85 @@ def setup_exec_env():
     os.environ['minimal_64b_with_stdout'] = \
         os.path.join(bld_root, 'data', 'mach', 'minimal_64b_with_stdout.adf')
 
+def find_real_executable(path):
+    """Returns the ELF executable a libtool wrapper script runs, if any.
+
+    Uninstalled libtool programs in the build tree are shell scripts which
+    run .libs/lt-<name>, linked with the build tree rpath. The wrapper
+    creates it on its first run, so the wrapper is run once if it is
+    missing. The .libs/<name> next to it is linked with the install rpath
+    and could thus load an installed libtce, so it is never used. Returns
+    None in case the path is not such a wrapper or lt-<name> could not be
+    created."""
+    with open(path, "rb") as f:
+        header = f.read(1024)
+    if header.startswith(b"\x7fELF") or \
+            b"temporary wrapper script for" not in header:
+        return None
+    candidate = os.path.join(os.path.dirname(path), ".libs",
+                             "lt-" + os.path.basename(path))
+    if not os.path.exists(candidate):
+        try:
+            wrapper = Popen([path, "--help"], stdin=DEVNULL, stdout=DEVNULL,
+                            stderr=DEVNULL)
+        except OSError:
+            return None
+        try:
+            wrapper.wait(timeout=60)
+        except TimeoutExpired:
+            wrapper.kill()
+            wrapper.wait()
+    if os.access(candidate, os.X_OK) and not os.path.isdir(candidate):
+        with open(candidate, "rb") as f:
+            if f.read(4) == b"\x7fELF":
+                return candidate
+    return None
+
+def setup_warm_tools():
+    """Reduces the start up time of the tested TCE binaries.
+
+    Puts a shim dir with links to the real executables of the libtool
+    wrapper scripts first in the PATH, so each tool invocation of a test
+    skips the wrapper shell. The libraries the wrappers would add to the
+    library path are in LD_LIBRARY_PATH already. Also asks the kernel to
+    read libtce, the tested binaries and the OSAL operation set files to
+    the page cache ahead, so the first test cases do not pay for cold
+    loading of them."""
+    bld_root = os.environ['TCE_BUILD_ROOT']
+    shim_dir = tempfile.mkdtemp(prefix="tce-warm-tools-")
+    tempdirs.append(shim_dir)
+
+    prefetched = []
+    for binary in tested_binaries:
+        path = shutil.which(binary)
+        if path is None:
+            continue
+        real_path = find_real_executable(path)
+        if real_path is not None:
+            os.symlink(real_path, os.path.join(shim_dir, binary))
+            path = real_path
+        prefetched.append(path)
+    os.environ['PATH'] = shim_dir + ":" + os.environ['PATH']
+
+    prefetched += glob.glob(os.path.join(bld_root, "src", ".libs", "libtce*.so*"))
+    prefetched += glob.glob(os.path.join(bld_root, "opset", "base", "*.op[bp]"))
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in prefetched:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
 if __name__ == "__main__":
     options, args = parse_options()
     setup_exec_env()
+    if options.warm_tools:
+        setup_warm_tools()
 
     if options.output_diff:
         output_diff_file = open('difference.txt', 'w+')
@@ -771,7 +1911,7 @@ if __name__ == "__main__":
             root_dir = "."
         else:
             root_dir = args[0]
-        all_test_cases = find_test_cases(root_dir)
+        all_test_cases = find_test_cases(root_dir, options.index_file)
     else:
         for fn in options.test_cases:
             if not os.access(fn, os.R_OK):
@@ -784,13 +1924,31 @@ if __name__ == "__main__":
         test_dirs[test_case.test_dir] = \
             test_dirs.get(test_case.test_dir, []) + [test_case]
 
+    test_history = TestHistory(options.history_file)
+    collector = ResultCollector(options.results_file, options.junit_file,
+                                test_history)
+
+    if options.use_cache and not options.dump_output:
+        result_cache = TestResultCache(
+            options.cache_dir,
+            [options.index_file, options.history_file, options.results_file,
+             options.junit_file])
+        test_dirs = remove_cached_test_cases(test_dirs)
+
+    test_dirs = test_history.longest_first(test_dirs)
+
     all_ok = True
 
-    if mp_supported and options.par_process_count > 1:
+    if options.asyncio_scheduler:
+        all_ok = run_tests_with_asyncio(test_dirs)
+    elif mp_supported and options.par_process_count > 1:
+        collector_queue = collector.start_queue()
         if options.all_parallel:
             all_ok = run_all_tests_in_parallel(test_dirs)
         else:
             all_ok = run_test_dirs_in_parallel(test_dirs)
+        collector.stop_queue()
+        collector_queue = None
     else:
         for test_dir in test_dirs.keys():
             all_ok = process_test_dir_seq(test_dir, test_dirs[test_dir]) and all_ok
@@ -798,6 +1956,14 @@ if __name__ == "__main__":
     if options.output_diff:
         output_diff_file.close()
 
+    collector.close()
+    test_history.update(collector.records)
+    test_history.save()
+
+    if not collector.perf_ok:
+        sys.stderr.write("Some test cases exceeded their CPU time or memory budget.\n")
+        all_ok = False
+
     if not all_ok:
         if options.output_diff:
             sys.stderr.write("Differences found against verification data are stored into difference.txt\n")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Test module for systemtest"""
+import contextlib
+import io
+import optparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import systemtest
+
+
+class TestCaseDirTestCase(unittest.TestCase):
+    """Creates a test dir with a single shell test case"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.test_dir = os.path.join(self.directory, "tests")
+        self.write("tcetest_sum.sh",
+                   "#!/bin/sh\n### TCE TESTCASE\n### title: sum\ncat data/a.txt\n")
+        self.write("data/a.txt", "1 2\n")
+        self.write("sub/input.txt", "3 4\n")
+        self.test_case = systemtest.IntegrationTestCase(
+            os.path.join(self.test_dir, "tcetest_sum.sh"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        path = os.path.join(self.test_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
+
+
+class TestResultCacheKey(TestCaseDirTestCase):
+    """The result cache key covers the test dir tree"""
+
+    def setUp(self):
+        super().setUp()
+        self.history_file = os.path.join(self.test_dir, "history.json")
+        self.cache = systemtest.TestResultCache(
+            os.path.join(self.test_dir, "cache"), [self.history_file])
+
+    def key(self):
+        # A new cache does not remember the hashes of the earlier keys.
+        return systemtest.TestResultCache(
+            self.cache.cache_dir, [self.history_file]).key(self.test_case)
+
+    def test_subdir_edit_changes_key(self):
+        """Files in the subdirs of the test dir are inputs"""
+        key = self.key()
+        self.write("sub/input.txt", "3 5\n")
+        self.assertNotEqual(self.key(), key)
+        self.write("sub/deeper/more.txt", "6\n")
+        self.assertNotEqual(self.key(), key)
+
+    def test_harness_files_do_not_change_key(self):
+        """The files the harness writes are not inputs"""
+        key = self.key()
+        self.write("history.json", "{}")
+        self.write("history.json.tmp", "{")
+        self.cache.add(key, self.test_case.test_path())
+        self.write(".libs/libtool_output", "")
+        self.assertEqual(self.key(), key)
+
+
+class TestPerformanceGate(TestCaseDirTestCase):
+    """Only the fresh passing runs are a baseline and can be cached"""
+
+    def setUp(self):
+        super().setUp()
+        self.test_path = self.test_case.test_path()
+        self.history = systemtest.TestHistory(None)
+        self.history.update([self.record("pass", 1.0)])
+        # The options are only set when systemtest runs as a script.
+        self.saved_globals = (getattr(systemtest, "options", None),
+                              systemtest.result_cache, systemtest.collector)
+        systemtest.options = optparse.Values(
+            {"cpu_regression_limit": 50.0, "rss_regression_limit": None,
+             "dump_output": False, "print_successful": False,
+             "colors": False})
+        systemtest.result_cache = systemtest.TestResultCache(
+            os.path.join(self.directory, "cache"))
+        systemtest.collector = systemtest.ResultCollector(history=self.history)
+
+    def tearDown(self):
+        (systemtest.options, systemtest.result_cache,
+         systemtest.collector) = self.saved_globals
+        super().tearDown()
+
+    def record(self, verdict, cpu):
+        return {"test": self.test_path, "verdict": verdict, "timeout": False,
+                "maxrss": 0, "perf_budget": None, "exitcode": 0,
+                "wall": cpu, "user": cpu, "sys": 0.0}
+
+    def finish(self, cpu):
+        """Reports a passing run of the test case using the given CPU time."""
+        self.test_case.cache_key = systemtest.result_cache.key(self.test_case)
+        result = systemtest.TestCaseResult(self.test_path)
+        result.usage = systemtest.ProcessUsage(cpu, cpu, 0.0, 0)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.test_case._finish(result, io.StringIO())
+        return systemtest.collector.records[-1]["verdict"]
+
+    def test_failed_run_does_not_update_history(self):
+        """Failed, timed out and regressed runs keep the old baseline"""
+        self.history.update([self.record("fail", 0.1),
+                             self.record("timeout", 0.1),
+                             self.record("perf-regression", 9.0),
+                             self.record("cached-pass", 0.0)])
+        self.assertEqual(self.history.tests[self.test_path]["cpu"], 1.0)
+        self.assertEqual(
+            self.history.regressions(self.record("pass", 3.0), 50.0, None),
+            ["CPU time 1.00s -> 3.00s"])
+        self.history.update([self.record("pass", 1.2)])
+        self.assertEqual(self.history.tests[self.test_path]["cpu"], 1.2)
+
+    def test_regressed_run_is_not_cached(self):
+        """A run exceeding its budget is reported and not cached"""
+        self.assertEqual(self.finish(3.0), "perf-regression")
+        self.assertFalse(systemtest.result_cache.contains(
+            self.test_case.cache_key))
+        self.assertEqual(self.finish(1.2), "pass")
+        self.assertTrue(systemtest.result_cache.contains(
+            self.test_case.cache_key))
+
+
+if __name__ == '__main__':
+    unittest.main()
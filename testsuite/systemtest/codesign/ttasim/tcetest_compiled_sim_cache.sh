@@ -0,0 +1,59 @@
+#!/bin/bash
+### TCE TESTCASE
+### title: Compiled simulation engine cache
+### xstdout: miss OK\nhit OK\nrace OK
+
+# The first simulation stores its engine to TTASIM_COMPILED_SIM_CACHE, the
+# second one reuses it. Two concurrent simulations of a new program both
+# compile an engine, one of them stores it and the other one runs from its
+# own temporary engine, which is then removed.
+
+ADF=./data/guard_latencies.adf
+TPEF=./data/guard_latencies.tpef
+OTHER_ADF=./data/guard_write_in_the_same_instruction.adf
+OTHER_TPEF=./data/guard_write_in_the_same_instruction.tpef
+CACHE=$(mktemp -d tmpXXXXXX)
+FIRST=$(mktemp tmpXXXXXX.txt)
+SECOND=$(mktemp tmpXXXXXX.txt)
+
+function on_exit {
+    rm -rf $CACHE $FIRST $SECOND
+}
+trap on_exit EXIT
+
+set -e
+export TTASIM_COMPILED_SIM_CACHE=$CACHE
+
+function simulate {
+    ttasim -q --no-debugmode -a $1 -p $2 \
+        -e "run; puts [info proc cycles]; quit;"
+}
+
+function engines {
+    ls $CACHE | grep -c '^engine_' || true
+}
+
+function leftovers {
+    ls $CACHE | grep -c '^tmp_engine_' || true
+}
+
+CYCLES=$(simulate $ADF $TPEF)
+if [ "$(engines)" = 1 ] && [ "$(leftovers)" = 0 ]; then
+    echo "miss OK"
+fi
+
+ENGINE=$(ls $CACHE)
+# A hit marks the engine recently used for the eviction.
+touch -d "2000-01-01" $CACHE/$ENGINE
+if [ "$(simulate $ADF $TPEF)" = "$CYCLES" ] && [ "$(engines)" = 1 ] && \
+   [ -n "$(find $CACHE/$ENGINE -maxdepth 0 -newermt 2001-01-01)" ]; then
+    echo "hit OK"
+fi
+
+simulate $OTHER_ADF $OTHER_TPEF > $FIRST &
+simulate $OTHER_ADF $OTHER_TPEF > $SECOND
+wait
+if [ -s $FIRST ] && cmp -s $FIRST $SECOND && [ "$(engines)" = 2 ] && \
+   [ "$(leftovers)" = 0 ]; then
+    echo "race OK"
+fi
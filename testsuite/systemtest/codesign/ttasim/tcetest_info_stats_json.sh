@@ -0,0 +1,48 @@
+#!/bin/bash
+### TCE TESTCASE
+### title: info stats json in the interpretive and the compiled simulation
+### xstdout: interpretive OK\ncompiled OK\ncycles match
+
+# The record of 'info stats json' must be a single JSON object with all the
+# keys scheduler_tester reads, in both simulation engines.
+
+ADF=./data/guard_latencies.adf
+TPEF=./data/guard_latencies.tpef
+INTERPRETIVE=$(mktemp tmpXXXXXX.json)
+COMPILED=$(mktemp tmpXXXXXX.json)
+
+function on_exit {
+    rm -f $INTERPRETIVE $COMPILED
+}
+trap on_exit EXIT
+
+set -e
+
+function check_record {
+    python3 -c '
+import json, sys
+stats = json.load(open(sys.argv[1]))
+for key in ["cycles", "executed_operations", "register_reads",
+            "register_writes"]:
+    assert isinstance(stats[key], int) and stats[key] >= 0, key
+assert stats["cycles"] > 0
+assert isinstance(stats["fu_triggers"], dict) and stats["fu_triggers"]
+assert isinstance(stats["bus_writes"], dict) and stats["bus_writes"]
+print(sys.argv[2], "OK")
+' $1 $2
+}
+
+ttasim --no-debugmode -a $ADF -p $TPEF \
+    -e "run; puts [info stats json]; quit;" > $INTERPRETIVE
+check_record $INTERPRETIVE interpretive
+
+ttasim -q --no-debugmode -a $ADF -p $TPEF \
+    -e "run; puts [info stats json]; quit;" > $COMPILED
+check_record $COMPILED compiled
+
+python3 -c '
+import json, sys
+if json.load(open(sys.argv[1]))["cycles"] == \
+        json.load(open(sys.argv[2]))["cycles"]:
+    print("cycles match")
+' $INTERPRETIVE $COMPILED